@@ -0,0 +1,233 @@
+# Copyright © 2015 Landon Bouma. All rights reserved.
+#
+# Permission is hereby granted,  free of charge,  to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge,  publish,  distribute, sublicense,
+# and/or  sell copies  of the Software,  and to permit persons  to whom the
+# Software  is  furnished  to do so,  subject  to  the following conditions:
+#
+# The  above  copyright  notice  and  this  permission  notice  shall  be
+# included  in  all  copies  or  substantial  portions  of  the  Software.
+#
+# THE  SOFTWARE  IS  PROVIDED  "AS IS",  WITHOUT  WARRANTY  OF ANY KIND,
+# EXPRESS OR IMPLIED,  INCLUDING  BUT NOT LIMITED  TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE  FOR ANY
+# CLAIM,  DAMAGES OR OTHER LIABILITY,  WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE,  ARISING FROM,  OUT OF  OR IN  CONNECTION WITH THE
+# SOFTWARE   OR   THE   USE   OR   OTHER   DEALINGS  IN   THE  SOFTWARE.
+
+
+# Source slides read straight out of a zip or tar archive, or out of a tar
+# stream on stdin ('-'), without extracting them. An archive lists its
+# members (the regular files, by their normalized path) and reads each
+# member's bytes on demand, from any thread.
+#
+# A zip, or a plain tar file, is read in place: the zip's central directory,
+# or the tar's headers, say where each member's bytes are. A compressed tar,
+# or a stream, can't be read out of order without decompressing it all over
+# again, so its members are read as it's listed, in one pass, into memory,
+# up to MAX_MEMORY_BYTES, and past that, into a temporary file.
+
+import os
+import posixpath
+import sys
+import time
+
+# NOTE: mdm2 imports us on every run, so the archives import what only
+#       they need (zipfile, tarfile, and tempfile and shutil, to spool a
+#       stream) themselves.
+
+# How much of a compressed tar, or a stream, to keep in memory. The rest
+# of its members are spooled to a temporary file.
+MAX_MEMORY_BYTES = 64 * 1024 * 1024
+
+class ArchiveError(Exception):
+	pass
+
+def member_name(name):
+	'''
+	>>> member_name('./deck/slide.png')
+	'deck/slide.png'
+	>>> member_name('../slide.png') # doctest: +IGNORE_EXCEPTION_DETAIL
+	Traceback (most recent call last):
+	...
+	ArchiveError: the archive member is outside the archive: "../slide.png"
+	'''
+	# The member's path, normalized, since the target mirrors it, and so
+	# it had better not climb out of the target directory.
+	norm_name = posixpath.normpath(name)
+	if norm_name.startswith('/') or (norm_name.split('/')[0] in ('.', '..',)):
+		raise ArchiveError('the archive member is outside the archive: "%s"' % (name,))
+	return norm_name
+
+class SourceArchive(object):
+
+	def __init__(self, path):
+		self.path = path
+		# The (size, mtime, and where the bytes are) of each member, by name.
+		self.members = {}
+
+	def names(self):
+		return sorted(self.members)
+
+	def size(self, name):
+		return self.members[name][0]
+
+	def mtime(self, name):
+		return self.members[name][1]
+
+	def read(self, name):
+		# Raises KeyError if there's no such member.
+		raise NotImplementedError
+
+	def leading_bytes(self, name, count):
+		return self.read(name)[:count]
+
+	def close(self):
+		pass
+
+class ZipArchive(SourceArchive):
+	# NOTE: ZipFile reads each member under a lock, so the workers can share it.
+
+	def __init__(self, path):
+		import zipfile
+		import zlib
+		super(ZipArchive, self).__init__(path)
+		try:
+			self.zip_f = zipfile.ZipFile(path)
+		except (zipfile.BadZipFile, zlib.error, EOFError, NotImplementedError, RuntimeError) as err:
+			raise ArchiveError('could not read the archive "%s": %s' % (path, err,))
+		for info in self.zip_f.infolist():
+			if not info.is_dir():
+				mtime = time.mktime(info.date_time + (0, 0, -1,))
+				self.members[member_name(info.filename)] = (info.file_size, mtime, info,)
+
+	def read(self, name):
+		import zipfile
+		import zlib
+		try:
+			return self.zip_f.read(self.members[name][2])
+		except (zipfile.BadZipFile, zlib.error, EOFError, NotImplementedError, RuntimeError) as err:
+			raise ArchiveError('could not read "%s" from "%s": %s' % (name, self.path, err,))
+
+	def leading_bytes(self, name, count):
+		# Only decompresses as much as it has to.
+		import zipfile
+		import zlib
+		try:
+			with self.zip_f.open(self.members[name][2]) as member_f:
+				return member_f.read(count)
+		except (zipfile.BadZipFile, zlib.error, EOFError, NotImplementedError, RuntimeError) as err:
+			raise ArchiveError('could not read "%s" from "%s": %s' % (name, self.path, err,))
+
+	def close(self):
+		self.zip_f.close()
+
+class TarArchive(SourceArchive):
+	# An uncompressed tar file, whose members we read in place with pread,
+	# so the workers don't fight over the file position.
+
+	def __init__(self, path):
+		import tarfile
+		super(TarArchive, self).__init__(path)
+		# Listing a plain tar file only reads the headers, seeking past the rest.
+		with tarfile.open(path, 'r:') as tar_f:
+			for member in tar_f:
+				if not member.isreg():
+					continue
+				if member.issparse():
+					raise ArchiveError('sparse archive members are not supported: "%s"' % (member.name,))
+				self.members[member_name(member.name)] = (member.size, member.mtime, member.offset_data,)
+		self.fd = os.open(path, os.O_RDONLY)
+
+	def read(self, name):
+		size, mtime, offset = self.members[name]
+		data = os.pread(self.fd, size, offset)
+		if len(data) < size:
+			raise ArchiveError('"%s" is cut short in "%s"' % (name, self.path,))
+		return data
+
+	def leading_bytes(self, name, count):
+		size, mtime, offset = self.members[name]
+		return os.pread(self.fd, min(count, size), offset)
+
+	def close(self):
+		os.close(self.fd)
+
+class StreamArchive(SourceArchive):
+	# A compressed tar, or a tar stream, read as it's listed. A member is
+	# kept in memory (as bytes), if it fits in what's left of the
+	# max_memory, or else spooled to a temporary file (at an offset),
+	# which we read with pread, like TarArchive.
+
+	def __init__(self, path, tar_f, max_memory=None):
+		super(StreamArchive, self).__init__(path)
+		self.spool_f = None
+		memory_left = MAX_MEMORY_BYTES if (max_memory is None) else max_memory
+		for member in tar_f:
+			if not member.isreg():
+				continue
+			member_f = tar_f.extractfile(member)
+			if member.size <= memory_left:
+				where = member_f.read()
+				memory_left -= member.size
+			else:
+				if self.spool_f is None:
+					import tempfile
+					self.spool_f = tempfile.TemporaryFile(prefix='mdm2-archive-')
+				where = self.spool_f.seek(0, os.SEEK_END)
+				import shutil
+				shutil.copyfileobj(member_f, self.spool_f)
+			self.members[member_name(member.name)] = (member.size, member.mtime, where,)
+		if self.spool_f is not None:
+			self.spool_f.flush()
+
+	def read(self, name):
+		size, mtime, where = self.members[name]
+		if isinstance(where, bytes):
+			return where
+		return os.pread(self.spool_f.fileno(), size, where)
+
+	def leading_bytes(self, name, count):
+		size, mtime, where = self.members[name]
+		if isinstance(where, bytes):
+			return where[:count]
+		return os.pread(self.spool_f.fileno(), min(count, size), where)
+
+	def close(self):
+		if self.spool_f is not None:
+			self.spool_f.close()
+
+def is_archive(path):
+	import tarfile
+	import zipfile
+	try:
+		return zipfile.is_zipfile(path) or tarfile.is_tarfile(path)
+	except OSError:
+		return False
+
+def open_archive(path):
+	# Open the zip or tar archive at path, or '-' for a tar stream on stdin.
+	import tarfile
+	import zipfile
+	import zlib
+	try:
+		if path == '-':
+			with tarfile.open(fileobj=sys.stdin.buffer, mode='r|*') as tar_f:
+				return StreamArchive(path, tar_f)
+		if zipfile.is_zipfile(path):
+			return ZipArchive(path)
+		try:
+			return TarArchive(path)
+		except tarfile.ReadError:
+			# Not a plain tar file, so try it as a compressed one.
+			with tarfile.open(path, 'r|*') as tar_f:
+				return StreamArchive(path, tar_f)
+	except (tarfile.TarError, zipfile.BadZipFile, zlib.error, EOFError, OSError) as err:
+		raise ArchiveError('could not read the archive "%s": %s' % (path, err,))
+
+if __name__ == '__main__':
+	import doctest
+	doctest.testmod()
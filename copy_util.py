@@ -0,0 +1,83 @@
+# Copyright © 2015 Landon Bouma. All rights reserved.
+#
+# Permission is hereby granted,  free of charge,  to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge,  publish,  distribute, sublicense,
+# and/or  sell copies  of the Software,  and to permit persons  to whom the
+# Software  is  furnished  to do so,  subject  to  the following conditions:
+#
+# The  above  copyright  notice  and  this  permission  notice  shall  be
+# included  in  all  copies  or  substantial  portions  of  the  Software.
+#
+# THE  SOFTWARE  IS  PROVIDED  "AS IS",  WITHOUT  WARRANTY  OF ANY KIND,
+# EXPRESS OR IMPLIED,  INCLUDING  BUT NOT LIMITED  TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE  FOR ANY
+# CLAIM,  DAMAGES OR OTHER LIABILITY,  WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE,  ARISING FROM,  OUT OF  OR IN  CONNECTION WITH THE
+# SOFTWARE   OR   THE   USE   OR   OTHER   DEALINGS  IN   THE  SOFTWARE.
+
+# Copy a file as cheaply as the filesystem allows: share its blocks (a
+# reflink, on Btrfs or XFS), have the kernel copy it (copy_file_range),
+# or, failing both, copy it the usual way.
+
+import os
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+# From <linux/fs.h>: _IOW(0x94, 9, int).
+FICLONE = 0x40049409
+
+def reflink(source_path, target_path):
+	if fcntl is None:
+		raise OSError('reflinks need fcntl')
+	with open(source_path, 'rb') as source_f, open(target_path, 'wb') as target_f:
+		fcntl.ioctl(target_f.fileno(), FICLONE, source_f.fileno())
+
+def copy_range(source_path, target_path):
+	with open(source_path, 'rb') as source_f, open(target_path, 'wb') as target_f:
+		remaining = os.fstat(source_f.fileno()).st_size
+		while remaining > 0:
+			copied = os.copy_file_range(source_f.fileno(), target_f.fileno(), remaining)
+			if copied == 0:
+				break
+			remaining -= copied
+
+def clone_file(source_path, target_path, hardlink=False):
+	# Make target_path a copy of source_path, and return how we did it:
+	# 'link', 'reflink', 'copy_file_range' or 'copy'.
+	#
+	# A hard link is the cheapest of all, but then the target *is* the
+	# source, and editing one edits the other, so the caller has to ask.
+	#
+	# NOTE: We always remove the old target first, in case it's a hard link
+	#       from last time, so we don't go writing through it to the source.
+	try:
+		os.unlink(target_path)
+	except FileNotFoundError:
+		pass
+	if hardlink:
+		try:
+			os.link(source_path, target_path)
+			return 'link'
+		except OSError:
+			# E.g., the target's on another filesystem.
+			pass
+	try:
+		reflink(source_path, target_path)
+		return 'reflink'
+	except OSError:
+		pass
+	if hasattr(os, 'copy_file_range'):
+		try:
+			copy_range(source_path, target_path)
+			return 'copy_file_range'
+		except OSError:
+			pass
+	import shutil
+	shutil.copyfile(source_path, target_path)
+	return 'copy'
@@ -0,0 +1,127 @@
+# Copyright © 2015 Landon Bouma. All rights reserved.
+#
+# Permission is hereby granted,  free of charge,  to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge,  publish,  distribute, sublicense,
+# and/or  sell copies  of the Software,  and to permit persons  to whom the
+# Software  is  furnished  to do so,  subject  to  the following conditions:
+#
+# The  above  copyright  notice  and  this  permission  notice  shall  be
+# included  in  all  copies  or  substantial  portions  of  the  Software.
+#
+# THE  SOFTWARE  IS  PROVIDED  "AS IS",  WITHOUT  WARRANTY  OF ANY KIND,
+# EXPRESS OR IMPLIED,  INCLUDING  BUT NOT LIMITED  TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE  FOR ANY
+# CLAIM,  DAMAGES OR OTHER LIABILITY,  WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE,  ARISING FROM,  OUT OF  OR IN  CONNECTION WITH THE
+# SOFTWARE   OR   THE   USE   OR   OTHER   DEALINGS  IN   THE  SOFTWARE.
+
+
+# ImageMagick geometry, e.g., "1280x1024+0+8", "150%", "800x", "x600>", and
+# the sizes that -extent and -resize make of an image with it. Both engines
+# go by this, as does mdm2 when it estimates a slide's memory or scales its
+# labels, so they all agree with convert (and with each other).
+
+import re
+
+# E.g., "1280x1024+0+8", "150%", "800x", "x600>".
+geometry_regex = re.compile(
+	r'^(?P<width>\d+(\.\d+)?)?(x(?P<height>\d+(\.\d+)?))?'
+	r'(?P<flags>[%!<>^]*)(?P<x>[+-]\d+)?(?P<y>[+-]\d+)?$'
+)
+
+class GeometryError(ValueError):
+	pass
+
+def parse_geometry(geom, width, height):
+	'''
+	>>> parse_geometry('1280x1024+0+8', 1123, 873)
+	(1280, 1024, 0, 8, '')
+	>>> parse_geometry('100%', 1123, 873)
+	(1123, 873, 0, 0, '%')
+	>>> parse_geometry('50%', 1000, 800)
+	(500, 400, 0, 0, '%')
+	>>> parse_geometry('640', 1000, 800)
+	(640, 640, 0, 0, '')
+	>>> parse_geometry('x600>', 1000, 800)
+	(1000, 600, 0, 0, '>')
+	>>> parse_geometry('%', 1000, 800) # doctest: +IGNORE_EXCEPTION_DETAIL
+	Traceback (most recent call last):
+	...
+	GeometryError: geometry is missing a size: "%"
+	'''
+	# The percent sign can go after either dimension, or both, so treat it
+	# like just another flag.
+	match_obj = geometry_regex.match(geom.replace('%', ''))
+	if (match_obj is None) or (not geom):
+		raise GeometryError('unrecognized geometry: "%s"' % (geom,))
+	flags = match_obj.group('flags') + ('%' if ('%' in geom) else '')
+	geom_w = match_obj.group('width')
+	geom_h = match_obj.group('height')
+	if (geom_w is None) and (geom_h is None):
+		raise GeometryError('geometry is missing a size: "%s"' % (geom,))
+	if '%' in flags:
+		scale_w = float(geom_w if geom_w is not None else geom_h)
+		scale_h = float(geom_h if geom_h is not None else geom_w)
+		new_w = int(round(width * scale_w / 100.0))
+		new_h = int(round(height * scale_h / 100.0))
+	else:
+		# Like convert, a lone width is also the height, and vice versa,
+		# except that a missing dimension is left as is with "Wx" or "xH".
+		if geom_w is None:
+			new_w = width
+		else:
+			new_w = int(float(geom_w))
+		if geom_h is None:
+			new_h = new_w if ('x' not in geom) else height
+		else:
+			new_h = int(float(geom_h))
+	off_x = int(match_obj.group('x') or 0)
+	off_y = int(match_obj.group('y') or 0)
+	return new_w, new_h, off_x, off_y, flags
+
+def extent_size(extent_geom, width, height):
+	'''
+	>>> extent_size('100%', 640, 480)
+	(640, 480)
+	>>> extent_size('1280x1024+0+8', 640, 480)
+	(1280, 1024)
+	>>> extent_size('50x25%', 640, 480)
+	(320, 120)
+	>>> extent_size('640', 800, 480)
+	(640, 640)
+	'''
+	# The size of the canvas that -extent makes from a width x height image.
+	new_w, new_h, off_x, off_y, flags = parse_geometry(extent_geom, width, height)
+	return new_w, new_h
+
+def resize_size(resize_geom, width, height):
+	'''
+	>>> resize_size('1920x1080', 3840, 2400)
+	(1728, 1080)
+	>>> resize_size('25%', 1280, 1024)
+	(320, 256)
+	>>> resize_size('320', 1280, 1024)
+	(320, 256)
+	>>> resize_size('1920x1080>', 1280, 1024)
+	(1280, 1024)
+	>>> resize_size('320x320!', 1280, 1024)
+	(320, 320)
+	'''
+	# The size that -resize makes from a width x height image: scaled to fit
+	# inside the box, keeping the aspect ratio, unless it's a percentage or
+	# has a "!", and only shrunk (or enlarged) with a ">" (or "<").
+	new_w, new_h, off_x, off_y, flags = parse_geometry(resize_geom, width, height)
+	if ('%' not in flags) and ('!' not in flags):
+		scale = min(float(new_w) / width, float(new_h) / height)
+		if (('>' in flags) and (scale >= 1.0)) or (('<' in flags) and (scale <= 1.0)):
+			return width, height
+		new_w = max(1, int(round(width * scale)))
+		new_h = max(1, int(round(height * scale)))
+	return new_w, new_h
+
+if __name__ == '__main__':
+	import doctest
+	doctest.testmod()
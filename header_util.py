@@ -0,0 +1,241 @@
+# Copyright © 2015 Landon Bouma. All rights reserved.
+#
+# Permission is hereby granted,  free of charge,  to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge,  publish,  distribute, sublicense,
+# and/or  sell copies  of the Software,  and to permit persons  to whom the
+# Software  is  furnished  to do so,  subject  to  the following conditions:
+#
+# The  above  copyright  notice  and  this  permission  notice  shall  be
+# included  in  all  copies  or  substantial  portions  of  the  Software.
+#
+# THE  SOFTWARE  IS  PROVIDED  "AS IS",  WITHOUT  WARRANTY  OF ANY KIND,
+# EXPRESS OR IMPLIED,  INCLUDING  BUT NOT LIMITED  TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE  FOR ANY
+# CLAIM,  DAMAGES OR OTHER LIABILITY,  WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE,  ARISING FROM,  OUT OF  OR IN  CONNECTION WITH THE
+# SOFTWARE   OR   THE   USE   OR   OTHER   DEALINGS  IN   THE  SOFTWARE.
+
+# Read an image's size from its header, without decoding the image, so we
+# can tell how much memory it'll take before we hand it to convert. Also
+# read the date from its EXIF data, for the {exif_date} label variable, and
+# check that an image we wrote wasn't cut short, for --resume.
+
+import io
+import struct
+
+class HeaderError(Exception):
+	pass
+
+# The EXIF tags for when the picture was taken, and, failing that, when
+# the file was last changed (by the camera, or an editor).
+EXIF_DATE_ORIGINAL = 0x9003
+EXIF_DATE_TIME = 0x0132
+EXIF_IFD_POINTER = 0x8769
+
+# The most IFDs we'll read for those (there's usually just the two).
+MAX_IFDS = 4
+
+def open_image(image):
+	# The image is a path, or its bytes, e.g., read out of an archive.
+	if isinstance(image, bytes):
+		return io.BytesIO(image)
+	return open(image, 'rb')
+
+def jpeg_segments(image_f):
+	# Yield the marker and length of each JPEG segment, with the file at the
+	# start of the segment's data. We seek past the segments the caller
+	# doesn't read, so, e.g., a big EXIF thumbnail doesn't cost us a read.
+	if image_f.read(2) != b'\xff\xd8':
+		raise HeaderError('not a JPEG')
+	while True:
+		marker = image_f.read(2)
+		while marker[1:2] == b'\xff':
+			# Padding.
+			marker = marker[1:] + image_f.read(1)
+		if (len(marker) < 2) or (marker[0] != 0xff):
+			raise HeaderError('not a JPEG: ran out of segments')
+		seg_len = struct.unpack('>H', image_f.read(2))[0]
+		next_segment = image_f.tell() + seg_len - 2
+		yield marker[1], seg_len - 2
+		image_f.seek(next_segment)
+
+def jpeg_dimensions(image_f):
+	'''
+	>>> sof = b'\\xff\\xc0\\x00\\x11\\x08\\x00\\x02\\x00\\x03\\x03'
+	>>> jpeg_dimensions(io.BytesIO(b'\\xff\\xd8' + sof))
+	(3, 2, 3)
+	'''
+	# The start of frame has the size and the number of color components.
+	for marker, seg_len in jpeg_segments(image_f):
+		if (0xc0 <= marker <= 0xcf) and (marker not in (0xc4, 0xc8, 0xcc,)):
+			segment = image_f.read(6)
+			height, width = struct.unpack('>HH', segment[1:5])
+			return width, height, segment[5]
+
+def header_dimensions(header):
+	'''
+	>>> header_dimensions(b'\\x89PNG\\r\\n\\x1a\\n\\x00\\x00\\x00\\rIHDR'
+	...     b'\\x00\\x00\\x01\\x00\\x00\\x00\\x00\\x80\\x08\\x06')
+	(256, 128, 4)
+	>>> header_dimensions(b'GIF89a\\x20\\x00\\x10\\x00')
+	(32, 16, 4)
+	>>> print(header_dimensions(b'II*\\x00'))
+	None
+	'''
+	# The formats (other than JPEG) that put the size up front.
+	if header.startswith(b'\x89PNG\r\n\x1a\n') and (header[12:16] == b'IHDR'):
+		width, height = struct.unpack('>II', header[16:24])
+		# Gray, RGB, palette (which gets expanded), gray+alpha, RGBA.
+		channels = {0: 1, 2: 3, 3: 3, 4: 2, 6: 4}.get(header[25], 4)
+		return width, height, channels
+	if header.startswith((b'GIF87a', b'GIF89a',)):
+		width, height = struct.unpack('<HH', header[6:10])
+		return width, height, 4
+	if header.startswith(b'BM') and (len(header) >= 30):
+		width, height = struct.unpack('<ii', header[18:26])
+		bits = struct.unpack('<H', header[28:30])[0]
+		return width, abs(height), (4 if (bits == 32) else 3)
+	if header.startswith(b'RIFF') and (header[8:12] == b'WEBP'):
+		chunk = header[12:16]
+		if chunk == b'VP8 ':
+			width, height = struct.unpack('<HH', header[26:30])
+			return width & 0x3fff, height & 0x3fff, 3
+		if chunk == b'VP8L':
+			bits = struct.unpack('<I', header[21:25])[0]
+			return (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1, 4
+		if chunk == b'VP8X':
+			width = int.from_bytes(header[24:27], 'little') + 1
+			height = int.from_bytes(header[27:30], 'little') + 1
+			return width, height, 4
+	return None
+
+def image_dimensions(image_path):
+	# Returns (width, height, channels), or None if we don't know the format
+	# (or the header's garbage), in which case, the caller has to guess.
+	try:
+		with open_image(image_path) as image_f:
+			header = image_f.read(32)
+			if header.startswith(b'\xff\xd8'):
+				image_f.seek(0)
+				return jpeg_dimensions(image_f)
+			return header_dimensions(header)
+	except (OSError, HeaderError, struct.error, IndexError):
+		return None
+
+def image_complete(image_path):
+	# Returns False if the image was cut short (e.g., by a crash while it was
+	# being written), going by how its format ends, True if it ends right,
+	# or None if we can't tell (an unknown format, or no such file).
+	try:
+		with open(image_path, 'rb') as image_f:
+			header = image_f.read(12)
+			image_f.seek(0, io.SEEK_END)
+			image_size = image_f.tell()
+			image_f.seek(max(0, image_size - 12))
+			trailer = image_f.read(12)
+	except OSError:
+		return None
+	if header.startswith(b'\x89PNG\r\n\x1a\n'):
+		# The IEND chunk: no data, and a fixed CRC.
+		return trailer == b'\x00\x00\x00\x00IEND\xaeB`\x82'
+	if header.startswith(b'\xff\xd8'):
+		# The end of image marker (which some encoders pad after).
+		return trailer.rstrip(b'\x00').endswith(b'\xff\xd9')
+	if header.startswith((b'GIF87a', b'GIF89a',)):
+		return trailer.endswith(b'\x3b')
+	if header.startswith(b'RIFF') and (header[8:12] == b'WEBP'):
+		# The RIFF size doesn't count the first 8 bytes.
+		return struct.unpack('<I', header[4:8])[0] + 8 == image_size
+	return None
+
+def exif_block(image_f):
+	# Return the EXIF data (which is a little TIFF file) from a JPEG, PNG or
+	# WebP, or None if there isn't any.
+	header = image_f.read(12)
+	image_f.seek(0)
+	if header.startswith(b'\xff\xd8'):
+		for marker, seg_len in jpeg_segments(image_f):
+			if marker == 0xe1:
+				segment = image_f.read(seg_len)
+				if segment.startswith(b'Exif\x00\x00'):
+					return segment[6:]
+			elif marker in (0xc0, 0xc2, 0xda,):
+				# The EXIF comes before the image data, if at all.
+				return None
+	elif header.startswith(b'\x89PNG\r\n\x1a\n'):
+		image_f.seek(8)
+		while True:
+			chunk_len, chunk_type = struct.unpack('>I4s', image_f.read(8))
+			if chunk_type == b'eXIf':
+				return image_f.read(chunk_len)
+			if chunk_type in (b'IDAT', b'IEND',):
+				return None
+			image_f.seek(chunk_len + 4, io.SEEK_CUR)
+	elif header.startswith(b'RIFF') and (header[8:12] == b'WEBP'):
+		image_f.seek(12)
+		while True:
+			chunk_type, chunk_len = struct.unpack('<4sI', image_f.read(8))
+			if chunk_type == b'EXIF':
+				return image_f.read(chunk_len)
+			# Chunks are padded to an even length.
+			image_f.seek(chunk_len + (chunk_len & 1), io.SEEK_CUR)
+	return None
+
+def tiff_ascii_tags(tiff, wanted):
+	'''
+	>>> tiff = (b'II*\\x00\\x08\\x00\\x00\\x00' b'\\x01\\x00'
+	...     b'\\x32\\x01\\x02\\x00\\x04\\x00\\x00\\x00' b'abc\\x00' b'\\x00\\x00\\x00\\x00')
+	>>> tiff_ascii_tags(tiff, (0x0132,))
+	{306: 'abc'}
+	>>> tiff_ascii_tags(b'II*\\x00\\x08\\x00\\x00\\x00' b'\\x01\\x00'
+	...     b'\\x69\\x87\\x04\\x00\\x01\\x00\\x00\\x00\\x08\\x00\\x00\\x00', (0x0132,))
+	{}
+	'''
+	# Look up the wanted ASCII tags in the first IFD, and in the EXIF IFD
+	# it points to, if any. A broken (or nasty) file's IFDs might point
+	# back at each other, so we read each one once, and only so many.
+	byte_order = '<' if tiff.startswith(b'II') else '>'
+	found = {}
+	ifd_offsets = [struct.unpack(byte_order + 'I', tiff[4:8])[0]]
+	visited = set()
+	while ifd_offsets and (len(visited) < MAX_IFDS):
+		ifd_offset = ifd_offsets.pop()
+		if (ifd_offset in visited) or (ifd_offset >= len(tiff)):
+			continue
+		visited.add(ifd_offset)
+		num_entries = struct.unpack(byte_order + 'H', tiff[ifd_offset:ifd_offset + 2])[0]
+		for entry_i in range(num_entries):
+			entry_offset = ifd_offset + 2 + (12 * entry_i)
+			tag, value_type, count = struct.unpack(
+				byte_order + 'HHI', tiff[entry_offset:entry_offset + 8],
+			)
+			value = tiff[entry_offset + 8:entry_offset + 12]
+			if tag == EXIF_IFD_POINTER:
+				ifd_offsets.append(struct.unpack(byte_order + 'I', value)[0])
+			elif (tag in wanted) and (value_type == 2):
+				# ASCII, which is stored in the entry itself if it fits.
+				if count > 4:
+					value_offset = struct.unpack(byte_order + 'I', value)[0]
+					value = tiff[value_offset:value_offset + count]
+				found[tag] = value[:count].split(b'\x00', 1)[0].decode('ascii', 'replace').strip()
+	return found
+
+def exif_date(image_path):
+	# Returns when the picture was taken, according to its EXIF data, as a
+	# datetime, or None if it doesn't say.
+	try:
+		with open_image(image_path) as image_f:
+			tiff = exif_block(image_f)
+		if not tiff:
+			return None
+		tags = tiff_ascii_tags(tiff, (EXIF_DATE_ORIGINAL, EXIF_DATE_TIME,))
+		for tag in (EXIF_DATE_ORIGINAL, EXIF_DATE_TIME,):
+			if tags.get(tag):
+				import datetime
+				return datetime.datetime.strptime(tags[tag], '%Y:%m:%d %H:%M:%S')
+	except (OSError, HeaderError, struct.error, ValueError):
+		pass
+	return None
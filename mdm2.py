@@ -32,8 +32,13 @@ import os
 import sys
 
 import argparse
+import fnmatch
+import io
+import json
 import re
+import signal
 import subprocess
+import threading
 import time
 
 try:
@@ -41,8 +46,2011 @@ try:
 except ImportError:
 	pass
 
+# NOTE: To keep startup quick, modules that only some runs need are
+#       imported when first needed: concurrent.futures (when rendering),
+#       hashlib (--incremental, --dedup), datetime ({mtime}), string (for
+#       the labels), shutil, watch_util (--watch) and pil_render (--engine
+#       pillow).
+
+import archive_util
+import copy_util
+import geometry_util
+import header_util
+import metrics_util
+import probe_util
+import sink_util
+
+# The in-process rendering engine is optional, as is Pillow, which it needs.
+# Pillow's slow to import, so pil_render_load() imports it, if it can, the
+# first time it's called. Until then, this is None.
+pil_render = None
+
+def pil_render_load():
+	global pil_render
+	if pil_render is None:
+		try:
+			import pil_render
+		except ImportError:
+			return None
+	return pil_render
+
 SCRIPT_NAME = os.path.basename(__file__)
 
+# The incremental mode remembers what it rendered in the target directory.
+MANIFEST_NAME = '.mdm2-manifest.json'
+MANIFEST_VERSION = 2
+
+# Each --shard keeps its own manifest, which --merge-shards checks and
+# combines into the usual one.
+SHARD_MANIFEST_FMT = '.mdm2-manifest.shard-%d-of-%d.json'
+
+# Each slide is written to a partial file, which is renamed into place when
+# it's done, and then noted in the journal, so --resume can pick up after a
+# crash. The journal is removed when the run finishes.
+PARTIAL_PREFIX = '.mdm2-partial.'
+JOURNAL_NAME = '.mdm2-journal.jsonl'
+SHARD_JOURNAL_FMT = '.mdm2-journal.shard-%d-of-%d.jsonl'
+
+# How long to wait before trying a convert that timed out again (in secs.),
+# which doubles with each try.
+RETRY_BACKOFF = 1.0
+
+# The file extensions we assume are images, unless --sniff is used.
+IMAGE_EXTENSIONS = set([
+	'.avif', '.bmp', '.gif', '.heic', '.ico', '.jp2', '.jpeg', '.jpg', '.jxl',
+	'.pbm', '.pgm', '.png', '.pnm', '.ppm', '.psd', '.svg', '.tga', '.tif',
+	'.tiff', '.webp', '.xcf',
+])
+
+# The first few bytes of the image formats we know, for --sniff.
+IMAGE_MAGIC = (
+	b'\x89PNG\r\n\x1a\n', # PNG
+	b'\xff\xd8\xff', # JPEG
+	b'GIF87a', b'GIF89a', # GIF
+	b'BM', # BMP
+	b'II*\x00', b'MM\x00*', # TIFF
+	b'gimp xcf', # XCF
+	b'8BPS', # PSD
+	b'\x00\x00\x01\x00', # ICO
+	b'\x00\x00\x00\x0cjP  ', # JPEG 2000
+	b'\xff\x0a', b'\x00\x00\x00\x0cJXL ', # JPEG XL
+	b'P1', b'P2', b'P3', b'P4', b'P5', b'P6', # Netpbm
+)
+
+def percentile(values, pct):
+	'''
+	>>> percentile([3, 1, 2, 4], 50)
+	2
+	>>> percentile([3, 1, 2, 4], 95)
+	4
+	>>> print(percentile([], 50))
+	None
+	'''
+	# The nearest-rank percentile, which is always one of the values.
+	if not values:
+		return None
+	ordered = sorted(values)
+	rank = max(1, int(-(-pct * len(ordered) // 100)))
+	return ordered[rank - 1]
+
+def parse_size(size):
+	'''
+	>>> parse_size('512M')
+	536870912
+	>>> parse_size('1.5GiB')
+	1610612736
+	>>> parse_size('1000')
+	1000
+	'''
+	# A byte count, with an optional (binary) K, M, G or T suffix.
+	match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)(?:i?b)?\s*$', size, re.IGNORECASE)
+	if match is None:
+		raise ValueError('not a size: "%s"' % (size,))
+	scale = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+	return int(float(match.group(1)) * scale[match.group(2).lower()])
+
+def shard_range(count, shard_i, shard_n):
+	'''
+	>>> [shard_range(10, shard_i, 3) for shard_i in (1, 2, 3)]
+	[(0, 3), (3, 6), (6, 10)]
+	>>> shard_range(2, 3, 4)
+	(1, 1)
+	'''
+	# The start and end index of shard i (1-based) of n of count slides.
+	# Each shard gets a contiguous run of slides, so it knows the number of
+	# its first slide, and the shards' sizes differ by one at most.
+	return (count * (shard_i - 1) // shard_n, count * shard_i // shard_n)
+
+def partial_path(target_path):
+	'''
+	>>> partial_path(os.path.join('dst', 'web', 'slide.png'))
+	'dst/web/.mdm2-partial.slide.png'
+	'''
+	# Where to write the target until it's done. It keeps the extension,
+	# since that's how convert knows what format to write.
+	target_dir, target_name = os.path.split(target_path)
+	return os.path.join(target_dir, PARTIAL_PREFIX + target_name)
+
+def stdin_source(src_file):
+	'''
+	>>> stdin_source('deck/slide.PNG')
+	'png:-'
+	>>> stdin_source('slide')
+	'-'
+	'''
+	# How to tell convert to read the source from stdin. The extension says
+	# what format it is, as it would for a file, for the formats that don't
+	# start with any magic that convert could go by.
+	source_ext = os.path.splitext(src_file)[1][1:].lower()
+	return '%s:-' % (source_ext,) if source_ext else '-'
+
+def shrink_geometry(resize_geom):
+	'''
+	>>> shrink_geometry('1920x1080')
+	'1920x1080>'
+	>>> shrink_geometry('50%')
+	'50%'
+	'''
+	# Only ever shrink a rendition, so a smaller one never gets blown back up.
+	if re.search(r'[%<>!^]', resize_geom):
+		return resize_geom
+	return resize_geom + '>'
+
+def parse_extent_profile(profile):
+	'''
+	>>> parse_extent_profile('1280x1024+0+8')
+	(None, '1280x1024+0+8', None)
+	>>> parse_extent_profile('web=1920x1080:0.5')
+	('web', '1920x1080', 0.5)
+	'''
+	# An --extent is [NAME=]GEOM[:LABEL_SCALE].
+	name, _, geom = profile.rpartition('=')
+	geom, _, label_scale = geom.partition(':')
+	# Raises GeometryError, a ValueError, if convert wouldn't understand it.
+	geometry_util.parse_geometry(geom, 1, 1)
+	return (name or None, geom, float(label_scale) if label_scale else None)
+
+def rendition_name(geom):
+	'''
+	>>> rendition_name('1920x1080+0+8')
+	'1920x1080'
+	>>> rendition_name('25%')
+	'25pct'
+	'''
+	# A directory name for an unnamed rendition.
+	return re.sub(r'[^0-9A-Za-z.x]', '', re.split(r'[+-]', geom)[0].replace('%', 'pct'))
+
+# The output encoder presets. The options the user specifies win out.
+# PNG compression goes from 0 (none) to 9 (most), and the PNG filter is
+# 0 (none) through 4 (Paeth), or 5 (adaptive). WebP's method goes from 0
+# (fastest) to 6 (smallest). Quality applies to the lossy formats.
+ENCODER_PRESETS = {
+	# For previewing: spend as little CPU as possible on compression.
+	'fast': {
+		'quality': 85,
+		'png_compression': 1,
+		'png_filter': 0,
+		'webp_method': 0,
+		'strip': False,
+	},
+	# For distribution: spend the CPU to make the files small.
+	'small': {
+		'quality': 75,
+		'png_compression': 9,
+		'png_filter': 5,
+		'webp_method': 6,
+		'strip': True,
+	},
+}
+
+# The encoder settings when neither the user nor a preset says otherwise.
+ENCODER_DEFAULTS = {
+	'format': None,
+	'quality': None,
+	'png_compression': None,
+	'png_filter': None,
+	'webp_method': None,
+	'strip': False,
+}
+
+# The label settings when the user doesn't specify them. The font_path
+# default depends on what's installed; see find_default_font.
+LABEL_DEFAULTS = {
+	'font_path': None,
+	'font_style': 'Normal',
+	'font_weight': 'Normal',
+	'font_size': 20,
+	'font_fill': 'black',
+	'font_stroke': 'none',
+	'offset_gravity': 'center',
+	'offset_x': 0,
+	'offset_y': 0,
+	'autofit': None,
+}
+
+# The variables a label can use, e.g., '{slide_number} / {slide_count}'.
+# Those past slide_count are looked up from the source image (or from its
+# caption file, e.g., 'slide.png.txt'), but only if a label uses them.
+LABEL_VARIABLES = (
+	'filename', 'slide_number', 'slide_count',
+	'width', 'height', 'mtime', 'exif_date', 'caption',
+)
+
+# The label variables that change from slide to slide.
+PER_SLIDE_VARIABLES = tuple(
+	var_name for var_name in LABEL_VARIABLES if var_name != 'slide_count'
+)
+
+class MDM2_Error(Exception):
+	# Raised from the render workers so that the main thread, and not
+	# some worker thread, decides how to report the failure and quit.
+	pass
+
+class MemoryBudget(object):
+	# Lets the render workers take turns with a fixed amount of memory. Each
+	# worker reserves what it thinks its slide needs, and waits until that
+	# much is free. A slide that needs more than the whole budget still gets
+	# rendered, once it has the budget all to itself.
+
+	def __init__(self, limit):
+		self.limit = limit
+		self.in_use = 0
+		self.peak = 0
+		self.cond = threading.Condition()
+
+	def acquire(self, amount):
+		amount = min(amount, self.limit)
+		with self.cond:
+			while self.in_use and (self.in_use + amount > self.limit):
+				self.cond.wait()
+			self.in_use += amount
+			self.peak = max(self.peak, self.in_use)
+		return amount
+
+	def release(self, amount):
+		with self.cond:
+			self.in_use -= amount
+			self.cond.notify_all()
+
+def find_default_font():
+	# The author is partial to the Google-sponsored open source sans font.
+	# Check for that first in the user's home directory.
+	def_font_path = os.path.join(
+		# I.e., ~/.fonts/open-sans/OpenSans-Regular.ttf
+		os.path.expanduser('~'), '.fonts', 'open-sans', 'OpenSans-Regular.ttf',
+	)
+	# The auther also runs Linux Mint (Ubuntu), so fallback on the system sans.
+	if not os.path.exists(def_font_path):
+		def_font_path = os.path.join(
+			# I.e., /usr/share/fonts/truetype/dejavu/DejaVuSans.ttf
+			os.sep, 'usr', 'share', 'fonts', 'truetype', 'dejavu', 'DejaVuSans.ttf',
+		)
+	# If there's no basic font found, force the user to specify it.
+	if not os.path.exists(def_font_path):
+		def_font_path = None
+	# NOTE: For a list of fonts, try
+	#         convert -list font
+	return def_font_path
+
+class MissingValue(object):
+	# Stands in for a variable the slide doesn't have, like the EXIF date of
+	# a screenshot, and comes out empty, whatever the format spec.
+
+	def __format__(self, format_spec):
+		return ''
+
+	def __str__(self):
+		return ''
+
+class LabelTemplate(object):
+	'''
+	>>> template = LabelTemplate('{slide_number} / {slide_count}')
+	>>> sorted(template.variables)
+	['slide_count', 'slide_number']
+	>>> template.static
+	False
+	>>> LabelTemplate('My Design Presentation').static
+	True
+	>>> LabelTemplate('{slide_count} slides').static
+	True
+	>>> template.render({'slide_number': '07', 'slide_count': 12})
+	'07 / 12'
+	>>> import datetime
+	>>> LabelTemplate('{mtime:%Y}').render({'mtime': datetime.datetime(2015, 7, 4)})
+	'2015'
+	'''
+	# A label, parsed once into its literal text and variable fields, so that
+	# rendering it for each slide is just a join, and so we know up front
+	# which variables it needs and whether it's the same on every slide.
+
+	# A string.Formatter, made for the first label.
+	formatter = None
+
+	def __init__(self, label):
+		if LabelTemplate.formatter is None:
+			import string
+			LabelTemplate.formatter = string.Formatter()
+		self.label = label
+		try:
+			self.segments = list(self.formatter.parse(label))
+			self.variables = set()
+			for literal_text, field_name, format_spec, conversion in self.segments:
+				if field_name is not None:
+					self.variables.add(self.variable_name(field_name))
+				# The format spec can have fields of its own, e.g., '{caption:>{width}}'.
+				for _, spec_field, _, _ in self.formatter.parse(format_spec or ''):
+					if spec_field is not None:
+						self.variables.add(self.variable_name(spec_field))
+		except ValueError as err:
+			raise MDM2_Error('bad label: "%s": %s' % (label, err,))
+		self.static = not self.variables.intersection(PER_SLIDE_VARIABLES)
+		# The text of a static label, by slide_count, which is all it can use.
+		self.static_texts = {}
+
+	def variable_name(self, field_name):
+		# E.g., 'mtime.year' is the mtime variable.
+		var_name = re.match(r'[^.\[]*', field_name).group(0)
+		if var_name not in LABEL_VARIABLES:
+			raise ValueError('unknown variable: "{%s}"' % (field_name,))
+		return var_name
+
+	def render(self, variables):
+		# The variables is a mapping, which only has to have the ones we use.
+		if self.static:
+			static_key = variables['slide_count'] if ('slide_count' in self.variables) else None
+			try:
+				return self.static_texts[static_key]
+			except KeyError:
+				pass
+		parts = []
+		for literal_text, field_name, format_spec, conversion in self.segments:
+			parts.append(literal_text)
+			if field_name is None:
+				continue
+			value = self.formatter.get_field(field_name, (), variables)[0]
+			value = self.formatter.convert_field(value, conversion)
+			if format_spec and ('{' in format_spec):
+				format_spec = self.formatter.vformat(format_spec, (), variables)
+			parts.append(self.formatter.format_field(value, format_spec))
+		text = ''.join(parts)
+		if self.static:
+			self.static_texts[static_key] = text
+		return text
+
+class SlideVariables(dict):
+	# The label variables for one slide. The ones that cost I/O to look up
+	# (the image size, the dates, and the caption) are only looked up when a
+	# label asks for them, and then only once.
+	#
+	# For a slide from an archive, the source_path is the member's name, and
+	# the source_data its bytes.
+
+	def __init__(self, source_path, archive=None, source_data=None, **variables):
+		super(SlideVariables, self).__init__(variables)
+		self.source_path = source_path
+		self.archive = archive
+		self.source_data = source_data
+		self.image = source_path if (archive is None) else source_data
+
+	def __missing__(self, var_name):
+		if var_name in ('width', 'height',):
+			self['width'], self['height'] = self.image_size()
+		elif var_name == 'mtime':
+			if self.archive is not None:
+				source_mtime = int(self.archive.mtime(self.source_path))
+			else:
+				source_mtime = int(os.stat(self.source_path).st_mtime)
+			import datetime
+			self['mtime'] = datetime.datetime.fromtimestamp(source_mtime)
+		elif var_name == 'exif_date':
+			self['exif_date'] = header_util.exif_date(self.image) or MissingValue()
+		elif var_name == 'caption':
+			self['caption'] = self.read_caption()
+		else:
+			raise KeyError(var_name)
+		return self[var_name]
+
+	def image_size(self):
+		dimensions = header_util.image_dimensions(self.image)
+		if dimensions is not None:
+			return dimensions[0], dimensions[1]
+		# A format we can't read the header of, so ask ImageMagick, which
+		# (with -ping) doesn't decode the image, either.
+		if self.archive is not None:
+			identify_source = stdin_source(self.source_path)
+		else:
+			identify_source = self.source_path
+		try:
+			size_text = subprocess.check_output(
+				['identify', '-ping', '-format', '%w %h', '%s[0]' % (identify_source,)],
+				input=self.source_data,
+				stderr=subprocess.PIPE,
+			)
+			width, height = size_text.split()
+			return int(width), int(height)
+		except (OSError, ValueError, subprocess.CalledProcessError):
+			raise MDM2_Error('could not tell the size of "%s"' % (self.source_path,))
+
+	def read_caption(self):
+		# The caption is in a text file next to the image, named after the
+		# image, e.g., 'slide.png.txt', or 'slide.txt'.
+		for caption_path in (
+			'%s.txt' % (self.source_path,),
+			'%s.txt' % (os.path.splitext(self.source_path)[0],),
+		):
+			try:
+				if self.archive is not None:
+					return self.archive.read(caption_path).decode('utf-8').strip()
+				with open(caption_path, 'r') as caption_f:
+					return caption_f.read().strip()
+			except (FileNotFoundError, KeyError):
+				pass
+		return ''
+
+class LabelSpec(dict):
+	# One label: its text (which may use {filename}, {slide_number} and
+	# {slide_count}) and the LABEL_DEFAULTS settings used to draw it. It's
+	# just a dict (a/k/a label_def), so the engines can look up its settings.
+
+	def __init__(self, label, **settings):
+		super(LabelSpec, self).__init__(LABEL_DEFAULTS)
+		self.update(settings)
+		if not self['font_path']:
+			self['font_path'] = find_default_font()
+		self['label'] = label
+		# With autofit, a (width, height) box (or a 'WxH' string), the label
+		# is drawn at the largest font_size that fits in it (see sized).
+		if isinstance(self['autofit'], str):
+			match = re.match(r'^(\d+)x(\d+)$', self['autofit'])
+			if match is None:
+				raise MDM2_Error(
+					'the autofit box should be WxH, e.g., 400x60: "%s"' % (self['autofit'],)
+				)
+			self['autofit'] = (int(match.group(1)), int(match.group(2)),)
+		self.template = LabelTemplate(label)
+		# A label that doesn't use any of the per-slide variables looks the
+		# same on every slide, so the pillow engine only renders it once.
+		self['static'] = self.template.static
+		# The convert options that draw the label, less the text itself.
+		self.annotate_opts = None
+		# The copies of this label for other sizes of slide, by scale, and
+		# for the autofit font sizes.
+		self.scaled_specs = {}
+		self.sized_specs = {}
+
+	def scaled(self, scale):
+		# The same label, sized for a slide that's scale times as big.
+		if scale == 1.0:
+			return self
+		try:
+			return self.scaled_specs[scale]
+		except KeyError:
+			pass
+		settings = dict(self)
+		del settings['label']
+		del settings['static']
+		settings['font_size'] = max(1, int(round(self['font_size'] * scale)))
+		settings['offset_x'] = int(round(self['offset_x'] * scale))
+		settings['offset_y'] = int(round(self['offset_y'] * scale))
+		if self['autofit']:
+			settings['autofit'] = tuple(max(1, int(round(side * scale))) for side in self['autofit'])
+		return self.scaled_specs.setdefault(scale, LabelSpec(self['label'], **settings))
+
+	def sized(self, font_size):
+		# The same label, at the font_size its autofit box fits.
+		try:
+			return self.sized_specs[font_size]
+		except KeyError:
+			pass
+		settings = dict(self)
+		del settings['label']
+		del settings['static']
+		settings['font_size'] = font_size
+		settings['autofit'] = None
+		return self.sized_specs.setdefault(font_size, LabelSpec(self['label'], **settings))
+
+	def annotate_options(self):
+		if self.annotate_opts is None:
+			#draw_text_posit = '%s,%s' % (self['offset_x'], self['offset_y'],)
+			annotate_posit = '+%s+%s' % (self['offset_x'], self['offset_y'],)
+			self.annotate_opts = metrics_util.font_options(
+				self['font_path'], self['font_style'], self['font_weight'],
+			) + [
+				'-fill', self['font_fill'],
+				'-stroke', self['font_stroke'],
+				'-pointsize', str(self['font_size']),
+				'-gravity', self['offset_gravity'],
+				# [lb] thinks -draw 'text x,y "string"' is an archaic command; also
+				#  '-draw', 'text %s "%s"' % (draw_text_posit, label_text,),
+				# works the same as:
+				'-annotate', annotate_posit,
+			]
+		return self.annotate_opts
+
+class RenderPlan(object):
+	# Everything about how to render a slide that doesn't depend on which
+	# slide it is: the labels, the canvas, the encoder, and the engine. Make
+	# it once and then render as many decks (or single slides) as you like.
+	#
+	# To make smaller copies of each slide in the same run, pass renditions,
+	# a list of dicts, each with a name (its subdirectory of the target), a
+	# resize geom, and a label_scale (or None, to scale the labels with the
+	# slide). Each slide is decoded and composited once, and each rendition
+	# is resized from the one before it, so list them from largest down. The
+	# full-size slides then go in the extent_name subdirectory, and their
+	# labels are scaled by extent_label_scale.
+	#
+	# The labels with an autofit box are sized using text_metrics (see
+	# metrics_util), by default, the engine's, cached on disk. Call
+	# metrics_save() when you're done, to keep what it measured.
+
+	def __init__(
+		self,
+		text_labels,
+		background_color='None',
+		extent_geom='100%',
+		extent_gravity='center',
+		encoder=None,
+		engine='convert',
+		extent_name=None,
+		extent_label_scale=None,
+		renditions=None,
+		text_metrics=None,
+	):
+		self.text_labels = [
+			label_def if isinstance(label_def, LabelSpec) else LabelSpec(**label_def)
+			for label_def in text_labels
+		]
+		self.background_color = background_color
+		self.extent_geom = extent_geom
+		self.extent_gravity = extent_gravity
+		self.extent_name = extent_name or rendition_name(extent_geom)
+		self.extent_label_scale = extent_label_scale or 1.0
+		self.renditions = []
+		for rendition in (renditions or []):
+			rendition = dict(rendition)
+			rendition.setdefault('name', None)
+			rendition.setdefault('label_scale', None)
+			if not rendition['name']:
+				rendition['name'] = rendition_name(rendition['geom'])
+			self.renditions.append(rendition)
+		for geom in [self.extent_geom] + [rend['geom'] for rend in self.renditions]:
+			try:
+				geometry_util.parse_geometry(geom, 1, 1)
+			except geometry_util.GeometryError as err:
+				raise MDM2_Error(str(err))
+		rendition_names = [self.extent_name] + [rend['name'] for rend in self.renditions]
+		if len(set(rendition_names)) < len(rendition_names):
+			raise MDM2_Error('each rendition needs its own name: %s' % (', '.join(rendition_names),))
+		self.encoder = dict(ENCODER_DEFAULTS)
+		self.encoder.update(encoder or {})
+		self.engine = engine
+		if (self.engine == 'pillow') and (pil_render_load() is None):
+			raise MDM2_Error('the pillow engine needs Pillow: try `pip3 install Pillow`')
+		self.text_metrics = text_metrics
+		if (self.text_metrics is None) and any(label_def['autofit'] for label_def in self.text_labels):
+			self.text_metrics = self.engine_metrics()
+		# If the canvas stays the same size, and any new space would be
+		# transparent anyway, and the encoder's left be, then a slide with no
+		# label text would come out looking just like its source.
+		self.passthrough_canvas = (
+			(self.extent_geom.replace('%', '') in ('100', '100x100',))
+			and ('%' in self.extent_geom)
+			and (self.background_color.lower() in ('none', 'transparent',))
+			and (self.extent_label_scale == 1.0)
+			and not self.renditions
+			and not self.encoder['strip']
+			and all(
+				self.encoder[enc_key] is None
+				for enc_key in ('quality', 'png_compression', 'png_filter', 'webp_method',)
+			)
+		)
+		# The pillow engine's idea of the convert options that apply to the
+		# whole image. (Also see geometry_util.)
+		self.canvas_def = {
+			'background_color': self.background_color,
+			'extent_geom': self.extent_geom,
+			'extent_gravity': self.extent_gravity,
+		}
+
+	def engine_metrics(self):
+		# Each engine measures text its own way (and each version of it
+		# might, too), so they each get their own metrics.
+		if self.engine == 'pillow':
+			return metrics_util.TextMetrics(
+				lambda font_path, font_style, font_weight, font_size, text:
+					pil_render.text_size(font_path, font_size, text),
+				'pillow %s' % (pil_render.Image.__version__,),
+			)
+		imagemagick = probe_util.imagemagick_probe()
+		return metrics_util.TextMetrics(
+			metrics_util.convert_text_size,
+			imagemagick['version'] if imagemagick else 'convert',
+		)
+
+	def metrics_save(self):
+		if self.text_metrics is not None:
+			self.text_metrics.save()
+
+	def fit_size(self, label_def, label_text):
+		# The largest font_size at which the label text fits its autofit box.
+		box_w, box_h = label_def['autofit']
+		try:
+			return self.text_metrics.fit_size(
+				label_def['font_path'], label_def['font_style'], label_def['font_weight'],
+				label_text, box_w, box_h,
+			)
+		except metrics_util.MetricsError as err:
+			raise MDM2_Error('could not fit label "%s": %s' % (label_def['label'], err,))
+
+	def memory_estimate(self, source_path):
+		# Roughly how many bytes it takes to render the slide, going by the
+		# source image's header (or its bytes), or None if we can't tell. That's the decoded
+		# source, plus the RGBA canvas it's extended onto, plus the resized
+		# copy of that. Convert (the usual Q16 build) uses 2 bytes per sample,
+		# and Pillow uses 1.
+		dimensions = header_util.image_dimensions(source_path)
+		if dimensions is None:
+			return None
+		width, height, channels = dimensions
+		canvas_w, canvas_h = geometry_util.extent_size(self.extent_geom, width, height)
+		sample_bytes = 1 if (self.engine == 'pillow') else 2
+		return ((width * height * channels) + (2 * canvas_w * canvas_h * 4)) * sample_bytes
+
+	def is_passthrough(self, labels, source_name, target_name):
+		# True if rendering the slide wouldn't change how it looks, nor its
+		# format, so we can just copy the source instead.
+		return (
+			self.passthrough_canvas
+			and not any(label_text for label_def, label_text in labels)
+			and (
+				os.path.splitext(source_name)[1].lower()
+				== os.path.splitext(target_name)[1].lower()
+			)
+		)
+
+	def label_scales(self, source_path):
+		# The label scale for the full-size slide and for each rendition: as
+		# specified, or else scaled by how much smaller the rendition is than
+		# the full-size slide, going by the source image's header (or bytes).
+		scales = [self.extent_label_scale]
+		dimensions = None
+		if any(rend['label_scale'] is None for rend in self.renditions):
+			dimensions = header_util.image_dimensions(source_path)
+		if dimensions is not None:
+			width, height = geometry_util.extent_size(self.extent_geom, dimensions[0], dimensions[1])
+			width, height = geometry_util.resize_size(self.extent_geom, width, height)
+			full_w = width
+		for rend in self.renditions:
+			if dimensions is not None:
+				rend_w, rend_h = geometry_util.resize_size(rend['geom'], width, height)
+				if rend_w < width:
+					width, height = rend_w, rend_h
+			if rend['label_scale'] is not None:
+				scales.append(rend['label_scale'])
+			elif dimensions is not None:
+				scales.append(self.extent_label_scale * width / full_w)
+			else:
+				# We can't tell how big the slide is, so leave the labels be.
+				scales.append(self.extent_label_scale)
+		return scales
+
+	def target_names(self, src_file):
+		# Where the slide goes, and then where each of its renditions go.
+		target_name = self.target_name(src_file)
+		if not self.renditions:
+			return [target_name]
+		return [
+			os.path.join(rend_name, target_name)
+			for rend_name in [self.extent_name] + [rend['name'] for rend in self.renditions]
+		]
+
+	def target_name(self, src_file):
+		# With --recursive, the source file is a relative path, and the
+		# target is the same relative path under the target directory.
+		if not self.encoder['format']:
+			return src_file
+		# Otherwise the extension tells convert (and Pillow) what to write.
+		target_ext = 'jpg' if (self.encoder['format'] == 'jpeg') else self.encoder['format']
+		return '%s.%s' % (os.path.splitext(src_file)[0], target_ext,)
+
+	def label_texts(
+		self, src_file, slide_index_text, slide_count,
+		source_path=None, variables=None, archive=None, source_data=None,
+	):
+		# MAGIC_VALUES: ${filename}, ${slide_number}, ${slide_count}, and the
+		#               rest of LABEL_VARIABLES, which need the source_path.
+		#        NOTE: str.format() consumes starting $ or doesn't care.
+		# The caller can also fill in variables, e.g., the {caption}, which
+		# then aren't looked up.
+		slide_variables = dict(
+			filename=src_file,
+			slide_number=slide_index_text,
+			slide_count=slide_count,
+		)
+		slide_variables.update(variables or {})
+		variables = SlideVariables(
+			source_path or src_file, archive=archive, source_data=source_data, **slide_variables
+		)
+		labels = []
+		for label_def in self.text_labels:
+			try:
+				label_text = label_def.template.render(variables)
+			except (KeyError, AttributeError, IndexError, ValueError, OSError) as err:
+				raise MDM2_Error(
+					'could not fill in label "%s" for file "%s": %s'
+					% (label_def['label'], src_file, err,)
+				)
+			if label_def['autofit'] and label_text:
+				label_def = label_def.sized(self.fit_size(label_def, label_text))
+			labels.append((label_def, label_text,))
+		return labels
+
+	def label_options(self, labels):
+		# Create the text layer(s).
+		label_opts = []
+		for label_def, label_text in labels:
+			label_opts += label_def.annotate_options()
+			label_opts.append(label_text)
+		return label_opts
+
+	def convert_command(self, labels, source_path, target_path, renditions=None):
+		# The renditions are the (labels, target_path) for each of the plan's
+		# renditions, if it has any.
+		if renditions:
+			return [
+				'convert',
+				'-respect-parentheses',
+				'-size', self.extent_geom,
+				source_path,
+				'-background', self.background_color,
+				'-gravity', self.extent_gravity,
+				'-extent', self.extent_geom,
+				'-resize', self.extent_geom,
+				] + self.rendition_options(labels, target_path, renditions) + [
+				# The last rendition (unlabeled) is still on the stack.
+				'null:',
+			]
+
+		label_opts = self.label_options(labels)
+
+		cmd_merge = [
+			# Oh ho ho it's imagemagick ya know.
+			'convert',
+
+			# Resize (but don't stretch) the image (if extent_geom is set).
+			'-background', self.background_color,
+			'-size', self.extent_geom,
+			'-gravity', self.extent_gravity,
+			# NOTE: Order matters. If -resize comes before -extent, the
+			#       image is stretched.
+			'-extent', self.extent_geom,
+			'-resize', self.extent_geom,
+
+			# One or more sets of label options.
+			] + label_opts + [
+
+			# The source image we're manipulating.
+			source_path,
+
+			# How to encode the image we're writing.
+			] + self.encoder_options(target_path) + [
+
+			# Our target image we're creating.
+			target_path,
+		]
+
+		return cmd_merge
+
+	def rendition_options(self, labels, target_path, renditions):
+		# Label and write a copy of the full-size slide, and then shrink it
+		# for the next rendition, label and write a copy of that, and so on.
+		rendition_opts = []
+		outputs = [(labels, target_path,)] + list(renditions)
+		for rend_i, (rend_labels, rend_path) in enumerate(outputs):
+			if rend_i > 0:
+				rendition_opts += [
+					'-resize', shrink_geometry(self.renditions[rend_i - 1]['geom']),
+				]
+			rendition_opts += [
+				'(',
+				'+clone',
+				] + self.label_options(rend_labels) + [
+				] + self.encoder_options(rend_path) + [
+				'-write', rend_path,
+				'+delete',
+				')',
+			]
+		return rendition_opts
+
+	def encoder_options(self, target_path):
+		# Convert picks the output format from the target's file extension,
+		# or from its prefix when writing to stdout, e.g., 'png:-'.
+		if target_path.endswith(':-'):
+			target_ext = '.' + target_path[:-len(':-')].lower()
+		else:
+			target_ext = os.path.splitext(target_path)[1].lower()
+		encoder_opts = []
+		if self.encoder['strip']:
+			encoder_opts += ['-strip']
+		if target_ext == '.png':
+			# NOTE: For PNG, convert reads -quality as the compression level
+			#       and filter, so we use the more obvious defines instead.
+			if self.encoder['png_compression'] is not None:
+				encoder_opts += [
+					'-define', 'png:compression-level=%d' % (self.encoder['png_compression'],),
+				]
+			if self.encoder['png_filter'] is not None:
+				encoder_opts += [
+					'-define', 'png:compression-filter=%d' % (self.encoder['png_filter'],),
+				]
+		elif self.encoder['quality'] is not None:
+			encoder_opts += ['-quality', str(self.encoder['quality'])]
+		if (target_ext == '.webp') and (self.encoder['webp_method'] is not None):
+			encoder_opts += ['-define', 'webp:method=%d' % (self.encoder['webp_method'],)]
+		return encoder_opts
+
+	def convert_batch_command(self, slides):
+		# Each slide gets its own parenthesized image sequence, which reads the
+		# source, applies the same options as convert_command, writes the target,
+		# and then discards the image, so only one slide is in memory at a time.
+		# NOTE: Within the parentheses, the image is read before the operators,
+		#       unlike convert_command, which uses the legacy option order.
+		cmd_batch = [
+			'convert',
+			# Keep the settings, like -gravity, from leaking between slides.
+			'-respect-parentheses',
+		]
+		for slide_i, slide in enumerate(slides):
+			cmd_batch += [
+				'(',
+				'-size', self.extent_geom,
+				slide['source_path'],
+				'-background', self.background_color,
+				'-gravity', self.extent_gravity,
+				'-extent', self.extent_geom,
+				'-resize', self.extent_geom,
+			]
+			if slide['renditions']:
+				cmd_batch += self.rendition_options(
+					slide['labels'], slide['write_path'], slide['renditions'],
+				)
+			else:
+				cmd_batch += [
+					] + self.label_options(slide['labels']) + [
+					] + self.encoder_options(slide['write_path']) + [
+					'-write', slide['write_path'],
+				]
+			# Convert complains if there are no images left at the end,
+			# so keep the last one around for the 'null:' output.
+			if slide_i < (len(slides) - 1):
+				cmd_batch.append('+delete')
+			cmd_batch.append(')')
+		cmd_batch.append('null:')
+		return cmd_batch
+
+	def base_label_count(self):
+		# How many of the labels, from the first, are the same on every slide,
+		# and so can be drawn once on the base layer that the slides with the
+		# same source share. Only the leading ones, since the labels are drawn
+		# in order, and where they overlap, the last one drawn is on top.
+		base_count = 0
+		for label_def in self.text_labels:
+			if not label_def.template.static:
+				break
+			base_count += 1
+		return base_count
+
+	def base_command(self, labels, source_path, base_path, target_path):
+		# Like convert_command, but on the way, also save the base layer -- the
+		# source on its canvas, with the labels that are the same on every
+		# slide -- to base_path, for the slides with the same source to start
+		# from (see from_base_command). An MPC base_path is ImageMagick's raw
+		# pixel cache, which convert reads without decoding anything.
+		# NOTE: As in convert_batch_command, the image is read before the
+		#       operators, so that the -write comes after the right ones.
+		base_count = self.base_label_count()
+		return [
+			'convert',
+			'-size', self.extent_geom,
+			source_path,
+			'-background', self.background_color,
+			'-gravity', self.extent_gravity,
+			'-extent', self.extent_geom,
+			'-resize', self.extent_geom,
+			] + self.label_options(labels[:base_count]) + [
+			'-write', base_path,
+			] + self.label_options(labels[base_count:]) + [
+			] + self.encoder_options(target_path) + [
+			target_path,
+		]
+
+	def from_base_command(self, labels, base_path, target_path):
+		# Draw the rest of the labels on the base layer, and encode the slide.
+		return [
+			'convert',
+			base_path,
+			] + self.label_options(labels[self.base_label_count():]) + [
+			] + self.encoder_options(target_path) + [
+			target_path,
+		]
+
+class RenderJob(object):
+	# One run of a RenderPlan over a list of source files, which are paths
+	# relative to the source_dir (or absolute, if there's no source_dir).
+	# Or, to read the slides out of an archive (see archive_util), pass the
+	# source_archive, and the inputs are the names of its members, whose
+	# bytes are piped to convert, so they're never written out.
+	#
+	# For an incremental update, pass the render keys from the last run as
+	# manifest_prev, and afterwards, save the job's manifest for next time.
+	#
+	# Normally the first input is slide 1 of len(inputs), but a caller that
+	# renders part of a deck can say where the inputs fall with first_index
+	# (0-based) and slide_count.
+	#
+	# To put the slides in one archive, PDF or video instead of a directory
+	# of files, pass a sink_util sink (see make_sink), which gets each slide
+	# in slide order, and the job closes it when it's done. The target_dir
+	# isn't used then, and neither is incremental mode.
+	#
+	# To keep from running out of memory on huge images, pass a memory_limit
+	# (in bytes), and the job only renders as many slides at once as fit, by
+	# their memory_estimate. Convert is also told to use no more than that,
+	# and to page to disk rather than fail, up to disk_limit, if there is one.
+	#
+	# A slide that would come out the same as its source (see is_passthrough)
+	# is copied rather than rendered, which, with hardlink, means hard linked,
+	# if the target directory's on the same filesystem.
+	#
+	# Each slide is written next to its target (see partial_path) and then
+	# renamed into place, so a crash never leaves a target half written. To
+	# be able to pick up after one, pass a journal path, and each finished
+	# slide's outputs (and render keys) are appended to it. To pick up, pass
+	# the outputs that were done (see journal_load) as resumed, and they're
+	# skipped (if their render keys still match, for an incremental update).
+	#
+	# Decks often repeat an image, e.g., a section divider, or the "build"
+	# slides that only differ by their label. With dedup, the job finds the
+	# inputs with the same bytes, and renders their base layer -- the image
+	# on its canvas, and the labels that are the same on every slide -- once,
+	# and each copy only has to draw the rest of its labels and be encoded.
+	# (Not for renditions, which are resized from the base, label and all.)
+	#
+	# A convert that hangs, e.g., on a malformed image, is killed (along with
+	# any helpers it started) after slide_timeout seconds, and tried again,
+	# up to retries more times, waiting longer before each try. The job can
+	# also have a run_budget (in seconds), after which it stops, killing the
+	# converts that are still running. (The pillow engine renders in-process,
+	# so only the run_budget applies, between slides.) A slide that fails
+	# stops the job, unless keep_going, in which case the slide's left out,
+	# and listed in the job's failures.
+
+	def __init__(
+		self,
+		plan,
+		inputs,
+		target_dir,
+		source_dir='',
+		jobs=1,
+		batch_size=1,
+		manifest_prev=None,
+		source_digests=None,
+		progress=None,
+		first_index=0,
+		slide_count=None,
+		sink=None,
+		memory_limit=None,
+		disk_limit=None,
+		hardlink=False,
+		journal=None,
+		resumed=None,
+		variables=None,
+		source_archive=None,
+		dedup=False,
+		slide_timeout=None,
+		retries=0,
+		run_budget=None,
+		keep_going=False,
+	):
+		self.plan = plan
+		self.inputs = list(inputs)
+		self.target_dir = target_dir
+		self.source_dir = source_dir
+		self.jobs = jobs
+		self.batch_size = batch_size
+		self.incremental = (manifest_prev is not None)
+		# The render keys from the last run and this one.
+		self.manifest_prev = dict(manifest_prev or {})
+		self.manifest = {}
+		self.manifest_lock = threading.Lock()
+		# Source digests, by path, good for as long as the mtime and size stay
+		# the same, which the caller can share between jobs, e.g., for --watch.
+		if source_digests is None:
+			source_digests = {}
+		self.source_digests = source_digests
+		self.progress_cb = progress
+		self.first_index = first_index
+		self.sink = None
+		if sink is not None:
+			if plan.renditions:
+				raise MDM2_Error('the renditions need a target directory, not a sink')
+			self.sink = sink_util.OrderedSink(sink, first_index)
+		self.memory_limit = memory_limit
+		self.disk_limit = disk_limit
+		self.memory_budget = MemoryBudget(memory_limit) if memory_limit else None
+		self.hardlink = hardlink
+		self.journal_path = journal
+		self.journal_f = None
+		self.journal_lock = threading.Lock()
+		self.resumed = dict(resumed or {})
+		# Label variables that the caller fills in, for every slide.
+		self.variables = variables
+		self.source_archive = source_archive
+		self.dedup = dedup and not plan.renditions
+		# The digest of each input that has the same bytes as another, and the
+		# base layer for each such digest, once a slide has rendered it.
+		self.dedup_keys = {}
+		self.dedup_bases = {}
+		self.dedup_lock = threading.Lock()
+		self.dedup_dir = None
+		self.dedup_scan_time = None
+		self.slide_timeout = slide_timeout
+		self.retries = retries
+		self.run_budget = run_budget
+		self.run_deadline = None
+		self.keep_going = keep_going
+		# The slides that failed, with keep_going.
+		self.failures = []
+		# The converts that are running, to kill if we're interrupted.
+		self.convert_procs = set()
+		self.convert_lock = threading.Lock()
+		self.converts_stopped = False
+		# Determine how many digits the final number will be.
+		num_digits = 0
+		self.slide_count = slide_count or len(self.inputs)
+		largest_num = self.slide_count
+		while largest_num > 0:
+			largest_num = int(largest_num / 10)
+			num_digits += 1
+		# Make the format symbol, e.g., '%04d' % 12 ==> 0012.
+		self.slide_num_fmt = '%%0%dd' % (num_digits,)
+		# Timings and sizes for each slide, for the summary and --report.
+		self.slide_stats = []
+		self.stats_lock = threading.Lock()
+		self.time_render_0 = None
+		self.time_render_1 = None
+
+	def run(self):
+		if self.run_budget is not None:
+			self.run_deadline = time.monotonic() + self.run_budget
+		if self.dedup:
+			self.dedup_scan()
+		try:
+			self.render_output()
+		finally:
+			self.dedup_cleanup()
+		return self
+
+	def render_output(self):
+		if self.sink is None:
+			if self.target_dir:
+				os.makedirs(self.target_dir, exist_ok=True)
+			if self.journal_path:
+				# Line buffered, so each slide's line is written as it's done.
+				self.journal_f = open(self.journal_path, 'a', buffering=1)
+			try:
+				self.render_slides()
+			finally:
+				if self.journal_f is not None:
+					self.journal_f.close()
+			return
+		try:
+			self.render_slides()
+			self.sink.close()
+		except (sink_util.SinkError, OSError) as err:
+			self.sink.abort()
+			raise MDM2_Error('could not write the output: %s' % (err,))
+		except BaseException:
+			# Don't leave half an archive behind.
+			self.sink.abort()
+			raise
+
+	def progress(self, msg):
+		if self.progress_cb is not None:
+			self.progress_cb(msg)
+
+	def render_slides(self):
+		# Each slide's number comes from its place in the sorted list and not
+		# from the order in which the workers finish, so the output is the
+		# same no matter how many jobs we run.
+		# NOTE: We only keep a few more batches queued than there are workers,
+		#       so that on failure there's little pending work to throw away.
+		max_pending = self.jobs * 2
+		# With a sink, the slides that finish ahead of a slow one are held in
+		# memory until it's written, so don't start a slide that's more than
+		# sink_window slides past the next one the sink's waiting on.
+		sink_window = max_pending * self.batch_size
+		slides = list(enumerate(self.inputs, self.first_index))
+		batches = iter([
+			slides[batch_i:batch_i + self.batch_size]
+			for batch_i in range(0, len(slides), self.batch_size)
+		])
+		next_batch = None
+		self.time_render_0 = time.perf_counter()
+		import concurrent.futures
+		with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+			pending = set()
+			failure = None
+			try:
+				while True:
+					while (
+						(failure is None)
+						and (len(pending) < max_pending)
+						and not self.budget_spent()
+					):
+						if next_batch is None:
+							try:
+								next_batch = next(batches)
+							except StopIteration:
+								break
+						if (
+							(self.sink is not None)
+							and pending
+							and (next_batch[0][0] - self.sink.next_index >= sink_window)
+						):
+							break
+						pending.add(executor.submit(
+							self.convert_batch, next_batch, time.perf_counter(),
+						))
+						next_batch = None
+					if not pending:
+						break
+					done, pending = concurrent.futures.wait(
+						pending, return_when=concurrent.futures.FIRST_COMPLETED,
+					)
+					for future in done:
+						try:
+							future.result()
+						except MDM2_Error as err:
+							# Remember the first failure and stop feeding the pool. The
+							# slides already being rendered are left to finish up.
+							if failure is None:
+								failure = err
+			except BaseException:
+				# E.g., ^C, which the converts in their own process group miss.
+				self.converts_kill()
+				raise
+			self.time_render_1 = time.perf_counter()
+			# The slides we never got to, because the run budget ran out.
+			unstarted = []
+			if failure is None:
+				unstarted = [slide for batch in [next_batch or []] + list(batches) for slide in batch]
+			if unstarted and self.keep_going:
+				for curr_index, src_file in unstarted:
+					self.slide_failed(
+						curr_index, src_file, MDM2_Error('the run budget ran out before it started'),
+					)
+			elif unstarted:
+				failure = MDM2_Error(
+					'the run budget ran out with %d slide(s) to go' % (len(unstarted),)
+				)
+			if failure is not None:
+				raise failure
+
+	def convert_batch(self, batch, queued_at):
+		# How long the batch sat in the executor's queue before a worker
+		# got to it, which tells us if the pool is the bottleneck.
+		queue_wait = time.perf_counter() - queued_at
+
+		try:
+			self.render_batch_slides(batch, queue_wait)
+		finally:
+			for curr_index, src_file in batch:
+				self.dedup_release(src_file)
+
+	def render_batch_slides(self, batch, queue_wait):
+		slides = []
+		for curr_index, src_file in batch:
+			try:
+				slide = self.slide_prepare(src_file, curr_index)
+			except MDM2_Error as err:
+				if not self.keep_going:
+					raise
+				self.slide_failed(curr_index, src_file, err)
+				continue
+			if isinstance(slide, dict):
+				slide['timings'] = {'queue_wait': queue_wait}
+				slides.append(slide)
+			else:
+				# It was skipped, so that's its status.
+				self.stats_record(curr_index, src_file, slide, {'queue_wait': queue_wait})
+
+		# The slides that would come out the same as their sources are copied.
+		for slide in slides:
+			if slide['passthrough']:
+				try:
+					self.copy_slide(slide)
+				except MDM2_Error as err:
+					if not self.keep_going:
+						raise
+					self.slide_failed(slide['curr_index'], slide['src_file'], err, slide)
+		slides = [slide for slide in slides if not slide['passthrough']]
+		if not slides:
+			return
+
+		try:
+			self.render_batch(slides)
+		except BaseException:
+			# Don't leave half-written slides behind.
+			for slide in slides:
+				for write_path in slide['write_paths']:
+					if write_path is None:
+						continue
+					try:
+						os.unlink(write_path)
+					except FileNotFoundError:
+						pass
+			raise
+
+	def render_batch(self, slides):
+		# The slides whose source is a duplicate are rendered one at a time,
+		# from their base layer (see dedup_scan).
+		self.render_each([slide for slide in slides if slide['dedup_key'] is not None])
+		slides = [slide for slide in slides if slide['dedup_key'] is None]
+		if not slides:
+			return
+		# NOTE: A batch writes its slides to files, so there's no batching
+		#       into a sink, which reads each slide from convert's stdout.
+		#       Nor from an archive, since convert's stdin only fits one slide.
+		if (
+			(self.plan.engine == 'convert')
+			and (len(slides) > 1)
+			and (self.sink is None)
+			and (self.source_archive is None)
+		):
+			# The batch renders one slide at a time, so it needs as much
+			# memory as its biggest slide.
+			reserved = self.memory_acquire(slides)
+			try:
+				time_0 = time.perf_counter()
+				batched = self.render_convert_batch(slides, reserved)
+				# We can't tell how long each slide took, so split it evenly.
+				render_time = (time.perf_counter() - time_0) / len(slides)
+			finally:
+				self.memory_release(reserved)
+			if batched:
+				for slide in slides:
+					slide['timings']['render'] = render_time
+					try:
+						self.slide_finish(slide)
+					except MDM2_Error as err:
+						if not self.keep_going:
+							raise
+						self.slide_failed(slide['curr_index'], slide['src_file'], err, slide)
+				return
+			# We don't know which slide broke the batch, so render them one
+			# by one, so that the error (if it happens again) names the culprit.
+		self.render_each(slides)
+
+	def render_each(self, slides):
+		for slide in slides:
+			reserved = self.memory_acquire([slide])
+			try:
+				self.convert_image(slide, reserved)
+			except MDM2_Error as err:
+				if not self.keep_going:
+					raise
+				self.slide_failed(slide['curr_index'], slide['src_file'], err, slide)
+			finally:
+				self.memory_release(reserved)
+
+	def slide_failed(self, curr_index, src_file, err, slide=None):
+		# With keep_going, leave the slide out, and list it in the failures.
+		if slide is not None:
+			for write_path in slide['write_paths']:
+				if write_path is None:
+					continue
+				try:
+					os.unlink(write_path)
+				except FileNotFoundError:
+					pass
+		if self.sink is not None:
+			# So the slides after it don't wait for it.
+			self.sink.skip(curr_index)
+		with self.stats_lock:
+			self.failures.append({
+				'slide_number': curr_index + 1,
+				'file': src_file,
+				'error': str(err),
+			})
+		self.stats_record(curr_index, src_file, 'failed', slide['timings'] if slide else {})
+		self.progress(
+			'Failed slide for index %s: file: "%s"... %s' % (
+				self.slide_num_fmt % (curr_index + 1,), src_file, err,
+			)
+		)
+
+	def copy_slide(self, slide):
+		time_0 = time.perf_counter()
+		if slide['source_data'] is not None:
+			# From an archive, so there's no file to clone, but we have the bytes.
+			if self.sink is None:
+				try:
+					with open(slide['write_path'], 'wb') as target_f:
+						target_f.write(slide['source_data'])
+				except OSError as err:
+					raise MDM2_Error('could not write "%s": %s' % (slide['target_path'], err,))
+				slide['copy_method'] = 'write'
+			else:
+				slide['data'] = slide['source_data']
+				slide['copy_method'] = 'read'
+		elif self.sink is None:
+			try:
+				slide['copy_method'] = copy_util.clone_file(
+					slide['source_path'], slide['write_path'], hardlink=self.hardlink,
+				)
+			except OSError as err:
+				raise MDM2_Error(
+					'could not copy "%s" to "%s": %s'
+					% (slide['source_path'], slide['target_path'], err,)
+				)
+		else:
+			try:
+				with open(slide['source_path'], 'rb') as source_f:
+					slide['data'] = source_f.read()
+			except OSError as err:
+				raise MDM2_Error('could not read "%s": %s' % (slide['source_path'], err,))
+			slide['copy_method'] = 'read'
+		slide['timings']['write'] = time.perf_counter() - time_0
+		self.slide_finish(slide)
+
+	def memory_acquire(self, slides):
+		# Wait for enough of the memory budget to render the slides, and
+		# return how much we reserved (0 if there's no budget).
+		if self.memory_budget is None:
+			return 0
+		estimates = [slide['memory_estimate'] for slide in slides]
+		# If we can't tell, assume the slide needs its fair share.
+		fair_share = self.memory_limit // self.jobs
+		amount = max(
+			fair_share if (estimate is None) else estimate for estimate in estimates
+		)
+		time_0 = time.perf_counter()
+		reserved = self.memory_budget.acquire(amount)
+		memory_wait = time.perf_counter() - time_0
+		for slide in slides:
+			slide['timings']['memory_wait'] = memory_wait
+		return reserved
+
+	def memory_release(self, reserved):
+		if self.memory_budget is not None:
+			self.memory_budget.release(reserved)
+
+	def convert_limits(self, reserved):
+		# ImageMagick's resource limits, so convert pages its pixel cache to
+		# disk instead of using more than we reserved for it.
+		limit_opts = []
+		if reserved:
+			reserved_mib = '%dMiB' % (-(-reserved // (1024 ** 2)),)
+			limit_opts += ['-limit', 'memory', reserved_mib, '-limit', 'map', reserved_mib]
+		if self.disk_limit:
+			limit_opts += ['-limit', 'disk', '%dMiB' % (-(-self.disk_limit // (1024 ** 2)),)]
+		return limit_opts
+
+	def convert_image(self, slide, reserved=0):
+		if (self.plan.engine == 'pillow') and (slide['dedup_key'] is not None):
+			target_file = io.BytesIO() if (self.sink is not None) else None
+			slide['timings'].update(self.render_pillow_dedup(slide, target_file=target_file))
+			if target_file is not None:
+				slide['data'] = target_file.getvalue()
+		elif self.plan.engine == 'pillow':
+			target_file = io.BytesIO() if (self.sink is not None) else None
+			source = slide['source_path']
+			if slide['source_data'] is not None:
+				source = io.BytesIO(slide['source_data'])
+			timings = self.render_pillow(
+				slide['src_file'],
+				source,
+				slide['write_path'] or slide['target_name'],
+				slide['labels'],
+				target_file=target_file,
+				renditions=[
+					(shrink_geometry(rend['geom']), rend_labels, rend_path)
+					for rend, (rend_labels, rend_path) in zip(self.plan.renditions, slide['renditions'])
+				],
+			)
+			slide['timings'].update(timings)
+			if target_file is not None:
+				slide['data'] = target_file.getvalue()
+		else:
+			# Convert decodes, renders and writes, all in one go.
+			time_0 = time.perf_counter()
+			if slide['dedup_key'] is not None:
+				slide['data'] = self.render_convert_dedup(slide, reserved)
+			else:
+				slide['data'] = self.render_convert(
+					slide['src_file'], slide['cmd_merge'], reserved, source_data=slide['source_data'],
+				)
+			slide['timings']['render'] = time.perf_counter() - time_0
+		self.slide_finish(slide)
+
+	def slide_prepare(self, src_file, curr_index):
+		# Figure out everything about the slide we need to render it, or
+		# return why it's skipped: 'unchanged' since the last incremental
+		# run, or 'resumed' since --resume found it done already.
+		slide_index_text = self.slide_num_fmt % (curr_index + 1,)
+
+		if self.source_archive is not None:
+			# Convert reads the slide from stdin.
+			source_path = src_file
+			try:
+				source_data = self.source_archive.read(src_file)
+			except (KeyError, OSError, archive_util.ArchiveError) as err:
+				raise MDM2_Error('could not read "%s" from the archive: %s' % (src_file, err,))
+			source_image = source_data
+			convert_source = stdin_source(src_file)
+		else:
+			source_path = os.path.join(self.source_dir, src_file)
+			source_data = None
+			source_image = source_path
+			convert_source = source_path
+
+		# An absolute input is named after its file, and not its whole path.
+		slide_name = os.path.basename(src_file) if os.path.isabs(src_file) else src_file
+
+		# The slide's own target, and then one for each rendition, if any.
+		target_names = self.plan.target_names(slide_name)
+		target_name = target_names[0]
+		if self.sink is None:
+			target_paths = [
+				os.path.join(self.target_dir, out_name) for out_name in target_names
+			]
+			for out_name, out_path in zip(target_names, target_paths):
+				if os.path.dirname(out_name):
+					os.makedirs(os.path.dirname(out_path), exist_ok=True)
+			target_path = target_paths[0]
+			write_paths = [partial_path(out_path) for out_path in target_paths]
+			convert_target = write_paths[0]
+		else:
+			# Some sinks only take one format, e.g., PDF wants JPEGs.
+			if self.sink.frame_format:
+				target_name = '%s.%s' % (os.path.splitext(target_name)[0], self.sink.frame_format,)
+			target_names = [target_name]
+			target_path = None
+			target_paths = [None]
+			write_paths = [None]
+			# Have convert write the slide to stdout, e.g., 'png:-'.
+			convert_target = '%s:-' % (os.path.splitext(target_name)[1][1:] or 'png',)
+
+		labels = self.plan.label_texts(
+			slide_name, slide_index_text, self.slide_count,
+			source_path=source_path, variables=self.variables,
+			archive=self.source_archive, source_data=source_data,
+		)
+
+		# Each rendition gets the same label text, but drawn to its own scale.
+		label_scales = self.plan.label_scales(source_image)
+		labels = [(label_def.scaled(label_scales[0]), label_text) for label_def, label_text in labels]
+		renditions = [
+			(
+				[(label_def.scaled(rend_scale), label_text) for label_def, label_text in labels],
+				rend_path,
+			)
+			for rend_scale, rend_path in zip(
+				[scale / label_scales[0] for scale in label_scales[1:]], write_paths[1:],
+			)
+		]
+
+		cmd_merge = self.plan.convert_command(labels, convert_source, convert_target, renditions)
+
+		render_key = None
+		if self.incremental:
+			# Since the command includes the label text, a slide whose number
+			# changed because another slide was added or removed is also stale.
+			render_key = self.render_key(source_path, cmd_merge, source_data)
+		for done_outputs, skip_status, done_status in (
+			(self.manifest_prev if self.incremental else {}, 'unchanged', 'unchanged',),
+			(self.resumed, 'resumed', 'done already',),
+		):
+			if self.outputs_done(done_outputs, target_names, target_paths, render_key):
+				if self.incremental:
+					for out_name in target_names:
+						self.manifest_record(out_name, render_key)
+				self.progress(
+					'Skipping slide for index %s: file: "%s"... %s.' % (
+						slide_index_text, target_name, done_status,
+					)
+				)
+				return skip_status
+		if self.incremental:
+			# The old output is about to be replaced, so forget that it was good.
+			# NOTE: It's replaced by a rename, so if it's a hard link to its
+			#       source, the source is left be.
+			with self.manifest_lock:
+				for out_name in target_names:
+					self.manifest_prev.pop(out_name, None)
+
+		passthrough = self.plan.is_passthrough(labels, slide_name, target_name)
+		return {
+			'curr_index': curr_index,
+			'src_file': src_file,
+			'slide_index_text': slide_index_text,
+			'source_path': source_path,
+			'source_data': source_data,
+			'target_name': target_name,
+			'target_path': target_path,
+			'target_names': target_names,
+			'target_paths': target_paths,
+			'write_path': write_paths[0],
+			'write_paths': write_paths,
+			'labels': labels,
+			'renditions': renditions,
+			'cmd_merge': cmd_merge,
+			'convert_source': convert_source,
+			'convert_target': convert_target,
+			'render_key': render_key,
+			'passthrough': passthrough,
+			'copy_method': None,
+			'dedup_key': None if passthrough else self.dedup_keys.get(src_file),
+			'dedup': None,
+			'memory_estimate': (
+				self.plan.memory_estimate(source_image) if self.memory_budget else None
+			),
+		}
+
+	def outputs_done(self, done_outputs, target_names, target_paths, render_key):
+		# True if each of the slide's outputs is in done_outputs, with the
+		# same render key, and is still there.
+		return bool(done_outputs) and all(
+			(out_name in done_outputs)
+			and (done_outputs[out_name] == render_key)
+			and os.path.exists(out_path)
+			for out_name, out_path in zip(target_names, target_paths)
+		)
+
+	def slide_finish(self, slide):
+		if self.sink is None:
+			try:
+				for write_path, out_path in zip(slide['write_paths'], slide['target_paths']):
+					os.replace(write_path, out_path)
+			except OSError as err:
+				raise MDM2_Error(
+					'could not move "%s" into place: %s' % (slide['target_name'], err,)
+				)
+			self.journal_append(slide)
+
+		if self.incremental:
+			for out_name in slide['target_names']:
+				self.manifest_record(out_name, slide['render_key'])
+
+		if self.sink is None:
+			try:
+				bytes_out = sum(os.path.getsize(out_path) for out_path in slide['target_paths'])
+			except OSError:
+				bytes_out = None
+		else:
+			bytes_out = len(slide['data'])
+			try:
+				self.sink.add(slide['curr_index'], slide['target_name'], slide['data'])
+			except (sink_util.SinkError, OSError) as err:
+				raise MDM2_Error(
+					'could not write slide "%s" to the output: %s'
+					% (slide['target_name'], err,)
+				)
+
+		self.stats_record(
+			slide['curr_index'],
+			slide['src_file'],
+			'copied' if slide['passthrough'] else 'rendered',
+			slide['timings'],
+			bytes_out=bytes_out,
+			copy_method=slide['copy_method'],
+			dedup=slide['dedup'],
+		)
+
+		self.progress(
+			'%s slide for index %s: file: "%s"... ok.' % (
+				'Copied' if slide['passthrough'] else 'Created',
+				slide['slide_index_text'],
+				slide['target_name'],
+			)
+		)
+
+	def journal_append(self, slide):
+		if self.journal_f is None:
+			return
+		entry = json.dumps({
+			'slide': slide['curr_index'] + 1,
+			'source': slide['src_file'],
+			'outputs': {out_name: slide['render_key'] for out_name in slide['target_names']},
+		}, sort_keys=True)
+		with self.journal_lock:
+			self.journal_f.write(entry + '\n')
+
+	# Rendering engines.
+
+	def render_convert(self, src_file, cmd_merge, reserved=0, source_data=None):
+		# Returns what convert wrote to stdout, which is the slide, if the
+		# target is '-', or nothing, otherwise. The source_data, if any, is
+		# what convert reads from stdin.
+		# NOTE: The limits aren't part of cmd_merge, which is what the render
+		#       key hashes, since they don't change what convert makes.
+		cmd_merge = cmd_merge[:1] + self.convert_limits(reserved) + cmd_merge[1:]
+		for attempt in range(self.retries + 1):
+			if attempt:
+				# Back off, in case it's the machine that's struggling, and
+				# not the slide, but not past the end of the run budget.
+				backoff = RETRY_BACKOFF * (2 ** (attempt - 1))
+				if self.run_deadline is not None:
+					backoff = min(backoff, max(0, self.run_deadline - time.monotonic()))
+				time.sleep(backoff)
+			if self.budget_spent():
+				raise MDM2_Error('the run budget ran out before rendering file "%s"' % (src_file,))
+			result = self.run_convert(cmd_merge, source_data, self.convert_timeout())
+			if result is not None:
+				returncode, stdout, stderr = result
+				if returncode:
+					raise MDM2_Error(
+						'the "convert" command failed: "%s" (%s) on file "%s"'
+						% (stderr, returncode, src_file,)
+					)
+				return stdout
+			if self.budget_spent():
+				raise MDM2_Error('the run budget ran out while rendering file "%s"' % (src_file,))
+		raise MDM2_Error(
+			'the "convert" command took over %s secs. on file "%s" (tried %d time(s))'
+			% (self.slide_timeout, src_file, self.retries + 1,)
+		)
+
+	def run_convert(self, cmd, source_data=None, timeout=None):
+		# Returns convert's (returncode, stdout, stderr), or None if it ran out
+		# of time, in which case it's killed, along with any helpers it started
+		# (e.g., Ghostscript), which share its process group.
+		if self.converts_stopped:
+			raise MDM2_Error('stopped')
+		proc = subprocess.Popen(
+			cmd,
+			stdin=subprocess.PIPE if (source_data is not None) else None,
+			stdout=subprocess.PIPE,
+			stderr=subprocess.PIPE,
+			# NOTE: In a process group of its own, convert misses the ^C from
+			#       the terminal, so render_slides passes it on.
+			start_new_session=self.watchdog(),
+		)
+		with self.convert_lock:
+			self.convert_procs.add(proc)
+		try:
+			try:
+				stdout, stderr = proc.communicate(source_data, timeout=timeout)
+			except subprocess.TimeoutExpired:
+				self.convert_kill(proc)
+				proc.communicate()
+				return None
+		finally:
+			with self.convert_lock:
+				self.convert_procs.discard(proc)
+		return proc.returncode, stdout, stderr
+
+	def watchdog(self):
+		return (self.slide_timeout is not None) or (self.run_budget is not None)
+
+	def convert_timeout(self, slide_count=1):
+		# How long to let the next convert run: the slide timeout (for each
+		# slide it renders), but no longer than what's left of the run budget.
+		timeout = None
+		if self.slide_timeout is not None:
+			timeout = self.slide_timeout * slide_count
+		if self.run_deadline is not None:
+			remaining = self.run_deadline - time.monotonic()
+			if remaining <= 0:
+				raise MDM2_Error('the run budget ran out')
+			timeout = remaining if (timeout is None) else min(timeout, remaining)
+		return timeout
+
+	def budget_spent(self):
+		return (self.run_deadline is not None) and (time.monotonic() >= self.run_deadline)
+
+	def convert_kill(self, proc):
+		try:
+			if self.watchdog():
+				os.killpg(proc.pid, signal.SIGKILL)
+			else:
+				proc.kill()
+		except ProcessLookupError:
+			pass
+
+	def converts_kill(self):
+		# Kill the running converts, and don't start any more.
+		with self.convert_lock:
+			self.converts_stopped = True
+			procs = list(self.convert_procs)
+		for proc in procs:
+			self.convert_kill(proc)
+
+	def render_convert_dedup(self, slide, reserved=0):
+		# The first slide with this source to get here renders as usual, but
+		# also saves the base layer (see RenderPlan.base_command), and the rest
+		# start from that. They wait their turn, but it's not long, and they'd
+		# have had to decode the same image anyway.
+		base_entry = self.dedup_bases[slide['dedup_key']]
+		with base_entry['lock']:
+			if base_entry['base'] is None:
+				base_path = os.path.join(self.dedup_dir, '%s.mpc' % (slide['dedup_key'],))
+				cmd_base = self.plan.base_command(
+					slide['labels'], slide['convert_source'], base_path, slide['convert_target'],
+				)
+				data = self.render_convert(
+					slide['src_file'], cmd_base, reserved, source_data=slide['source_data'],
+				)
+				base_entry['base'] = base_path
+				slide['dedup'] = 'base'
+				return data
+		slide['dedup'] = 'hit'
+		cmd_slide = self.plan.from_base_command(
+			slide['labels'], base_entry['base'], slide['convert_target'],
+		)
+		return self.render_convert(slide['src_file'], cmd_slide, reserved)
+
+	def render_convert_batch(self, slides, reserved=0):
+		# Returns False if the batch failed, or ran out of time, for the caller
+		# to render its slides one by one.
+		cmd_batch = self.plan.convert_batch_command(slides)
+		cmd_batch = cmd_batch[:1] + self.convert_limits(reserved) + cmd_batch[1:]
+		result = self.run_convert(cmd_batch, timeout=self.convert_timeout(len(slides)))
+		return (result is not None) and (result[0] == 0)
+
+	def render_pillow(
+		self, src_file, source_path, target_path, labels, target_file=None, renditions=(),
+		base_image=None,
+	):
+		# The pillow engine implements the same options as the convert command.
+		try:
+			return pil_render.render_slide(
+				source_path, target_path, self.plan.canvas_def, labels, self.plan.encoder,
+				target_file=target_file, renditions=renditions, base_image=base_image,
+			)
+		except (OSError, ValueError) as err:
+			raise MDM2_Error(
+				'the pillow engine failed: "%s" on file "%s"'
+				% (err, src_file,)
+			)
+
+	def render_pillow_dedup(self, slide, target_file=None):
+		# As render_convert_dedup, but the base layer is kept in memory.
+		base_entry = self.dedup_bases[slide['dedup_key']]
+		base_count = self.plan.base_label_count()
+		timings = {}
+		with base_entry['lock']:
+			if base_entry['base'] is None:
+				source = slide['source_path']
+				if slide['source_data'] is not None:
+					source = io.BytesIO(slide['source_data'])
+				try:
+					base_entry['base'], timings = pil_render.render_base(
+						source, self.plan.canvas_def, slide['labels'][:base_count],
+					)
+				except (OSError, ValueError) as err:
+					raise MDM2_Error(
+						'the pillow engine failed: "%s" on file "%s"'
+						% (err, slide['src_file'],)
+					)
+				slide['dedup'] = 'base'
+			else:
+				slide['dedup'] = 'hit'
+		slide_timings = self.render_pillow(
+			slide['src_file'],
+			None,
+			slide['write_path'] or slide['target_name'],
+			slide['labels'][base_count:],
+			target_file=target_file,
+			base_image=base_entry['base'],
+		)
+		for stage, secs in slide_timings.items():
+			timings[stage] = timings.get(stage, 0) + secs
+		return timings
+
+	# Source deduplication.
+
+	def dedup_scan(self):
+		# Find the inputs with the same bytes as another, by their digests,
+		# which we only take of the inputs whose size isn't unique.
+		time_0 = time.perf_counter()
+		by_size = {}
+		for src_file in self.inputs:
+			try:
+				by_size.setdefault(self.source_size(src_file), []).append(src_file)
+			except (OSError, KeyError):
+				# Rendering it will say what's wrong.
+				pass
+		by_digest = {}
+		for same_size in by_size.values():
+			if len(same_size) < 2:
+				continue
+			for src_file in same_size:
+				try:
+					digest = self.input_digest(src_file)
+				except (OSError, archive_util.ArchiveError):
+					continue
+				by_digest.setdefault(digest, []).append(src_file)
+		for digest, same_bytes in by_digest.items():
+			if len(same_bytes) < 2:
+				continue
+			self.dedup_bases[digest] = {
+				'lock': threading.Lock(),
+				'users': len(same_bytes),
+				'base': None,
+			}
+			for src_file in same_bytes:
+				self.dedup_keys[src_file] = digest
+		if self.dedup_bases and (self.plan.engine == 'convert'):
+			import tempfile
+			self.dedup_dir = tempfile.mkdtemp(prefix='mdm2-dedup-')
+		self.dedup_scan_time = time.perf_counter() - time_0
+
+	def input_digest(self, src_file):
+		import hashlib
+		if self.source_archive is not None:
+			return hashlib.sha256(self.source_archive.read(src_file)).hexdigest()
+		return self.source_digest(os.path.join(self.source_dir, src_file))
+
+	def dedup_release(self, src_file):
+		# The input's slide is done, so if it was the last to need its base
+		# layer, let it go.
+		digest = self.dedup_keys.get(src_file)
+		if digest is None:
+			return
+		with self.dedup_lock:
+			base_entry = self.dedup_bases[digest]
+			base_entry['users'] -= 1
+			if base_entry['users'] > 0:
+				return
+			base = base_entry['base']
+			base_entry['base'] = None
+		if (base is not None) and (self.plan.engine == 'convert'):
+			# The MPC's pixels are in a '.cache' file next to it.
+			for base_path in (base, '%s.cache' % (os.path.splitext(base)[0],),):
+				try:
+					os.unlink(base_path)
+				except FileNotFoundError:
+					pass
+
+	def dedup_cleanup(self):
+		if self.dedup_dir is not None:
+			import shutil
+			shutil.rmtree(self.dedup_dir, ignore_errors=True)
+			self.dedup_dir = None
+
+	# Instrumentation.
+
+	def source_size(self, src_file):
+		if self.source_archive is not None:
+			return self.source_archive.size(src_file)
+		return os.path.getsize(os.path.join(self.source_dir, src_file))
+
+	def stats_record(
+		self, curr_index, src_file, status, timings, bytes_out=None, copy_method=None, dedup=None,
+	):
+		stats = {
+			'slide_number': curr_index + 1,
+			'file': src_file,
+			'status': status,
+			'queue_wait': None,
+			'memory_wait': None,
+			'decode': None,
+			'render': None,
+			'write': None,
+			'bytes_in': None,
+			'bytes_out': bytes_out,
+			'copy_method': copy_method,
+			'dedup': dedup,
+		}
+		stats.update(timings)
+		try:
+			stats['bytes_in'] = self.source_size(src_file)
+		except (OSError, KeyError):
+			pass
+		with self.stats_lock:
+			self.slide_stats.append(stats)
+
+	def stats_summary(self):
+		rendered = [stats for stats in self.slide_stats if stats['status'] == 'rendered']
+		copied = [stats for stats in self.slide_stats if stats['status'] == 'copied']
+		resumed = [stats for stats in self.slide_stats if stats['status'] == 'resumed']
+		summary = {
+			'slides': len(self.slide_stats),
+			'rendered': len(rendered),
+			'copied': len(copied),
+			'failed': len(self.failures),
+			'unchanged': (
+				len(self.slide_stats) - len(rendered) - len(copied) - len(resumed) - len(self.failures)
+			),
+			'resumed': len(resumed),
+			'jobs': self.jobs,
+			'batch_size': self.batch_size,
+			'engine': self.plan.engine,
+			'elapsed': None,
+			'slides_per_sec': None,
+			'bytes_in': sum(stats['bytes_in'] or 0 for stats in self.slide_stats),
+			'bytes_out': sum(stats['bytes_out'] or 0 for stats in rendered + copied),
+			'memory_limit': self.memory_limit,
+			'memory_peak': self.memory_budget.peak if self.memory_budget else None,
+			'dedup': None,
+			'failures': sorted(self.failures, key=lambda failure: failure['slide_number']),
+		}
+		if self.dedup:
+			hits = sum(1 for stats in rendered if stats['dedup'] == 'hit')
+			summary['dedup'] = {
+				# The distinct sources that more than one input shares, and the
+				# inputs that share them.
+				'sources': len(self.dedup_bases),
+				'inputs': len(self.dedup_keys),
+				'hits': hits,
+				'hit_rate': (hits / len(rendered)) if rendered else None,
+				'scan': self.dedup_scan_time,
+			}
+		if (self.time_render_0 is not None) and (self.time_render_1 is not None):
+			summary['elapsed'] = self.time_render_1 - self.time_render_0
+			if summary['elapsed'] > 0:
+				summary['slides_per_sec'] = len(self.slide_stats) / summary['elapsed']
+		for stage in ('queue_wait', 'memory_wait', 'decode', 'render', 'write',):
+			values = [stats[stage] for stats in rendered if stats[stage] is not None]
+			summary[stage] = {
+				'p50': percentile(values, 50),
+				'p95': percentile(values, 95),
+				'max': max(values) if values else None,
+				'total': sum(values),
+			}
+		return summary
+
+	# Incremental rebuild manifest.
+
+	def source_digest(self, source_path, source_data=None):
+		import hashlib
+		if source_data is not None:
+			# From an archive, and we've already read it.
+			return hashlib.sha256(source_data).hexdigest()
+		source_stat = os.stat(source_path)
+		stat_key = (source_stat.st_mtime_ns, source_stat.st_size,)
+		try:
+			cached_key, digest = self.source_digests[source_path]
+			if cached_key == stat_key:
+				return digest
+		except KeyError:
+			pass
+		source_hash = hashlib.sha256()
+		with open(source_path, 'rb') as source_f:
+			for chunk in iter(lambda: source_f.read(1024 * 1024), b''):
+				source_hash.update(chunk)
+		digest = source_hash.hexdigest()
+		self.source_digests[source_path] = (stat_key, digest,)
+		return digest
+
+	def render_key(self, source_path, cmd_merge, source_data=None):
+		# The key is a digest of the source image's bytes and the fully
+		# resolved convert command, which together determine the output.
+		import hashlib
+		digest = hashlib.sha256()
+		digest.update(self.source_digest(source_path, source_data).encode('utf-8'))
+		digest.update(json.dumps(cmd_merge).encode('utf-8'))
+		# The engines aim for the same output, but it's not byte-for-byte.
+		digest.update(self.plan.engine.encode('utf-8'))
+		return digest.hexdigest()
+
+	def manifest_record(self, target_name, render_key):
+		with self.manifest_lock:
+			self.manifest[target_name] = render_key
+
+def render(plan, inputs, target_dir, **kwargs):
+	'''
+	Render the inputs (a list of image paths) with the given RenderPlan,
+	writing the slides to target_dir (or to the sink, if there's a sink=).
+	See RenderJob for the other options.
+	Returns the finished RenderJob, e.g., for its stats_summary(), or
+	raises MDM2_Error if a slide could not be rendered.
+	'''
+	return RenderJob(plan, inputs, target_dir, **kwargs).run()
+
 class MDM2_CLI(argparse.ArgumentParser):
 
 	def __init__(self, script_version=None, description=None, **kwargs):
@@ -54,8 +2062,22 @@ class MDM2_CLI(argparse.ArgumentParser):
 		self.args = None
 		# Time the whole task.
 		self.time_0 = time.time()
+		# The render workers share stdout, so they take turns printing.
+		self.print_lock = threading.Lock()
+		# The RenderPlan made from the CLI options, and the RenderJob that's
+		# running it (or that ran it last).
+		self.plan = None
+		self.job = None
+		# For --incremental, the render keys from the last run.
+		self.manifest_prev = {}
+		# Source digests, by path, good for as long as the mtime and size
+		# stay the same, so --watch doesn't rehash the whole deck each pass.
+		self.source_digests = {}
+		# True if the source is a zip or tar archive, or stdin ('-').
+		self.source_is_archive = False
 
 	def done(self):
+		self.stats_summary_print()
 		try:
 			print(
 				'Finished. Your task ran in %s'
@@ -105,13 +2127,42 @@ class MDM2_CLI(argparse.ArgumentParser):
 
 		self.add_argument('-s', '--source', dest='source_dir',
 			type=str, metavar='SOURCE_DIR', default='.',
-			help='The source directory containing the images you want to enhance.')
+			help='The source directory containing the images you want to enhance,'
+				' or a zip or tar archive of them, or "-" for a tar stream on stdin.'
+				' (A tar stream, or a compressed tar, is read all the way through first,'
+				' into memory, up to %d MiB, and past that, into a temporary file.)'
+				% (archive_util.MAX_MEMORY_BYTES // (1024 * 1024),))
+
+		# Which files in the source directory are the slides.
+
+		self.add_argument('-r', '--recursive', dest='recursive',
+			action='store_true', default=False,
+			help='Also look for images in subdirectories (the target mirrors the layout).')
+
+		self.add_argument('--include', dest='include_glob',
+			type=str, metavar='GLOB', action='append',
+			help='Only use source files whose relative path matches the glob (repeatable).')
+
+		self.add_argument('--exclude', dest='exclude_glob',
+			type=str, metavar='GLOB', action='append',
+			help='Skip source files whose relative path matches the glob (repeatable).')
+
+		# By default we go by file extension, which doesn't cost any I/O.
+		self.add_argument('--sniff', dest='sniff',
+			action='store_true', default=False,
+			help='Identify images by their leading bytes rather than by file extension.')
 
 		# *** Destination image directory.
 
 		self.add_argument('-t', '--target', dest='target_dir',
-			type=str, metavar='TARGET_DIR', required=True,
-			help='The empty or nonexistant path to the target directory to save the new files.')
+			type=str, metavar='TARGET_DIR',
+			help='The empty or nonexistant path to the target directory to save the new files'
+				' (or a .zip, .tar, .tar.gz, .pdf, .mp4, .mkv or .webm file to make instead).')
+
+		# For a video target, how many slides to show per second.
+		self.add_argument('--fps', dest='fps',
+			type=float, metavar='FPS', default=1.0,
+			help='The slides per second for a video target, e.g., 0.2 for 5 secs. each (defaults to 1).')
 
 		# *** Configuring the font and indicating what text to write.
 
@@ -119,40 +2170,15 @@ class MDM2_CLI(argparse.ArgumentParser):
 		#       multiple texts to write.
 
 		self.add_argument('-l', '--label', dest='text_label',
-			type=str, metavar='LABEL_TYPE', action='append', required=True,
-			help='The label text with may include {filename}, {slide_number}, {slide_count}.')
+			type=str, metavar='LABEL_TYPE', action='append',
+			help='The label text with may include {filename}, {slide_number}, {slide_count},'
+				' {width}, {height}, {mtime}, {exif_date} and {caption}.')
 
 		# Text defaults.
 
-		# The author is partial to the Google-sponsored open source sans font.
-		# Check for that first in the user's home directory.
-		def_font_path = os.path.join(
-			# I.e., ~/.fonts/open-sans/OpenSans-Regular.ttf
-			os.path.expanduser('~'), '.fonts', 'open-sans', 'OpenSans-Regular.ttf',
-		)
-		# The auther also runs Linux Mint (Ubuntu), so fallback on the system sans.
-		if not os.path.exists(def_font_path):
-			def_font_path = os.path.join(
-				# I.e., /usr/share/fonts/truetype/dejavu/DejaVuSans.ttf
-				os.sep, 'usr', 'share', 'fonts', 'truetype', 'dejavu', 'DejaVuSans.ttf',
-			)
-		# If there's no basic font found, force the user to specify it.
-		if not os.path.exists(def_font_path):
-			def_font_path = None
-		# NOTE: For a list of fonts, try
-		#         convert -list font
-
-		self.text_defaults = {
-			'font_path': def_font_path,
-			'font_style': 'Normal',
-			'font_weight': 'Normal',
-			'font_size': 20,
-			'font_fill': 'black',
-			'font_stroke': 'none',
-			'offset_gravity': 'center',
-			'offset_x': 0,
-			'offset_y': 0,
-		}
+		# NOTE: We look for the default font in parser_verify, so that
+		#       --help doesn't have to.
+		self.text_defaults = dict(LABEL_DEFAULTS)
 
 		# Text options.
 
@@ -186,6 +2212,13 @@ class MDM2_CLI(argparse.ArgumentParser):
 			type=int, metavar='POINTSIZE', action='append',
 			help='The font size, or, as convert calls it, -pointsize.')
 
+		# Rather than a fixed --size, use the largest size at which the label
+		# text fits in a box, e.g., --autofit 400x60 for a long {filename}.
+		# The text sizes are cached, in ~/.cache/mdm2/text-metrics.json.
+		self.add_argument('--autofit', dest='autofit',
+			type=str, metavar='WxH', action='append',
+			help='Size the label to fit a box of WxH pixels (overrides --size).')
+
 		# Fill and stroke color.
 
 		# There are 3 color formats, e.g.,
@@ -228,9 +2261,14 @@ class MDM2_CLI(argparse.ArgumentParser):
 
 		# You can resize the canvas if you want images larger than your source
 		# images, say, for borders or so you can write your text off the image.
+		# Repeat --extent to also make smaller renditions of each slide, e.g.,
+		#   --extent 4k=3840x2160 --extent web=1920x1080 --extent thumb=320x180
+		# The first is the full-size slide, and each one after that is resized
+		# from the one before it, with its labels scaled to match (or by the
+		# :LABEL_SCALE, if given). Each goes in its NAME subdirectory.
 		self.add_argument('--extent', dest='extent_geom',
-			type=str, metavar='EXTENT_GEOM', default='100%',
-			help='Set the new image size without scaling.')
+			type=str, metavar='[NAME=]EXTENT_GEOM[:LABEL_SCALE]', action='append',
+			help='Set the new image size without scaling (repeat for smaller renditions).')
 		# Set the gravity used when resizing the canvas. Use center to keep
 		# the image centered, or you can anchor it to an edge or corner.
 		self.add_argument('--extent-gravity', dest='extent_gravity',
@@ -246,62 +2284,419 @@ class MDM2_CLI(argparse.ArgumentParser):
 			type=str, metavar='BACKGROUND_COLOR', default='None',
 			help='The background color to use for enlargements and alphaed sources.')
 
+		# *** Rendering concurrency.
+
+		# Each slide is rendered by its own 'convert' process, so we can keep
+		# all the cores busy by running a handful of them at the same time.
+		self.add_argument('-j', '--jobs', dest='jobs',
+			type=int, metavar='JOBS', default=(os.cpu_count() or 1),
+			help='The number of slides to render at once (defaults to the number of CPUs).')
+
+		# *** Batching slides.
+
+		# Rather than one convert per slide, send a batch of slides through
+		# a single convert process, which pays ImageMagick's startup cost
+		# (and the font loading) once per batch instead of once per slide.
+		self.add_argument('-b', '--batch-size', dest='batch_size',
+			type=int, metavar='BATCH_SIZE', default=1,
+			help='The number of slides each convert process renders (defaults to 1).')
+
+		# *** Memory use.
+
+		# Huge images (think 16K scans) can take gigabytes apiece to render,
+		# so rather than run --jobs of them at once and run out of memory,
+		# only run as many at once as fit in the budget. We estimate each
+		# slide's memory from its image header, without decoding it.
+		self.add_argument('--memory-limit', dest='memory_limit',
+			type=str, metavar='SIZE', default=None,
+			help='The most memory to use rendering slides at once, e.g., 4G (defaults to no limit).')
+
+		# Once convert hits its memory limit, it pages to disk, and, with this
+		# limit, fails rather than fill the disk, too.
+		self.add_argument('--disk-limit', dest='disk_limit',
+			type=str, metavar='SIZE', default=None,
+			help='The most disk space each convert may page to, e.g., 20G (defaults to no limit).')
+
+		# *** Slides that take too long.
+
+		# A malformed (or enormous) image can keep convert busy for ages, so
+		# give up on it (and try again, in case it was just unlucky), or on
+		# the whole run, e.g., a nightly build that has to be done by 8.
+		self.add_argument('--slide-timeout', dest='slide_timeout',
+			type=str, metavar='DURATION', default=None,
+			help='Kill a convert that runs longer than this, e.g., 90s or 2m (defaults to no limit).')
+
+		self.add_argument('--retries', dest='retries',
+			type=int, metavar='N', default=None,
+			help='How many more times to try a slide that timed out (default: 1).')
+
+		self.add_argument('--run-budget', dest='run_budget',
+			type=str, metavar='DURATION', default=None,
+			help='Stop rendering after this long, e.g., 1h (defaults to no limit).')
+
+		self.add_argument('--keep-going', dest='keep_going',
+			action='store_true', default=False,
+			help='Keep rendering past slides that fail, and list them at the end.')
+
+		# *** Instrumentation.
+
+		# Write the per-slide timings and the totals to a file. Use a .jsonl
+		# extension for one JSON object per line (with the summary last).
+		self.add_argument('--report', dest='report_path',
+			type=str, metavar='REPORT_FILE', default=None,
+			help='Write per-slide timings and a summary to a JSON (or .jsonl) file.')
+
+		# *** Output encoding.
+
+		# By default, each slide is written in the same format as its source,
+		# using the encoder's default settings.
+		self.add_argument('--format', dest='output_format',
+			type=str.lower, metavar='FORMAT', default=None,
+			choices=['png', 'jpeg', 'jpg', 'webp', 'avif', 'gif', 'tiff', 'bmp',],
+			help='The output image format (defaults to the same as the source).')
+
+		self.add_argument('--preset', dest='encoder_preset',
+			type=str.lower, metavar='PRESET', default=None,
+			choices=sorted(ENCODER_PRESETS.keys()),
+			help='Encoder settings: "fast" (for previews) or "small" (for distribution).')
+
+		self.add_argument('--quality', dest='quality',
+			type=int, metavar='QUALITY', default=None,
+			help='The JPEG, WebP or AVIF quality, from 1 to 100.')
+
+		self.add_argument('--png-compression', dest='png_compression',
+			type=int, metavar='LEVEL', default=None, choices=range(0, 10),
+			help='The PNG (zlib) compression level, from 0 (none) to 9 (most).')
+
+		self.add_argument('--png-filter', dest='png_filter',
+			type=int, metavar='FILTER', default=None, choices=range(0, 6),
+			help='The PNG filter, from 0 (none) to 4 (Paeth), or 5 (adaptive).')
+
+		self.add_argument('--strip', dest='strip',
+			action='store_true', default=None,
+			help='Strip metadata, like EXIF and color profiles, from the output.')
+
+		# *** Slides that don't change.
+
+		# A slide with no label text, on a canvas that's the same size, comes
+		# out the same as its source, so we copy it instead of rendering it.
+		# The copy shares blocks with the source if the filesystem can, but
+		# a hard link shares the whole file, so edit one and you edit both.
+		self.add_argument('--hardlink', dest='hardlink',
+			action='store_true', default=False,
+			help='Hard link (rather than copy) slides that would come out the same as their source.')
+
+		# Slides that share a source image (by its bytes) share the work of
+		# decoding it, putting it on its canvas, and drawing the labels that
+		# are the same on every slide, so each copy only draws the rest.
+		self.add_argument('--dedup', dest='dedup',
+			action='store_true', default=False,
+			help='Render each repeated source image\'s base layer once, and start its copies from it.')
+
+		# *** Rendering engine.
+
+		# By default, we fork ImageMagick's convert for each slide. The pillow
+		# engine renders in-process instead, which saves the fork, exec, and
+		# startup cost per slide, which, for small images, is most of the work.
+		self.add_argument('--engine', dest='engine',
+			type=str.lower, metavar='ENGINE', default='convert',
+			choices=['convert', 'pillow',],
+			help='The rendering engine: "convert" (ImageMagick) or "pillow" (in-process).')
+
+		# *** Incremental rebuilds.
+
+		# Rather than insisting on a new target directory, reuse the slides
+		# from the last run whose source image and convert command are the
+		# same as before, and only re-render the ones that changed.
+		self.add_argument('-i', '--incremental', dest='incremental',
+			action='store_true', default=False,
+			help='Update an existing target directory, only re-rendering changed slides.')
+
+		# Pick up where a run that crashed (or was killed) left off, going by
+		# the journal of finished slides it kept in the target directory.
+		self.add_argument('--resume', dest='resume',
+			action='store_true', default=False,
+			help='Finish an interrupted run: skip the slides it finished (run it with the same options).')
+
+		# *** Sharding.
+
+		# Split the deck across hosts (or processes): each --shard renders its
+		# slice of the sorted slides, numbered as in the whole deck, into the
+		# same target directory (e.g., on a shared drive). Then --merge-shards
+		# checks that every shard finished and merges their manifests.
+		self.add_argument('--shard', dest='shard',
+			type=str, metavar='I/N', default=None,
+			help='Only render the I-th (1-based) of N equal slices of the slides.')
+
+		self.add_argument('--merge-shards', dest='merge_shards',
+			type=int, metavar='N', default=None,
+			help='Check that all N shards finished, and merge their manifests, then quit.')
+
+		# *** Watch mode.
+
+		# Keep running, and whenever the source directory changes, update the
+		# target directory like --incremental would. Inserting or deleting a
+		# slide only re-renders the slides whose label text changes as a result.
+		self.add_argument('-w', '--watch', dest='watch',
+			action='store_true', default=False,
+			help='Keep running and re-render slides as the source directory changes.')
+
+		# Wait for the source directory to settle before re-rendering, since
+		# exporting a stack of layers from GIMP writes a bunch of files at once.
+		self.add_argument('--watch-debounce', dest='watch_debounce',
+			type=float, metavar='SECS', default=0.5,
+			help='Wait this long after the last change before re-rendering (defaults to 0.5).')
+
+		# *** Server mode.
+
+		# Keep the labels (and Pillow, and its fonts) loaded, and render one
+		# slide per request, so each one doesn't pay for starting mdm2. See
+		# serve_render for the requests.
+		self.add_argument('--serve', dest='serve',
+			type=str, metavar='ADDRESS', default=None,
+			help='Render slides on request, over HTTP, at unix:SOCKET_PATH or [HOST:]PORT (on localhost).')
+
+		# The requests past the ones being rendered (by --jobs workers) that
+		# can wait their turn, after which the server turns them away (503).
+		self.add_argument('--serve-queue', dest='serve_queue',
+			type=int, metavar='SIZE', default=None,
+			help='How many requests can wait to be rendered (defaults to 4 per job).')
+
 	def parser_verify(self):
 		ok = True
 
-		# Check that imagemagick is installed.
-		try:
-			ret = subprocess.check_output(['convert', '-version',], stderr=subprocess.STDOUT)
-		except FileNotFoundError:
-			print(
-				'%s: error: Have you installed imagemagick? try: `sudo apt-get install imagemagick`'
-				% (SCRIPT_NAME,)
-			)
+		# Merging shards only needs the target directory.
+		if self.args.merge_shards is not None:
+			if self.args.merge_shards < 1:
+				print(
+					'%s: error: the number of shards should be 1 or more: %d'
+					% (SCRIPT_NAME, self.args.merge_shards,)
+				)
+				ok = False
+			if not self.args.target_dir:
+				print('%s: error: the following argument is required: -t/--target' % (SCRIPT_NAME,))
+				ok = False
+			elif not os.path.isdir(self.args.target_dir):
+				print(
+					'%s: error: the target path does not exist or is not a directory: "%s"'
+					% (SCRIPT_NAME, self.args.target_dir,)
+				)
+				ok = False
+			return ok
+
+		if not self.args.text_label:
+			print('%s: error: the following argument is required: -l/--label' % (SCRIPT_NAME,))
+			return False
+
+		self.shard = None
+		if self.args.shard is not None:
+			try:
+				shard_i, shard_n = [int(part) for part in self.args.shard.split('/')]
+				if not (1 <= shard_i <= shard_n):
+					raise ValueError
+				self.shard = (shard_i, shard_n,)
+			except ValueError:
+				print(
+					'%s: error: the shard should be I/N, from 1/N to N/N: "%s"'
+					% (SCRIPT_NAME, self.args.shard,)
+				)
+				ok = False
+			if self.args.watch:
+				print('%s: error: --shard does not work with --watch' % (SCRIPT_NAME,))
+				ok = False
+
+		if self.args.resume and self.args.watch:
+			print('%s: error: --resume does not work with --watch' % (SCRIPT_NAME,))
 			ok = False
 
+		if self.args.serve is not None:
+			for serve_conflict, option_name in (
+				(self.args.watch, '--watch',),
+				(self.args.incremental, '--incremental',),
+				(self.args.resume, '--resume',),
+				(self.args.shard is not None, '--shard',),
+				(len(self.args.extent_geom or []) > 1, 'more than one --extent',),
+				(self.args.run_budget is not None, '--run-budget',),
+				(self.args.keep_going, '--keep-going',),
+			):
+				if serve_conflict:
+					print('%s: error: --serve does not work with %s' % (SCRIPT_NAME, option_name,))
+					ok = False
+			if (self.args.serve_queue is not None) and (self.args.serve_queue < 1):
+				print(
+					'%s: error: the serve queue should be 1 or more: %d'
+					% (SCRIPT_NAME, self.args.serve_queue,)
+				)
+				ok = False
+
+		# Watching is an incremental update, over and over.
+		if self.args.watch:
+			self.args.incremental = True
+
+		# Check that imagemagick is installed, or Pillow, for the pillow engine.
+		# NOTE: What convert can do is cached on disk (see probe_util), so
+		#       we don't run it just to ask, unless it's been updated.
+		self.imagemagick = None
+		if self.args.engine == 'pillow':
+			if pil_render_load() is None:
+				print(
+					'%s: error: Have you installed Pillow? try: `pip3 install Pillow`'
+					% (SCRIPT_NAME,)
+				)
+				ok = False
+		else:
+			self.imagemagick = probe_util.imagemagick_probe()
+			if self.imagemagick is None:
+				print(
+					'%s: error: Have you installed imagemagick? try: `sudo apt-get install imagemagick`'
+					% (SCRIPT_NAME,)
+				)
+				ok = False
+			elif (
+				self.args.output_format
+				and self.imagemagick['formats']
+				and (self.args.output_format.upper() not in self.imagemagick['formats'])
+			):
+				print(
+					'%s: error: this imagemagick cannot write %s: "%s"'
+					% (SCRIPT_NAME, self.args.output_format, self.imagemagick['version'],)
+				)
+				ok = False
+
 		#curr_path = os.path.dirname(os.path.abspath(__file__))
 
-		if not self.args.source_dir:
-			print('%s: error: the following argument is required: -s/--source' % (SCRIPT_NAME,))
-			ok = False
-		elif not os.path.isdir(self.args.source_dir):
+		# A target file like deck.pdf or deck.zip is a sink for all the slides.
+		self.sink_cls = sink_util.sink_class(self.args.target_dir or '')
+
+		# The server gets its sources and targets with each request.
+		if self.args.serve is None:
+			ok = self.paths_verify() and ok
+		elif self.args.target_dir:
 			print(
-				'%s: error: the source path does not exist or is not a directory: "%s"'
-				% (SCRIPT_NAME, self.args.source_dir,)
+				'%s: error: --serve takes the target with each request, not with -t/--target'
+				% (SCRIPT_NAME,)
 			)
 			ok = False
 
-		if not self.args.target_dir:
-			assert(False) # We marked this argument 'required' so this is a dead if.
-			print('%s: error: the following argument is required: -t/--target' % (SCRIPT_NAME,))
+		if self.args.fps <= 0:
+			print('%s: error: the frames per second should be more than 0: %s' % (SCRIPT_NAME, self.args.fps,))
 			ok = False
-		# MAYBE: Allow existing directory if empty.
-		elif os.path.exists(self.args.target_dir):
-			# MAYBE: Move the existing directory for the user.
+
+		if self.args.jobs < 1:
+			print('%s: error: the number of jobs should be 1 or more: %d' % (SCRIPT_NAME, self.args.jobs,))
+			ok = False
+		if self.args.batch_size < 1:
+			print('%s: error: the batch size should be 1 or more: %d' % (SCRIPT_NAME, self.args.batch_size,))
+			ok = False
+
+		self.memory_limit = None
+		self.disk_limit = None
+		for limit_key in ('memory_limit', 'disk_limit',):
+			if getattr(self.args, limit_key) is None:
+				continue
+			try:
+				limit = parse_size(getattr(self.args, limit_key))
+				if limit <= 0:
+					raise ValueError('not a size: "%s"' % (getattr(self.args, limit_key),))
+				setattr(self, limit_key, limit)
+			except ValueError as err:
+				print(
+					'%s: error: --%s should be a size, like 512M or 4G: %s'
+					% (SCRIPT_NAME, limit_key.replace('_', '-'), err,)
+				)
+				ok = False
+
+		self.slide_timeout = None
+		self.run_budget = None
+		for duration_key in ('slide_timeout', 'run_budget',):
+			duration = getattr(self.args, duration_key)
+			if duration is None:
+				continue
+			try:
+				tdelta = time_util.parse_timedelta(duration)
+			except NameError:
+				print(
+					'%s: error: --%s needs time_util.py, which is missing'
+					% (SCRIPT_NAME, duration_key.replace('_', '-'),)
+				)
+				ok = False
+				continue
+			if (tdelta is None) or (tdelta.total_seconds() <= 0):
+				print(
+					'%s: error: --%s should be a duration, like 90s, 2m or 1h: "%s"'
+					% (SCRIPT_NAME, duration_key.replace('_', '-'), duration,)
+				)
+				ok = False
+				continue
+			setattr(self, duration_key, tdelta.total_seconds())
+		# The watchdog kills (and retries) a convert, so there's nothing for
+		# it to do when the pillow engine renders in-process.
+		if (self.args.engine == 'pillow') and (
+			(self.args.slide_timeout is not None) or (self.args.retries is not None)
+		):
 			print(
-				'%s: error: the target path already exists: please rename (move) or remove: "%s"'
-				% (SCRIPT_NAME, self.args.target_dir,)
+				'%s: error: --slide-timeout and --retries only work with --engine convert'
+				% (SCRIPT_NAME,)
 			)
 			ok = False
+		if self.args.retries is None:
+			self.args.retries = 1
+		elif self.args.retries < 0:
+			print('%s: error: the retries should be 0 or more: %d' % (SCRIPT_NAME, self.args.retries,))
+			ok = False
 
-		if (
-			self.args.source_dir
-			and (os.path.abspath(self.args.source_dir) == os.path.abspath(self.args.target_dir))
-		):
+		if (self.args.quality is not None) and not (1 <= self.args.quality <= 100):
+			print('%s: error: the quality should be from 1 to 100: %d' % (SCRIPT_NAME, self.args.quality,))
+			ok = False
+
+		# Resolve the encoder settings: the preset, and then the user's options.
+		encoder = dict(ENCODER_DEFAULTS)
+		encoder['format'] = self.args.output_format
+		if self.args.encoder_preset:
+			encoder.update(ENCODER_PRESETS[self.args.encoder_preset])
+		for enc_key in ('quality', 'png_compression', 'png_filter', 'strip',):
+			if getattr(self.args, enc_key) is not None:
+				encoder[enc_key] = getattr(self.args, enc_key)
+
+		# The first extent is the full-size slide, and the rest are renditions.
+		extent_profiles = []
+		for extent_profile in (self.args.extent_geom or ['100%']):
+			try:
+				extent_profiles.append(parse_extent_profile(extent_profile))
+			except ValueError:
+				print(
+					'%s: error: an extent should look like [NAME=]GEOM[:LABEL_SCALE]: "%s"'
+					% (SCRIPT_NAME, extent_profile,)
+				)
+				ok = False
+		renditions = [
+			{'name': rend_name, 'geom': rend_geom, 'label_scale': rend_scale}
+			for rend_name, rend_geom, rend_scale in extent_profiles[1:]
+		]
+		if renditions and (self.sink_cls is not None):
 			print(
-				'%s: error: the source and target path should not be the same directory: "%s"'
-				% (SCRIPT_NAME, self.args.source_dir,)
+				'%s: error: more than one --extent needs a target directory, not a file: "%s"'
+				% (SCRIPT_NAME, self.args.target_dir,)
 			)
 			ok = False
 
 		# If we didn't figure out the font, use the first as the default.
-		for font_path in self.args.font_path:
-			if not os.path.isfile(font_path):
+		# A font can also be one that convert knows by name, e.g., from
+		# `convert -list font`, which we swap for its file, which works with
+		# either engine.
+		known_fonts = (self.imagemagick or {}).get('fonts', {})
+		for font_i, font_path in enumerate(self.args.font_path or []):
+			if os.path.isfile(font_path):
+				continue
+			if os.path.isfile(known_fonts.get(font_path, '')):
+				self.args.font_path[font_i] = known_fonts[font_path]
+			else:
 				print(
 					'%s: error: a font path does not exist or is not a file: "%s"'
 					% (SCRIPT_NAME, font_path,)
 				)
 				ok = False
+		self.text_defaults['font_path'] = find_default_font()
 		if not self.text_defaults['font_path']:
 			if self.args.font_path:
 				self.text_defaults['font_path'] = self.args.font_path[0]
@@ -329,8 +2724,7 @@ class MDM2_CLI(argparse.ArgumentParser):
 
 		self.text_labels = []
 		for label_i in range(len(self.args.text_label)):
-			label_def = {}
-			label_def['label'] = self.args.text_label[label_i]
+			label_settings = {}
 			for arg_key, arg_default in self.text_defaults.items():
 				arg_list = getattr(self.args, arg_key) or []
 				try:
@@ -338,138 +2732,854 @@ class MDM2_CLI(argparse.ArgumentParser):
 					# E.g., if there four labels and the user configures
 					# the first two labels on the CLI, the third and
 					# fourth will use the same setting as number two.
-					label_def[arg_key] = arg_list[label_i]
+					label_settings[arg_key] = arg_list[label_i]
 				except IndexError:
-					label_def[arg_key] = arg_default
-			self.text_labels.append(label_def)
+					label_settings[arg_key] = arg_default
+			try:
+				self.text_labels.append(LabelSpec(self.args.text_label[label_i], **label_settings))
+			except MDM2_Error as err:
+				print('%s: error: %s' % (SCRIPT_NAME, err,))
+				ok = False
+
+		# Everything else is the same for every slide, so figure it out once.
+		if ok:
+			extent_name, extent_geom, extent_label_scale = extent_profiles[0]
+			try:
+				self.plan = RenderPlan(
+					self.text_labels,
+					background_color=self.args.background_color,
+					extent_geom=extent_geom,
+					extent_gravity=self.args.extent_gravity,
+					encoder=encoder,
+					engine=self.args.engine,
+					extent_name=extent_name,
+					extent_label_scale=extent_label_scale,
+					renditions=renditions,
+				)
+			except MDM2_Error as err:
+				print('%s: error: %s' % (SCRIPT_NAME, err,))
+				ok = False
+
+		return ok
+
+	def paths_verify(self):
+		# Check the source and target paths, and how they go with the options.
+		ok = True
+
+		if not self.args.source_dir:
+			print('%s: error: the following argument is required: -s/--source' % (SCRIPT_NAME,))
+			ok = False
+		elif (self.args.source_dir == '-') or (
+			os.path.isfile(self.args.source_dir) and archive_util.is_archive(self.args.source_dir)
+		):
+			self.source_is_archive = True
+			if self.args.watch:
+				print(
+					'%s: error: --watch needs a source directory, not an archive: "%s"'
+					% (SCRIPT_NAME, self.args.source_dir,)
+				)
+				ok = False
+		elif not os.path.isdir(self.args.source_dir):
+			print(
+				'%s: error: the source path does not exist or is not a directory'
+				' (nor a zip or tar archive): "%s"'
+				% (SCRIPT_NAME, self.args.source_dir,)
+			)
+			ok = False
+
+		if not self.args.target_dir:
+			print('%s: error: the following argument is required: -t/--target' % (SCRIPT_NAME,))
+			ok = False
+		elif (self.sink_cls is not None) and (self.args.shard is not None):
+			print(
+				'%s: error: --shard needs a target directory, not a file: "%s"'
+				% (SCRIPT_NAME, self.args.target_dir,)
+			)
+			ok = False
+		# MAYBE: Allow existing directory if empty.
+		# NOTE: The shards all share the target directory.
+		elif (
+			os.path.exists(self.args.target_dir)
+			and not self.args.incremental
+			and not self.args.resume
+			and (self.args.shard is None)
+		):
+			# MAYBE: Move the existing directory for the user.
+			print(
+				'%s: error: the target path already exists: please rename (move) or remove,'
+				' or try --incremental%s: "%s"'
+				% (
+					SCRIPT_NAME,
+					' (or --resume, to finish the last run)' if os.path.exists(
+						os.path.join(self.args.target_dir, JOURNAL_NAME)
+					) else '',
+					self.args.target_dir,
+				)
+			)
+			ok = False
+		elif (self.sink_cls is not None) and self.args.resume:
+			print(
+				'%s: error: --resume needs a target directory, not a file: "%s"'
+				% (SCRIPT_NAME, self.args.target_dir,)
+			)
+			ok = False
+		elif (self.sink_cls is not None) and self.args.incremental:
+			print(
+				'%s: error: --incremental and --watch need a target directory, not a file: "%s"'
+				% (SCRIPT_NAME, self.args.target_dir,)
+			)
+			ok = False
+		elif (self.sink_cls is not None) and not os.path.isdir(
+			os.path.dirname(os.path.abspath(self.args.target_dir))
+		):
+			print(
+				'%s: error: the target file\'s directory does not exist: "%s"'
+				% (SCRIPT_NAME, self.args.target_dir,)
+			)
+			ok = False
+		elif self.args.incremental and os.path.exists(self.args.target_dir):
+			if not os.path.isdir(self.args.target_dir):
+				print(
+					'%s: error: the target path exists but is not a directory: "%s"'
+					% (SCRIPT_NAME, self.args.target_dir,)
+				)
+				ok = False
+
+		if (
+			self.args.source_dir
+			and self.args.target_dir
+			and (os.path.abspath(self.args.source_dir) == os.path.abspath(self.args.target_dir))
+		):
+			print(
+				'%s: error: the source and target path should not be the same directory: "%s"'
+				% (SCRIPT_NAME, self.args.source_dir,)
+			)
+			ok = False
+
+		if self.sink_cls is sink_util.FfmpegSink:
+			import shutil
+			if shutil.which('ffmpeg') is None:
+				print(
+					'%s: error: Have you installed ffmpeg? try: `sudo apt-get install ffmpeg`'
+					% (SCRIPT_NAME,)
+				)
+				ok = False
 
 		return ok
 
 	# Program runtime.
 
 	def process_images(self):
-		# Create the output directory.
+		self.target_prepare()
 		try:
-			os.mkdir(self.args.target_dir, mode=0o775)
-		except OSError:
-			assert(False) # We know the directory already exists.
-			raise
+			ok = self.render_pass()
+		finally:
+			self.plan.metrics_save()
+		if not ok:
+			sys.exit(1)
 
-		# Get a list of files in the source directory.
+	def watch_images(self):
+		self.target_prepare()
+		import watch_util
+		# Start watching before the first pass, so we don't miss any changes.
+		watcher = watch_util.make_watcher(
+			self.args.source_dir, recursive=self.args.recursive, skip_dir=self.args.target_dir,
+		)
+		try:
+			while True:
+				ok = self.render_pass()
+				self.plan.metrics_save()
+				self.stats_summary_print()
+				self.watch_reset(ok)
+				print('Watching for changes: "%s"' % (self.args.source_dir,), flush=True)
+				watch_util.wait_for_quiet(watcher, self.args.watch_debounce)
+		except KeyboardInterrupt:
+			print('')
+		finally:
+			watcher.close()
+
+	def watch_reset(self, ok):
+		# What we just rendered is what the next pass compares against. If
+		# the pass failed, the slides it didn't get to are still good, too.
+		if ok:
+			self.manifest_prev = dict(self.job.manifest)
+		elif self.job is not None:
+			self.manifest_prev.update(self.job.manifest)
+		self.job = None
+
+	def serve(self):
+		import serve_util
+		queue_size = self.args.serve_queue or (4 * self.args.jobs)
+		try:
+			server = serve_util.RenderServer(
+				self.args.serve, self.serve_render, workers=self.args.jobs, queue_size=queue_size,
+			)
+		except (OSError, ValueError) as err:
+			print('%s: error: cannot serve at "%s": %s' % (SCRIPT_NAME, self.args.serve, err,))
+			sys.exit(1)
+		print(
+			'Serving at %s with %d job(s), and room for %d more in the queue.'
+			% (self.args.serve, self.args.jobs, queue_size,),
+			flush=True,
+		)
+		# Shut down cleanly (and remove the socket) when a service manager
+		# stops us, too, and not just on Ctrl-C.
+		def serve_stop(signum, frame):
+			raise KeyboardInterrupt
+		signal.signal(signal.SIGTERM, serve_stop)
+		try:
+			server.serve_forever()
+		except KeyboardInterrupt:
+			pass
+		finally:
+			server.close()
+			self.plan.metrics_save()
+		stats = server.stats.summary()
+		print(
+			'Served %d slide(s) (%d failed, %d bad request(s), %d turned away).'
+			% (
+				stats['counts'].get('served', 0),
+				stats['counts'].get('failed', 0),
+				stats['counts'].get('bad_request', 0),
+				stats['counts'].get('rejected', 0),
+			)
+		)
+		if stats['total']['p50'] is not None:
+			print(
+				'Request latency: p50 %.3f secs. / p99 %.3f secs. / max %.3f secs.'
+				% (stats['total']['p50'], stats['total']['p99'], stats['total']['max'],)
+			)
+
+	def serve_render(self, request):
+		# Render one slide for --serve. The request is a JSON object with:
+		#   "source": the image's path, or else
+		#   "data" and "name": the image, base64-encoded, and its file name;
+		#   "variables" (optional): label variables to fill in, e.g.,
+		#       {"slide_number": 3, "slide_count": 12, "caption": "Such wow"};
+		#   "target_dir" (optional): where to write the slide, or else it's
+		#       sent back as the response.
+		import base64
+		import mimetypes
+		import tempfile
+		from serve_util import ServeError
+
+		variables = dict(request.get('variables') or {})
+		unknown_variables = set(variables) - set(LABEL_VARIABLES)
+		if unknown_variables:
+			raise ServeError(400, 'unknown label variables: %s' % (', '.join(sorted(unknown_variables)),))
+		# The slide number and count decide how the number's padded, so they
+		# go to the RenderJob, like they would for a deck.
+		try:
+			slide_count = int(variables.pop('slide_count', 1))
+			slide_number = int(variables.pop('slide_number', 1))
+		except (TypeError, ValueError):
+			raise ServeError(400, 'the slide_number and slide_count should be numbers')
+		if not (1 <= slide_number <= slide_count):
+			raise ServeError(400, 'the slide_number should be from 1 to the slide_count')
+
+		target_dir = request.get('target_dir')
+		if target_dir and not os.path.isdir(target_dir):
+			raise ServeError(400, 'the target directory does not exist: "%s"' % (target_dir,))
+		upload_dir = None
+		try:
+			if request.get('data') is not None:
+				src_file = os.path.basename(request.get('name') or '')
+				if os.path.splitext(src_file)[1].lower() not in IMAGE_EXTENSIONS:
+					raise ServeError(400, 'the "name" should be an image file name: "%s"' % (src_file,))
+				try:
+					image_data = base64.b64decode(request['data'], validate=True)
+				except ValueError as err:
+					raise ServeError(400, 'the "data" should be base64: %s' % (err,))
+				upload_dir = tempfile.mkdtemp(prefix='mdm2-serve-')
+				with open(os.path.join(upload_dir, src_file), 'wb') as upload_f:
+					upload_f.write(image_data)
+				source_dir = upload_dir
+			elif request.get('source'):
+				source_dir, src_file = os.path.split(os.path.abspath(request['source']))
+				if not os.path.isfile(os.path.join(source_dir, src_file)):
+					raise ServeError(400, 'the source is not a file: "%s"' % (request['source'],))
+			else:
+				raise ServeError(400, 'the request needs a "source", or "data" and a "name"')
+
+			sink = None if target_dir else sink_util.BufferSink()
+			job = RenderJob(
+				self.plan,
+				[src_file],
+				target_dir,
+				source_dir=source_dir,
+				first_index=slide_number - 1,
+				slide_count=slide_count,
+				sink=sink,
+				# The workers share the memory limit.
+				memory_limit=(self.memory_limit // self.args.jobs) if self.memory_limit else None,
+				disk_limit=self.disk_limit,
+				hardlink=self.args.hardlink,
+				variables=variables,
+				slide_timeout=self.slide_timeout,
+				retries=self.args.retries,
+			)
+			try:
+				job.run()
+			except MDM2_Error as err:
+				raise ServeError(422, str(err))
+		finally:
+			if upload_dir is not None:
+				import shutil
+				shutil.rmtree(upload_dir, ignore_errors=True)
+
+		if sink is None:
+			targets = [
+				os.path.join(target_dir, target_name)
+				for target_name in self.plan.target_names(src_file)
+			]
+			return (200, 'application/json', json.dumps({'targets': targets}).encode('utf-8') + b'\n',)
+		slide_name, slide_data = sink.slides[0]
+		return (200, mimetypes.guess_type(slide_name)[0] or 'application/octet-stream', slide_data,)
+
+	def target_prepare(self):
+		# Create the output directory, unless the target's a file.
+		if self.sink_cls is not None:
+			return
+		if self.shard is not None:
+			# The other shards may be making it at the same time.
+			os.makedirs(self.args.target_dir, mode=0o775, exist_ok=True)
+			if self.args.incremental:
+				self.manifest_load()
+		elif (self.args.incremental or self.args.resume) and os.path.isdir(self.args.target_dir):
+			if self.args.incremental:
+				self.manifest_load()
+		else:
+			try:
+				os.mkdir(self.args.target_dir, mode=0o775)
+			except OSError:
+				assert(False) # We know the directory already exists.
+				raise
+
+	def render_pass(self):
+		# Render (or update) the target directory from what's in the source
+		# directory right now. Returns False if something went wrong.
+
+		# Get a list of images in the source directory (or archive).
+		# NOTE: We only ever make one pass over an archive (it can't be
+		#       --watch'ed), and stdin can only be read once, anyway.
+		if self.source_is_archive:
+			try:
+				source_archive = archive_util.open_archive(self.args.source_dir)
+			except archive_util.ArchiveError as err:
+				print('%s: error: %s' % (SCRIPT_NAME, err,))
+				return False
+			try:
+				return self.render_source_files(
+					list(self.scan_archive_members(source_archive)), source_archive,
+				)
+			finally:
+				source_archive.close()
 		try:
-			source_files = os.listdir(self.args.source_dir)
+			source_files = list(self.scan_source_files())
 		except FileNotFoundError:
 			assert(False) # We know the directory already exists.
 			raise
+		return self.render_source_files(source_files)
 
+	def render_source_files(self, source_files, source_archive=None):
 		if not source_files:
 			print(
-				'%s: error: the source directory does not contain any files: "%s"'
-				% (SCRIPT_NAME, self.args.source_dir,)
+				'%s: error: the source %s does not contain any images: "%s"'
+				% (
+					SCRIPT_NAME,
+					'directory' if source_archive is None else 'archive',
+					self.args.source_dir,
+				)
 			)
-			sys.exit(1)
+			return False
+
+		# With --format, 'a.png' and 'a.jpg' would both be written to 'a.webp'.
+		if self.plan.encoder['format']:
+			target_names = {}
+			for src_file in source_files:
+				target_names.setdefault(self.plan.target_name(src_file), []).append(src_file)
+			collisions = [names for names in target_names.values() if len(names) > 1]
+			if collisions:
+				print(
+					'%s: error: these source files would have the same target name: %s'
+					% (SCRIPT_NAME, ', '.join('"%s"' % (name,) for name in sorted(collisions[0])),)
+				)
+				return False
 
-		# Determine how many digits the final number will be.
-		num_digits = 0
-		self.slide_count = len(source_files)
-		largest_num = self.slide_count
-		while largest_num > 0:
-			largest_num = int(largest_num / 10)
-			num_digits += 1
-		# Make the format symbol, e.g., '%04d' % 12 ==> 0012.
-		self.slide_num_fmt = '%%0%dd' % (num_digits,)
+		sink = None
+		if self.sink_cls is not None:
+			try:
+				sink = sink_util.make_sink(self.args.target_dir, fps=self.args.fps)
+			except (sink_util.SinkError, OSError) as err:
+				print('%s: error: %s' % (SCRIPT_NAME, err,))
+				return False
 
-		# Walk the files in the top-level source directory in alphabetical order.
+		# Walk the images in the source directory in alphabetical order.
 		source_files.sort()
-		curr_index = 0
-		for src_file in source_files:
-			self.convert_image(src_file, curr_index)
-			curr_index += 1
 
-	def convert_image(self, src_file, curr_index):
-		slide_index_text = self.slide_num_fmt % (curr_index + 1,)
-		print(
-			'Creating slide for index %s: file: "%s"...' % (
-				slide_index_text, os.path.basename(src_file),
-			),
-			end="",
-			flush=True,
+		# A shard renders its slice of the deck, but numbers the slides (and
+		# counts them) as in the whole deck. It always keeps a manifest, for
+		# --merge-shards, and only prunes slides that left the deck entirely,
+		# and not slides that moved to another shard.
+		slide_count = len(source_files)
+		first_index = 0
+		manifest_prev = self.manifest_prev if self.args.incremental else None
+		self.deck_targets = None
+		if self.shard is not None:
+			self.deck_targets = set()
+			for src_file in source_files:
+				self.deck_targets.update(self.plan.target_names(src_file))
+			first_index, last_index = shard_range(slide_count, *self.shard)
+			source_files = source_files[first_index:last_index]
+			if manifest_prev is None:
+				manifest_prev = {}
+
+		# Keep a journal of the finished slides, for --resume, unless we're
+		# watching, where the next pass catches up anyway.
+		journal_path = None
+		resumed = None
+		if (self.sink_cls is None) and not self.args.watch:
+			journal_path = self.journal_path()
+			if self.args.resume:
+				resumed = self.journal_load(journal_path)
+			else:
+				try:
+					os.unlink(journal_path)
+				except FileNotFoundError:
+					pass
+			# The shards share the directory, so leave each other's be.
+			if self.shard is None:
+				self.partials_remove(source_files)
+
+		self.job = RenderJob(
+			self.plan,
+			source_files,
+			self.args.target_dir,
+			source_dir=self.args.source_dir if (source_archive is None) else '',
+			jobs=self.args.jobs,
+			batch_size=self.args.batch_size,
+			manifest_prev=manifest_prev,
+			first_index=first_index,
+			slide_count=slide_count,
+			source_digests=self.source_digests,
+			progress=self.progress,
+			sink=sink,
+			memory_limit=self.memory_limit,
+			disk_limit=self.disk_limit,
+			hardlink=self.args.hardlink,
+			journal=journal_path,
+			resumed=resumed,
+			source_archive=source_archive,
+			dedup=self.args.dedup,
+			slide_timeout=self.slide_timeout,
+			retries=self.args.retries,
+			run_budget=self.run_budget,
+			keep_going=self.args.keep_going,
 		)
+		try:
+			self.job.run()
+		except MDM2_Error as err:
+			print('%s: error: %s' % (SCRIPT_NAME, err,))
+			self.render_failed(journal_path)
+			return False
+		if self.job.failures:
+			# With --keep-going, the rest of the deck is done, but not these.
+			print('%s: error: %d slide(s) failed:' % (SCRIPT_NAME, len(self.job.failures),))
+			for failure in sorted(self.job.failures, key=lambda failure: failure['slide_number']):
+				print('  %s: %s' % (failure['file'], failure['error'],))
+			self.render_failed(journal_path)
+			return False
+		self.manifest_save(prune=True)
+		self.report_write()
+		if journal_path:
+			os.unlink(journal_path)
+		return True
+
+	def render_failed(self, journal_path):
+		# Keep track of the slides that did finish, so the next
+		# incremental run doesn't have to render them again.
+		self.manifest_save(prune=False)
+		self.report_write()
+		if journal_path:
+			print(
+				'%s: to pick up where this run left off, run it again with --resume'
+				% (SCRIPT_NAME,)
+			)
 
-		source_path = os.path.join(self.args.source_dir, src_file)
-
-		target_path = os.path.join(self.args.target_dir, os.path.basename(src_file))
-
-		# Create the text layer(s).
-		label_opts = []
-		for label_def in self.text_labels:
-			#draw_text_posit = '%s,%s' % (label_def['offset_x'], label_def['offset_y'],)
-			annotate_posit = '+%s+%s' % (label_def['offset_x'], label_def['offset_y'],)
-
-			# MAGIC_VALUES: ${filename}, ${slide_number}, and ${slide_count}.
-			#         NOTE: str.format() consumes starting $ or doesn't care.
-			label_text = label_def['label'].format(
-				filename=src_file,
-				slide_number=slide_index_text,
-				slide_count=self.slide_count,
-			)
-
-			label_opts += [
-				'-font', '"%s"' % (label_def['font_path'],),
-				'-style', label_def['font_style'],
-				'-weight', label_def['font_weight'],
-				'-fill', label_def['font_fill'],
-				'-stroke', label_def['font_stroke'],
-				'-pointsize', str(label_def['font_size']),
-				'-gravity', label_def['offset_gravity'],
-				# [lb] thinks -draw 'text x,y "string"' is an archaic command; also
-				#  '-draw', 'text %s "%s"' % (draw_text_posit, label_text,),
-				# works the same as:
-				'-annotate', annotate_posit, label_text,
-			]
+	def journal_path(self):
+		if self.shard is not None:
+			return os.path.join(self.args.target_dir, SHARD_JOURNAL_FMT % self.shard)
+		return os.path.join(self.args.target_dir, JOURNAL_NAME)
 
-		cmd_merge = [
-			# Oh ho ho it's imagemagick ya know.
-			'convert',
+	def journal_load(self, journal_path):
+		# Returns the render key of each output that the last run finished, by
+		# target name, for the RenderJob to skip.
+		entries = []
+		try:
+			with open(journal_path, 'r') as journal_f:
+				for line in journal_f:
+					try:
+						entries.append(json.loads(line))
+					except ValueError:
+						# The line we were writing when we crashed.
+						pass
+		except FileNotFoundError:
+			print('No journal to resume from, so starting over: "%s"' % (journal_path,))
+			return {}
+		# The slides are renamed into place before they're journaled, so they
+		# should be whole, but a system crash can still lose what hadn't been
+		# flushed to disk, so check the slides that were written last, which
+		# are the ones that could've been, going by how many we render at once.
+		recheck_count = self.args.jobs * 2 * self.args.batch_size
+		resumed = {}
+		cut_short = 0
+		for entry_i, entry in enumerate(entries):
+			outputs = entry['outputs']
+			if (entry_i >= len(entries) - recheck_count) and any(
+				header_util.image_complete(os.path.join(self.args.target_dir, out_name)) is False
+				for out_name in outputs
+			):
+				cut_short += 1
+				continue
+			resumed.update(outputs)
+		print(
+			'Resuming: %d slide(s) done already (re-checked the last %d, %d cut short).'
+			% (len(entries) - cut_short, min(recheck_count, len(entries)), cut_short,)
+		)
+		return resumed
 
-			# Resize (but don't stretch) the image (if extent_geom is set).
-			'-background', self.args.background_color,
-			'-size', self.args.extent_geom,
-			'-gravity', self.args.extent_gravity,
-			# NOTE: Order matters. If -resize comes before -extent, the
-			#       image is stretched.
-			'-extent', self.args.extent_geom,
-			'-resize', self.args.extent_geom,
+	def partials_remove(self, source_files):
+		# Remove any slides that a crashed run left half written.
+		target_dirs = set()
+		for src_file in source_files:
+			for target_name in self.plan.target_names(src_file):
+				target_dirs.add(os.path.join(self.args.target_dir, os.path.dirname(target_name)))
+		for target_dir in target_dirs:
+			try:
+				with os.scandir(target_dir) as entries:
+					for entry in entries:
+						if entry.name.startswith(PARTIAL_PREFIX):
+							os.unlink(entry.path)
+			except FileNotFoundError:
+				pass
+
+	def scan_source_files(self, rel_dir='', visited=None):
+		# Yield the relative path of each image under the source directory.
+		# NOTE: DirEntry knows if it's a file or a directory without a stat
+		#       (except for symlinks), so large directories scan quickly.
+		target_abs = os.path.abspath(self.args.target_dir)
+		scan_dir = os.path.join(self.args.source_dir, rel_dir)
+		# A symlink can lead back up the tree (e.g., src/loop -> ..), so
+		# scan each directory once, going by its device and inode.
+		if visited is None:
+			visited = set()
+		dir_stat = os.stat(scan_dir)
+		if (dir_stat.st_dev, dir_stat.st_ino,) in visited:
+			return
+		visited.add((dir_stat.st_dev, dir_stat.st_ino,))
+		with os.scandir(scan_dir) as entries:
+			for entry in entries:
+				rel_path = os.path.join(rel_dir, entry.name)
+				if entry.is_dir():
+					# Don't go rendering our own output, if it's under the source.
+					if self.args.recursive and (os.path.abspath(entry.path) != target_abs):
+						yield from self.scan_source_files(rel_path, visited)
+					continue
+				if not entry.is_file():
+					continue
+				if not self.is_wanted(rel_path):
+					continue
+				if not self.is_image_file(entry.name, lambda: self.read_leading_bytes(entry.path)):
+					continue
+				yield rel_path
+
+	def scan_archive_members(self, source_archive):
+		# Yield the name of each image in the archive, as scan_source_files
+		# would if it were extracted to a directory.
+		for member_name in source_archive.names():
+			if ('/' in member_name) and not self.args.recursive:
+				continue
+			if not self.is_wanted(member_name):
+				continue
+			if not self.is_image_file(
+				os.path.basename(member_name),
+				lambda: source_archive.leading_bytes(member_name, 16),
+			):
+				continue
+			yield member_name
+
+	def is_wanted(self, rel_path):
+		# True unless --include or --exclude says to skip it.
+		if self.args.include_glob and not any(
+			fnmatch.fnmatch(rel_path, glob) for glob in self.args.include_glob
+		):
+			return False
+		if self.args.exclude_glob and any(
+			fnmatch.fnmatch(rel_path, glob) for glob in self.args.exclude_glob
+		):
+			return False
+		return True
+
+	def read_leading_bytes(self, image_path):
+		with open(image_path, 'rb') as image_f:
+			return image_f.read(16)
+
+	def is_image_file(self, file_name, leading_bytes):
+		# The leading_bytes callable is only called (to read the file's first
+		# 16 bytes) with --sniff.
+		if not self.args.sniff:
+			return os.path.splitext(file_name)[1].lower() in IMAGE_EXTENSIONS
+		try:
+			leading_bytes = leading_bytes()
+		except (OSError, archive_util.ArchiveError):
+			return False
+		if leading_bytes.startswith(IMAGE_MAGIC):
+			return True
+		# WebP, AVIF and HEIC have their magic a few bytes in.
+		if leading_bytes.startswith(b'RIFF') and (leading_bytes[8:12] == b'WEBP'):
+			return True
+		if leading_bytes[4:8] == b'ftyp':
+			return True
+		# SVG is just text, so fall back on the extension.
+		return os.path.splitext(file_name)[1].lower() == '.svg'
+
+	def progress(self, msg):
+		with self.print_lock:
+			print(msg, flush=True)
+
+	# Instrumentation.
+
+	def stats_summary_print(self):
+		if (self.job is None) or not self.job.slide_stats:
+			return
+		summary = self.job.stats_summary()
+		def format_secs(secs):
+			try:
+				return time_util.time_format_scaled(secs)[0]
+			except NameError:
+				return '%.2f secs.' % (secs,)
+		def format_size(size):
+			for unit in ('B', 'KiB', 'MiB', 'GiB',):
+				if size < 1024:
+					break
+				size /= 1024
+			else:
+				unit = 'TiB'
+			return '%.1f %s' % (size, unit,)
+		print(
+			'Rendered %d slide(s), %s%s%s%d unchanged, at %s slides/sec.'
+			% (
+				summary['rendered'],
+				('%d copied as is, ' % (summary['copied'],)) if summary['copied'] else '',
+				('%d failed, ' % (summary['failed'],)) if summary['failed'] else '',
+				('%d resumed, ' % (summary['resumed'],)) if summary['resumed'] else '',
+				summary['unchanged'],
+				('%.1f' % (summary['slides_per_sec'],)) if summary['slides_per_sec'] else '?',
+			)
+		)
+		if summary['memory_limit'] and summary['memory_wait']['total']:
+			print(
+				'Waited %s for memory (%d%% of the %s budget at its peak).'
+				% (
+					format_secs(summary['memory_wait']['total']),
+					100 * summary['memory_peak'] / summary['memory_limit'],
+					format_size(summary['memory_limit']),
+				)
+			)
+		dedup = summary['dedup']
+		if dedup and dedup['inputs']:
+			print(
+				'Deduplicated %d slide(s) to %d source image(s): %d rendered from a cached base'
+				' (%s hit rate; the scan took %s).'
+				% (
+					dedup['inputs'],
+					dedup['sources'],
+					dedup['hits'],
+					('%d%%' % (100 * dedup['hit_rate'],)) if (dedup['hit_rate'] is not None) else '?',
+					format_secs(dedup['scan']),
+				)
+			)
+		render = summary['render']
+		if render['max'] is not None:
+			print(
+				'Slide render times: p50 %s / p95 %s / max %s'
+				% (
+					format_secs(render['p50']),
+					format_secs(render['p95']),
+					format_secs(render['max']),
+				)
+			)
 
-			# One or more sets of label options.
-			] + label_opts + [
+	def report_write(self):
+		if not self.args.report_path:
+			return
+		summary = self.job.stats_summary()
+		slide_stats = sorted(self.job.slide_stats, key=lambda stats: stats['slide_number'])
+		try:
+			with open(self.args.report_path, 'w') as report_f:
+				if self.args.report_path.endswith('.jsonl'):
+					for stats in slide_stats:
+						report_f.write(json.dumps(stats) + '\n')
+					report_f.write(json.dumps({'summary': summary}) + '\n')
+				else:
+					json.dump({'slides': slide_stats, 'summary': summary}, report_f, indent=1)
+					report_f.write('\n')
+		except OSError as err:
+			print(
+				'%s: warning: could not write the report: "%s": %s'
+				% (SCRIPT_NAME, self.args.report_path, err,)
+			)
 
-			# The source image we're manipulating.
-			source_path,
+	# Incremental rebuild manifest.
 
-			# Our target image we're creating.
-			target_path,
-		]
+	def manifest_path(self):
+		if self.shard is not None:
+			return os.path.join(self.args.target_dir, SHARD_MANIFEST_FMT % self.shard)
+		return os.path.join(self.args.target_dir, MANIFEST_NAME)
 
+	def manifest_load(self):
+		manifest_path = self.manifest_path()
 		try:
-			ret = subprocess.check_output(cmd_merge, stderr=subprocess.STDOUT)
-		except subprocess.CalledProcessError as err:
+			with open(manifest_path, 'r') as manifest_f:
+				manifest = json.load(manifest_f)
+			if manifest.get('version') != MANIFEST_VERSION:
+				# Different keys, so it'd be as good as empty anyway.
+				raise KeyError('version')
+			self.manifest_prev = manifest['slides']
+		except FileNotFoundError:
+			# No manifest, so every slide gets rendered (and overwritten).
+			self.manifest_prev = {}
+		except (ValueError, KeyError):
 			print(
-				'%s: error: the "convert" command failed: "%s" (%s) on file "%s"'
-				% (SCRIPT_NAME, err.output, err.returncode, src_file,)
+				'%s: warning: ignoring unreadable manifest: "%s"'
+				% (SCRIPT_NAME, manifest_path,)
 			)
-			sys.exit(1)
-
-		print(" ok.")
+			self.manifest_prev = {}
+
+	def manifest_save(self, prune):
+		if (not self.args.incremental) and (self.shard is None):
+			return
+		if prune:
+			# Remove the outputs of slides that are no longer in the deck.
+			# We only delete files that we know we made.
+			stale_names = set(self.job.manifest_prev) - set(self.job.manifest)
+			if self.deck_targets is not None:
+				# Leave the slides that moved to another shard to that shard.
+				stale_names -= self.deck_targets
+			for target_name in stale_names:
+				try:
+					os.unlink(os.path.join(self.args.target_dir, target_name))
+				except FileNotFoundError:
+					pass
+			slides = self.job.manifest
+		else:
+			# After a failure, remember the slides that are still good from
+			# the last run, too, since we never got around to checking them.
+			slides = dict(self.job.manifest_prev)
+			slides.update(self.job.manifest)
+		manifest = {'version': MANIFEST_VERSION, 'slides': slides}
+		if self.shard is not None:
+			# What --merge-shards needs to tell that the shard's all there.
+			manifest.update({
+				'shard': self.shard[0],
+				'shards': self.shard[1],
+				'first_index': self.job.first_index,
+				'slide_count': self.job.slide_count,
+				'inputs': list(self.job.inputs),
+				'outputs_per_slide': len(self.plan.target_names('')),
+				'complete': bool(prune),
+			})
+		self.manifest_write(self.manifest_path(), manifest)
+
+	def manifest_write(self, manifest_path, manifest):
+		manifest_temp = '%s.tmp' % (manifest_path,)
+		with open(manifest_temp, 'w') as manifest_f:
+			json.dump(manifest, manifest_f, indent=1, sort_keys=True)
+		os.replace(manifest_temp, manifest_path)
+
+	def shards_merge(self):
+		# Check that every shard rendered all of its slides, and that they
+		# all agree on the deck, then write the usual manifest, so the next
+		# run can be --incremental, sharded or not.
+		shard_n = self.args.merge_shards
+		problems = []
+		slides = {}
+		slide_count = None
+		for shard_i in range(1, shard_n + 1):
+			shard_name = SHARD_MANIFEST_FMT % (shard_i, shard_n,)
+			try:
+				with open(os.path.join(self.args.target_dir, shard_name)) as manifest_f:
+					manifest = json.load(manifest_f)
+			except FileNotFoundError:
+				problems.append('shard %d/%d has no manifest: "%s"' % (shard_i, shard_n, shard_name,))
+				continue
+			except ValueError as err:
+				problems.append('shard %d/%d has a bad manifest: %s' % (shard_i, shard_n, err,))
+				continue
+			if manifest.get('version') != MANIFEST_VERSION:
+				problems.append('shard %d/%d was made by another version of mdm2' % (shard_i, shard_n,))
+				continue
+			if not manifest.get('complete'):
+				problems.append('shard %d/%d did not finish' % (shard_i, shard_n,))
+			if slide_count is None:
+				slide_count = manifest['slide_count']
+			elif manifest['slide_count'] != slide_count:
+				problems.append(
+					'shard %d/%d saw %d slides, not %d: did the source change?'
+					% (shard_i, shard_n, manifest['slide_count'], slide_count,)
+				)
+			first_index, last_index = shard_range(slide_count, shard_i, shard_n)
+			# NOTE: Since the shards agree on the slide count, if each starts
+			#       where it should and has all its slides, they meet up.
+			if manifest['first_index'] != first_index:
+				problems.append(
+					'shard %d/%d starts at slide %d, not %d'
+					% (shard_i, shard_n, manifest['first_index'] + 1, first_index + 1,)
+				)
+			expected_outputs = len(manifest['inputs']) * manifest['outputs_per_slide']
+			if (
+				(len(manifest['inputs']) != (last_index - first_index))
+				or (len(manifest['slides']) != expected_outputs)
+			):
+				rendered = len(manifest['slides']) // max(manifest['outputs_per_slide'], 1)
+				problems.append(
+					'shard %d/%d rendered %d of its %d slides'
+					% (shard_i, shard_n, rendered, last_index - first_index,)
+				)
+			for target_name in manifest['slides']:
+				if target_name in slides:
+					problems.append('shard %d/%d also rendered "%s"' % (shard_i, shard_n, target_name,))
+				elif not os.path.exists(os.path.join(self.args.target_dir, target_name)):
+					problems.append('shard %d/%d is missing "%s"' % (shard_i, shard_n, target_name,))
+			slides.update(manifest['slides'])
+
+		if problems:
+			for problem in problems:
+				print('%s: error: %s' % (SCRIPT_NAME, problem,))
+			return 1
+		manifest_path = os.path.join(self.args.target_dir, MANIFEST_NAME)
+		self.manifest_write(manifest_path, {'version': MANIFEST_VERSION, 'slides': slides})
+		print(
+			'Merged %d shards of %d slides (%d files) into %s'
+			% (shard_n, slide_count, len(slides), manifest_path,)
+		)
+		return 0
 
 	# Main app wrapper.
 
 	def main(self):
 		self.parser_run()
-		self.process_images()
+		if self.args.merge_shards is not None:
+			sys.exit(self.shards_merge())
+		if self.args.serve is not None:
+			self.serve()
+			return
+		if self.args.watch:
+			self.watch_images()
+		else:
+			self.process_images()
 		self.done()
 
 if __name__ == '__main__':
 	numbrr_cli = MDM2_CLI()
 	numbrr_cli.main()
-
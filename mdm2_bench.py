@@ -0,0 +1,715 @@
+#!/usr/bin/env python3
+
+# Copyright © 2015 Landon Bouma. All rights reserved.
+#
+# Permission is hereby granted,  free of charge,  to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge,  publish,  distribute, sublicense,
+# and/or  sell copies  of the Software,  and to permit persons  to whom the
+# Software  is  furnished  to do so,  subject  to  the following conditions:
+#
+# The  above  copyright  notice  and  this  permission  notice  shall  be
+# included  in  all  copies  or  substantial  portions  of  the  Software.
+#
+# THE  SOFTWARE  IS  PROVIDED  "AS IS",  WITHOUT  WARRANTY  OF ANY KIND,
+# EXPRESS OR IMPLIED,  INCLUDING  BUT NOT LIMITED  TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE  FOR ANY
+# CLAIM,  DAMAGES OR OTHER LIABILITY,  WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE,  ARISING FROM,  OUT OF  OR IN  CONNECTION WITH THE
+# SOFTWARE   OR   THE   USE   OR   OTHER   DEALINGS  IN   THE  SOFTWARE.
+
+# Benchmark mdm2 against synthetic slide decks.
+#
+# E.g., to compare the engines on 100 and 1000 small PNGs:
+#
+#   ./mdm2_bench.py --count 100,1000 --format png --engine convert,pillow
+#
+# Each scenario runs mdm2.py end to end in its own process, so the numbers
+# include interpreter startup, and we can measure the peak memory of that
+# process and its convert children. The decks are generated once and kept
+# (under the --work-dir) for the next run.
+#
+# To check mdm2's fixed cost instead, which is most of the runtime for a
+# small deck, run:
+#
+#   ./mdm2_bench.py --startup --repeat 10
+#
+# And to compare the latency of one slide from mdm2 --serve against a
+# one-shot run of mdm2 per slide:
+#
+#   ./mdm2_bench.py --serve-requests 200
+#
+# And to check that the pillow engine draws the same slides as convert (the
+# same size and mode, the labels in the same place, and the pixels within a
+# tolerance), and how much faster it is:
+#
+#   ./mdm2_bench.py --compare-engines --count 100 --resolution 640x480
+
+SCRIPT_DESCRIPTION = 'Many Doge Meme Maker benchmark'
+
+import os
+import sys
+
+import argparse
+import itertools
+import json
+import shutil
+import struct
+import subprocess
+import tempfile
+import time
+import zlib
+
+try:
+	import time_util
+except ImportError:
+	pass
+
+try:
+	from PIL import Image
+	from PIL import ImageChops
+	from PIL import ImageStat
+except ImportError:
+	Image = None
+
+SCRIPT_NAME = os.path.basename(__file__)
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# The labels we cycle through, after the README example, and then some.
+BENCH_LABELS = (
+	('north', 30, 0, 20, 'My Design Presentation',),
+	('southeast', 14, 85, 52, '{filename}',),
+	('southeast', 30, 80, 12, '{slide_number} / {slide_count}',),
+	('northwest', 16, 10, 10, 'Draft',),
+	('northeast', 16, 10, 10, '{slide_number}',),
+	('southwest', 12, 10, 10, 'Confidential',),
+	('west', 20, 10, 0, '{filename}',),
+	('east', 20, 10, 0, 'Many Doge',),
+	('center', 40, 0, 0, 'such slide',),
+	('south', 18, 0, 30, 'very label {slide_number}',),
+)
+
+def png_chunk(chunk_type, data):
+	chunk = chunk_type + data
+	return (
+		struct.pack('>I', len(data))
+		+ chunk
+		+ struct.pack('>I', zlib.crc32(chunk) & 0xffffffff)
+	)
+
+def png_bytes(width, height, rows):
+	# A minimal 8-bit RGB PNG. Each row is already prefixed by its filter byte.
+	return b''.join([
+		b'\x89PNG\r\n\x1a\n',
+		png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)),
+		png_chunk(b'IDAT', zlib.compress(b''.join(rows), 6)),
+		png_chunk(b'IEND', b''),
+	])
+
+def base_rows(width, height):
+	# A diagonal gradient with some banding, so that the images compress
+	# about as well as a typical screenshot would, and not infinitely well.
+	rows = []
+	for y in range(height):
+		row = bytearray(width * 3)
+		for x in range(width):
+			row[x * 3] = (x * 255 // max(1, width - 1)) & 0xff
+			row[x * 3 + 1] = (y * 255 // max(1, height - 1)) & 0xff
+			row[x * 3 + 2] = ((x ^ y) * 7) & 0xff
+		rows.append(b'\x00' + bytes(row))
+	return rows
+
+def diff_box(image_a, image_b):
+	# Where the two images differ, in any band. (An RGBA image's getbbox
+	# only looks at its alpha.)
+	bands = ImageChops.difference(image_a, image_b).split()
+	diff_mask = bands[0]
+	for band in bands[1:]:
+		diff_mask = ImageChops.lighter(diff_mask, band)
+	return diff_mask.getbbox()
+
+class MDM2_Bench(argparse.ArgumentParser):
+
+	def __init__(self, description=None, **kwargs):
+		super(MDM2_Bench, self).__init__(
+			description=description or SCRIPT_DESCRIPTION,
+			**kwargs)
+		self.args = None
+		self.results = []
+
+	def parser_prepare(self):
+		# Comma-separated values run every combination.
+		self.add_argument('-n', '--count', dest='counts',
+			type=str, metavar='COUNTS', default='100',
+			help='The number of slides per deck, e.g., "10,100,10000".')
+		self.add_argument('--resolution', dest='resolutions',
+			type=str, metavar='WxH', default='1280x720',
+			help='The size of the synthetic slides, e.g., "640x480,1920x1080".')
+		self.add_argument('--format', dest='formats',
+			type=str, metavar='FORMATS', default='png',
+			help='The synthetic slide format(s): png, jpeg, webp.')
+		self.add_argument('--labels', dest='label_counts',
+			type=str, metavar='LABELS', default='3',
+			help='The number of labels per slide, 1 to 10.')
+		self.add_argument('--engine', dest='engines',
+			type=str, metavar='ENGINES', default='convert',
+			help='The mdm2 --engine(s) to run.')
+		self.add_argument('-j', '--jobs', dest='jobs',
+			type=str, metavar='JOBS', default=str(os.cpu_count() or 1),
+			help='The mdm2 --jobs to run with.')
+		self.add_argument('-b', '--batch-size', dest='batch_sizes',
+			type=str, metavar='BATCH_SIZES', default='1',
+			help='The mdm2 --batch-size(s) to run with.')
+		self.add_argument('--extent', dest='extent',
+			action='store_true', default=False,
+			help='Enlarge the canvas with a black border, like the README example.')
+		self.add_argument('-f', '--font', dest='font_path',
+			type=str, metavar='FONT_PATH', default=None,
+			help='The font to use, if mdm2 cannot find its default font.')
+		self.add_argument('--repeat', dest='repeat',
+			type=int, metavar='REPEAT', default=1,
+			help='How many times to run each scenario.')
+		self.add_argument('--work-dir', dest='work_dir',
+			type=str, metavar='WORK_DIR',
+			default=os.path.join(tempfile.gettempdir(), 'mdm2-bench'),
+			help='Where to keep the synthetic decks and the rendered output.')
+		self.add_argument('--startup', dest='startup',
+			action='store_true', default=False,
+			help='Measure the startup overhead of `mdm2.py --help` and of a one-slide deck instead.')
+		self.add_argument('--startup-budget', dest='startup_budget',
+			type=float, metavar='MSECS', default=100.0,
+			help='With --startup, fail if the overhead is over this many milliseconds.')
+		self.add_argument('--serve-requests', dest='serve_requests',
+			type=int, metavar='REQUESTS', default=0,
+			help='Measure the latency of this many one-slide requests to mdm2 --serve instead.')
+		self.add_argument('--compare-engines', dest='compare_engines',
+			action='store_true', default=False,
+			help='Render the same deck with convert and pillow, and compare the slides instead.')
+		self.add_argument('--pixel-tolerance', dest='pixel_tolerance',
+			type=float, metavar='LEVELS', default=16.0,
+			help='With --compare-engines, the most the labels may differ, on average,'
+				' in 0-255 levels per channel.')
+		self.add_argument('--placement-tolerance', dest='placement_tolerance',
+			type=int, metavar='PIXELS', default=4,
+			help='With --compare-engines, the most pixels the labels may be moved by.')
+		self.add_argument('--min-speedup', dest='min_speedup',
+			type=float, metavar='RATIO', default=5.0,
+			help='With --compare-engines, fail if pillow is not this many times as fast.')
+		self.add_argument('-o', '--output', dest='output_path',
+			type=str, metavar='OUTPUT_FILE', default=None,
+			help='Also write the results as JSON to this file.')
+
+	def parser_verify(self):
+		ok = True
+		try:
+			self.counts = [int(count) for count in self.args.counts.split(',')]
+			self.label_counts = [int(count) for count in self.args.label_counts.split(',')]
+			self.jobs = [int(jobs) for jobs in self.args.jobs.split(',')]
+			self.batch_sizes = [int(size) for size in self.args.batch_sizes.split(',')]
+			self.resolutions = [
+				tuple(int(dim) for dim in resolution.split('x'))
+				for resolution in self.args.resolutions.split(',')
+			]
+		except ValueError as err:
+			print('%s: error: expected a number: %s' % (SCRIPT_NAME, err,))
+			return False
+		self.formats = self.args.formats.lower().split(',')
+		self.engines = self.args.engines.lower().split(',')
+		for image_format in self.formats:
+			if image_format not in ('png', 'jpeg', 'webp',):
+				print('%s: error: unknown format: "%s"' % (SCRIPT_NAME, image_format,))
+				ok = False
+			elif (image_format != 'png') and (Image is None) and not shutil.which('convert'):
+				print(
+					'%s: error: making %s images needs Pillow or ImageMagick'
+					% (SCRIPT_NAME, image_format,)
+				)
+				ok = False
+		if self.args.compare_engines and (Image is None):
+			print('%s: error: comparing the engines needs Pillow' % (SCRIPT_NAME,))
+			ok = False
+		for label_count in self.label_counts:
+			if not (1 <= label_count <= len(BENCH_LABELS)):
+				print(
+					'%s: error: the number of labels should be 1 to %d: %d'
+					% (SCRIPT_NAME, len(BENCH_LABELS), label_count,)
+				)
+				ok = False
+		return ok
+
+	# Synthetic decks.
+
+	def make_deck(self, count, resolution, image_format):
+		width, height = resolution
+		deck_dir = os.path.join(
+			self.args.work_dir, 'deck-%s-%dx%d-%d' % (image_format, width, height, count,),
+		)
+		if os.path.isdir(deck_dir):
+			return deck_dir
+		print('Making %d %dx%d %s slides...' % (count, width, height, image_format,))
+		building_dir = deck_dir + '.tmp'
+		shutil.rmtree(building_dir, ignore_errors=True)
+		os.makedirs(building_dir)
+		rows = base_rows(width, height)
+		num_width = len(str(count))
+		for slide_i in range(count):
+			# Shift the rows so that each slide is a little different.
+			shift = (slide_i * 7) % height
+			slide_rows = rows[shift:] + rows[:shift]
+			slide_name = '%0*d00.Synthetic.slide.%s' % (
+				num_width, slide_i + 1, 'jpg' if image_format == 'jpeg' else image_format,
+			)
+			slide_path = os.path.join(building_dir, slide_name)
+			png_data = png_bytes(width, height, slide_rows)
+			if image_format == 'png':
+				with open(slide_path, 'wb') as slide_f:
+					slide_f.write(png_data)
+			elif Image is not None:
+				image = Image.frombytes('RGB', (width, height),
+					b''.join(row[1:] for row in slide_rows))
+				image.save(slide_path)
+			else:
+				subprocess.run(['convert', 'png:-', slide_path], input=png_data, check=True)
+		os.rename(building_dir, deck_dir)
+		return deck_dir
+
+	# Scenarios.
+
+	def mdm2_command(self, deck_dir, target_dir, report_path, scenario):
+		cmd_mdm2 = [
+			sys.executable, os.path.join(SCRIPT_DIR, 'mdm2.py'),
+			'-s', deck_dir,
+			'-t', target_dir,
+			'--engine', scenario['engine'],
+			'--jobs', str(scenario['jobs']),
+			'--batch-size', str(scenario['batch_size']),
+			'--report', report_path,
+		]
+		return cmd_mdm2 + self.label_options(scenario)
+
+	def label_options(self, scenario):
+		width, height = scenario['resolution']
+		cmd_mdm2 = []
+		if self.args.extent:
+			cmd_mdm2 += [
+				'--extent', '%dx%d+0+8' % (int(width * 1.14), int(height * 1.17),),
+				'--background', 'black',
+			]
+		if self.args.font_path:
+			cmd_mdm2 += ['-f', self.args.font_path]
+		for gravity, size, off_x, off_y, label in BENCH_LABELS[:scenario['labels']]:
+			cmd_mdm2 += [
+				'--gravity', gravity,
+				'--fill', 'white',
+				'--stroke', 'white',
+				'--size', str(size),
+				'-x', str(off_x),
+				'-y', str(off_y),
+				'-l', label,
+			]
+		return cmd_mdm2
+
+	def run_scenario(self, scenario, target_dir=None):
+		# The output is thrown away, unless the caller wants it in target_dir.
+		deck_dir = self.make_deck(
+			scenario['count'], scenario['resolution'], scenario['format'],
+		)
+		keep_output = target_dir is not None
+		target_dir = target_dir or os.path.join(self.args.work_dir, 'output')
+		report_path = os.path.join(self.args.work_dir, 'report.json')
+		shutil.rmtree(target_dir, ignore_errors=True)
+		cmd_mdm2 = self.mdm2_command(deck_dir, target_dir, report_path, scenario)
+		time_0 = time.perf_counter()
+		with open(os.devnull, 'w') as devnull:
+			mdm2_proc = subprocess.Popen(cmd_mdm2, stdout=devnull, stderr=subprocess.STDOUT)
+			# wait4 reports the peak RSS of mdm2 or of any of its convert
+			# children, whichever was largest.
+			pid, status, rusage = os.wait4(mdm2_proc.pid, 0)
+			mdm2_proc.returncode = os.waitstatus_to_exitcode(status)
+		elapsed = time.perf_counter() - time_0
+		result = dict(scenario)
+		result['resolution'] = '%dx%d' % scenario['resolution']
+		result['ok'] = (mdm2_proc.returncode == 0)
+		result['elapsed'] = elapsed
+		result['slides_per_sec'] = scenario['count'] / elapsed if elapsed > 0 else None
+		# Linux reports ru_maxrss in kilobytes.
+		result['peak_rss_mb'] = rusage.ru_maxrss / 1024.0
+		result['stages'] = {}
+		try:
+			with open(report_path, 'r') as report_f:
+				summary = json.load(report_f)['summary']
+			for stage in ('queue_wait', 'decode', 'render', 'write',):
+				result['stages'][stage] = summary[stage]
+			result['bytes_in'] = summary['bytes_in']
+			result['bytes_out'] = summary['bytes_out']
+		except (OSError, ValueError, KeyError):
+			pass
+		if not keep_output:
+			shutil.rmtree(target_dir, ignore_errors=True)
+		return result
+
+	# Startup overhead.
+
+	def time_command(self, cmd_run):
+		# Returns the wall time of the fastest of --repeat runs, which is the
+		# one least disturbed by whatever else the machine was doing.
+		best = None
+		for repeat_i in range(max(1, self.args.repeat)):
+			time_0 = time.perf_counter()
+			with open(os.devnull, 'w') as devnull:
+				ret = subprocess.run(cmd_run, stdout=devnull, stderr=subprocess.STDOUT)
+			elapsed = time.perf_counter() - time_0
+			if ret.returncode != 0:
+				return None
+			best = elapsed if best is None else min(best, elapsed)
+		return best
+
+	def run_startup(self):
+		# The overhead is what mdm2 costs on top of starting Python, and, for
+		# the one-slide deck, on top of the time convert spends rendering it.
+		scenario = {
+			'count': 1,
+			'resolution': self.resolutions[0],
+			'format': self.formats[0],
+			'labels': self.label_counts[0],
+			'engine': self.engines[0],
+			'jobs': 1,
+			'batch_size': 1,
+		}
+		deck_dir = self.make_deck(1, scenario['resolution'], scenario['format'])
+		target_dir = os.path.join(self.args.work_dir, 'output')
+		report_path = os.path.join(self.args.work_dir, 'report.json')
+		cmd_slide = self.mdm2_command(deck_dir, target_dir, report_path, scenario)
+		baseline = self.time_command([sys.executable, '-c', 'pass'])
+		help_secs = self.time_command([sys.executable, os.path.join(SCRIPT_DIR, 'mdm2.py'), '--help'])
+		slide_secs = None
+		render_secs = 0.0
+		for repeat_i in range(max(1, self.args.repeat)):
+			shutil.rmtree(target_dir, ignore_errors=True)
+			time_0 = time.perf_counter()
+			with open(os.devnull, 'w') as devnull:
+				ret = subprocess.run(cmd_slide, stdout=devnull, stderr=subprocess.STDOUT)
+			elapsed = time.perf_counter() - time_0
+			if ret.returncode != 0:
+				slide_secs = None
+				break
+			try:
+				with open(report_path, 'r') as report_f:
+					render = json.load(report_f)['summary']['render']['max'] or 0.0
+			except (OSError, ValueError, KeyError):
+				render = 0.0
+			if (slide_secs is None) or ((elapsed - render) < (slide_secs - render_secs)):
+				slide_secs, render_secs = elapsed, render
+		shutil.rmtree(target_dir, ignore_errors=True)
+
+		ok = True
+		result = {'startup': True, 'budget_ms': self.args.startup_budget}
+		for name, secs, less in (
+			('help', help_secs, 0.0,),
+			('one_slide', slide_secs, render_secs,),
+		):
+			if (secs is None) or (baseline is None):
+				print('%-9s FAILED' % (name,))
+				result[name + '_overhead_ms'] = None
+				ok = False
+				continue
+			overhead_ms = (secs - baseline - less) * 1000.0
+			result[name + '_overhead_ms'] = overhead_ms
+			within = overhead_ms <= self.args.startup_budget
+			ok = ok and within
+			print(
+				'%-9s overhead: %6.1f ms  (budget: %.0f ms)  %s'
+				% (name, overhead_ms, self.args.startup_budget, 'ok' if within else 'OVER',)
+			)
+		result['ok'] = ok
+		self.results.append(result)
+		return ok
+
+	# Server latency.
+
+	def run_serve(self):
+		import serve_util
+		scenario = {
+			'count': 1,
+			'resolution': self.resolutions[0],
+			'format': self.formats[0],
+			'labels': self.label_counts[0],
+			'engine': self.engines[0],
+			'jobs': 1,
+			'batch_size': 1,
+		}
+		deck_dir = self.make_deck(1, scenario['resolution'], scenario['format'])
+		slide_path = os.path.join(deck_dir, sorted(os.listdir(deck_dir))[0])
+		target_dir = os.path.join(self.args.work_dir, 'output')
+		report_path = os.path.join(self.args.work_dir, 'report.json')
+		address = 'unix:%s' % (os.path.join(self.args.work_dir, 'mdm2.sock'),)
+
+		# The one-shot baseline: a whole mdm2 run for the one slide.
+		cmd_oneshot = self.mdm2_command(deck_dir, target_dir, report_path, scenario)
+		oneshot = []
+		for repeat_i in range(max(1, self.args.repeat)):
+			shutil.rmtree(target_dir, ignore_errors=True)
+			time_0 = time.perf_counter()
+			with open(os.devnull, 'w') as devnull:
+				ret = subprocess.run(cmd_oneshot, stdout=devnull, stderr=subprocess.STDOUT)
+			if ret.returncode == 0:
+				oneshot.append(time.perf_counter() - time_0)
+		shutil.rmtree(target_dir, ignore_errors=True)
+
+		cmd_serve = [
+			sys.executable, os.path.join(SCRIPT_DIR, 'mdm2.py'),
+			'--serve', address,
+			'--engine', scenario['engine'],
+		] + self.label_options(scenario)
+		with open(os.devnull, 'w') as devnull:
+			serve_proc = subprocess.Popen(cmd_serve, stdout=devnull, stderr=subprocess.STDOUT)
+		latencies = []
+		failures = 0
+		try:
+			# Wait for the server to come up.
+			for wait_i in range(100):
+				try:
+					conn = serve_util.connect(address, timeout=5)
+					conn.request('GET', '/health')
+					conn.getresponse().read()
+					conn.close()
+					break
+				except OSError:
+					time.sleep(0.1)
+			request_body = json.dumps({'source': slide_path})
+			for request_i in range(self.args.serve_requests):
+				time_0 = time.perf_counter()
+				conn = serve_util.connect(address, timeout=60)
+				conn.request('POST', '/render', body=request_body)
+				response = conn.getresponse()
+				response.read()
+				conn.close()
+				if response.status == 200:
+					latencies.append(time.perf_counter() - time_0)
+				else:
+					failures += 1
+		finally:
+			serve_proc.terminate()
+			serve_proc.wait()
+
+		latencies.sort()
+		oneshot.sort()
+		def rank(ordered, pct):
+			return ordered[max(1, int(-(-pct * len(ordered) // 100))) - 1] if ordered else None
+		result = {
+			'serve': True,
+			'engine': scenario['engine'],
+			'requests': self.args.serve_requests,
+			'failures': failures,
+			'serve_p50': rank(latencies, 50),
+			'serve_p99': rank(latencies, 99),
+			'oneshot_p50': rank(oneshot, 50),
+			'ok': bool(latencies) and bool(oneshot) and not failures,
+		}
+		self.results.append(result)
+		if not result['ok']:
+			print('serve     FAILED (%d of %d requests failed)' % (failures, self.args.serve_requests,))
+			return False
+		print(
+			'serve     p50: %6.1f ms  p99: %6.1f ms  vs. one-shot p50: %6.1f ms  (p99 is %.0f%%)'
+			% (
+				result['serve_p50'] * 1000.0, result['serve_p99'] * 1000.0,
+				result['oneshot_p50'] * 1000.0, 100.0 * result['serve_p99'] / result['oneshot_p50'],
+			)
+		)
+		return True
+
+	# Engine equivalence.
+
+	def run_compare(self):
+		# Render the deck with each engine, and then again with no label text,
+		# so we can tell where each engine put the labels (wherever the slide
+		# differs from its unlabeled canvas).
+		scenario = {
+			'count': self.counts[0],
+			'resolution': self.resolutions[0],
+			'format': self.formats[0],
+			'labels': self.label_counts[0],
+			'jobs': self.jobs[0],
+			'batch_size': 1,
+		}
+		deck_dir = self.make_deck(scenario['count'], scenario['resolution'], scenario['format'])
+		report_path = os.path.join(self.args.work_dir, 'report.json')
+		outputs = {}
+		speeds = {}
+		for engine in ('convert', 'pillow',):
+			scenario['engine'] = engine
+			labeled_dir = os.path.join(self.args.work_dir, 'compare-%s' % (engine,))
+			blank_dir = os.path.join(self.args.work_dir, 'compare-%s-blank' % (engine,))
+			for target_dir in (labeled_dir, blank_dir,):
+				shutil.rmtree(target_dir, ignore_errors=True)
+			result = self.run_scenario(scenario, target_dir=labeled_dir)
+			self.print_result(result)
+			cmd_blank = self.mdm2_command(deck_dir, blank_dir, report_path, dict(scenario, labels=0))
+			with open(os.devnull, 'w') as devnull:
+				ret = subprocess.run(cmd_blank + ['-l', ''], stdout=devnull, stderr=subprocess.STDOUT)
+			if not result['ok'] or (ret.returncode != 0):
+				print('compare   FAILED (the %s engine could not render the deck)' % (engine,))
+				self.results.append({'compare': True, 'ok': False})
+				return False
+			outputs[engine] = (labeled_dir, blank_dir,)
+			speeds[engine] = result['slides_per_sec']
+
+		worst = {'pixels': 0.0, 'placement': 0, 'mismatched': 0}
+		for slide_name in sorted(os.listdir(outputs['convert'][0])):
+			slide_diff = self.compare_slide(
+				*[os.path.join(out_dir, slide_name) for out_dir in outputs['convert'] + outputs['pillow']]
+			)
+			if slide_diff is None:
+				worst['mismatched'] += 1
+				continue
+			worst['pixels'] = max(worst['pixels'], slide_diff['pixels'])
+			worst['placement'] = max(worst['placement'], slide_diff['placement'])
+		for out_dirs in outputs.values():
+			for out_dir in out_dirs:
+				shutil.rmtree(out_dir, ignore_errors=True)
+
+		speedup = speeds['pillow'] / speeds['convert'] if speeds['convert'] else None
+		result = {
+			'compare': True,
+			'count': scenario['count'],
+			'mismatched': worst['mismatched'],
+			'pixel_diff': worst['pixels'],
+			'placement_diff': worst['placement'],
+			'speedup': speedup,
+		}
+		result['ok'] = (
+			(not worst['mismatched'])
+			and (worst['pixels'] <= self.args.pixel_tolerance)
+			and (worst['placement'] <= self.args.placement_tolerance)
+			and (speedup is not None) and (speedup >= self.args.min_speedup)
+		)
+		self.results.append(result)
+		print(
+			'compare   %d slides: %d mismatched size/mode, worst label diff: %.1f levels (tolerance: %.1f),'
+			' worst placement: %d px (tolerance: %d)'
+			% (
+				scenario['count'], worst['mismatched'],
+				worst['pixels'], self.args.pixel_tolerance,
+				worst['placement'], self.args.placement_tolerance,
+			)
+		)
+		print(
+			'compare   pillow is %.1fx as fast as convert (target: %.1fx)  %s'
+			% (speedup or 0.0, self.args.min_speedup, 'ok' if result['ok'] else 'FAILED',)
+		)
+		return result['ok']
+
+	def compare_slide(self, convert_path, convert_blank, pillow_path, pillow_blank):
+		# Returns how far apart the engines' slides are, or None if they're
+		# not even the same size and mode (or one's missing).
+		try:
+			convert_image = Image.open(convert_path)
+			pillow_image = Image.open(pillow_path)
+			if (
+				(convert_image.size != pillow_image.size)
+				or (convert_image.mode != pillow_image.mode)
+			):
+				return None
+			convert_image = convert_image.convert('RGBA')
+			pillow_image = pillow_image.convert('RGBA')
+			convert_box = diff_box(convert_image, Image.open(convert_blank).convert('RGBA'))
+			pillow_box = diff_box(pillow_image, Image.open(pillow_blank).convert('RGBA'))
+		except (OSError, ValueError):
+			return None
+		if (convert_box is None) or (pillow_box is None):
+			# Labels on one, but not the other, are as misplaced as can be.
+			placement = 0 if (convert_box == pillow_box) else max(convert_image.size)
+			label_box = convert_box or pillow_box
+		else:
+			placement = max(abs(edge_a - edge_b) for edge_a, edge_b in zip(convert_box, pillow_box))
+			label_box = (
+				min(convert_box[0], pillow_box[0]), min(convert_box[1], pillow_box[1]),
+				max(convert_box[2], pillow_box[2]), max(convert_box[3], pillow_box[3]),
+			)
+		pixels = 0.0
+		if label_box is not None:
+			# Compare where the labels are, since the rest is mostly the same.
+			label_diff = ImageChops.difference(convert_image.crop(label_box), pillow_image.crop(label_box))
+			pixels = max(ImageStat.Stat(label_diff).mean)
+		return {'pixels': pixels, 'placement': placement}
+
+	def print_result(self, result):
+		def format_secs(secs):
+			if secs is None:
+				return '-'
+			try:
+				return time_util.time_format_scaled(secs)[0]
+			except NameError:
+				return '%.2f secs.' % (secs,)
+		print(
+			'%-7s %6d x %-9s %-4s labels: %2d jobs: %2d batch: %3d  %s  %8.1f slides/sec'
+			'  peak RSS: %7.1f MB  elapsed: %s'
+			% (
+				result['engine'], result['count'], result['resolution'], result['format'],
+				result['labels'], result['jobs'], result['batch_size'],
+				'ok    ' if result['ok'] else 'FAILED',
+				result['slides_per_sec'] or 0.0, result['peak_rss_mb'],
+				format_secs(result['elapsed']),
+			)
+		)
+		render = result['stages'].get('render')
+		if render and (render['p50'] is not None):
+			print(
+				'        render p50: %s p95: %s max: %s'
+				% (format_secs(render['p50']), format_secs(render['p95']), format_secs(render['max']),)
+			)
+
+	def run(self):
+		os.makedirs(self.args.work_dir, exist_ok=True)
+		if self.args.compare_engines:
+			ok = self.run_compare()
+			self.results_write()
+			return ok
+		if self.args.startup or self.args.serve_requests:
+			ok = True
+			if self.args.startup:
+				ok = self.run_startup() and ok
+			if self.args.serve_requests:
+				ok = self.run_serve() and ok
+			self.results_write()
+			return ok
+		for count, resolution, image_format, labels, engine, jobs, batch_size in itertools.product(
+			self.counts, self.resolutions, self.formats, self.label_counts,
+			self.engines, self.jobs, self.batch_sizes,
+		):
+			scenario = {
+				'count': count,
+				'resolution': resolution,
+				'format': image_format,
+				'labels': labels,
+				'engine': engine,
+				'jobs': jobs,
+				'batch_size': batch_size,
+			}
+			for repeat_i in range(self.args.repeat):
+				result = self.run_scenario(scenario)
+				self.print_result(result)
+				self.results.append(result)
+		self.results_write()
+		return all(result['ok'] for result in self.results)
+
+	def results_write(self):
+		if self.args.output_path:
+			with open(self.args.output_path, 'w') as output_f:
+				json.dump({'results': self.results}, output_f, indent=1)
+				output_f.write('\n')
+
+	def main(self):
+		self.parser_prepare()
+		self.args = self.parse_args()
+		if not self.parser_verify():
+			sys.exit(1)
+		if not self.run():
+			sys.exit(1)
+
+if __name__ == '__main__':
+	bench = MDM2_Bench()
+	bench.main()
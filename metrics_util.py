@@ -0,0 +1,198 @@
+# Copyright © 2015 Landon Bouma. All rights reserved.
+#
+# Permission is hereby granted,  free of charge,  to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge,  publish,  distribute, sublicense,
+# and/or  sell copies  of the Software,  and to permit persons  to whom the
+# Software  is  furnished  to do so,  subject  to  the following conditions:
+#
+# The  above  copyright  notice  and  this  permission  notice  shall  be
+# included  in  all  copies  or  substantial  portions  of  the  Software.
+#
+# THE  SOFTWARE  IS  PROVIDED  "AS IS",  WITHOUT  WARRANTY  OF ANY KIND,
+# EXPRESS OR IMPLIED,  INCLUDING  BUT NOT LIMITED  TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE  FOR ANY
+# CLAIM,  DAMAGES OR OTHER LIABILITY,  WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE,  ARISING FROM,  OUT OF  OR IN  CONNECTION WITH THE
+# SOFTWARE   OR   THE   USE   OR   OTHER   DEALINGS  IN   THE  SOFTWARE.
+
+
+# How big a label's text comes out, at a given font and point size, so a
+# label can be fit to a box (--autofit) by a binary search over the sizes.
+# Each measurement costs a convert (or, for the pillow engine, a FreeType
+# layout), so they're remembered, in ~/.cache/mdm2/text-metrics.json, for
+# this and later runs, which tend to see the same labels (and filenames).
+# The cache is keyed by the font file (and its mtime and size) and by the
+# engine (and its version), since they don't all measure alike.
+
+import json
+import os
+import subprocess
+import threading
+
+import probe_util
+
+METRICS_VERSION = 1
+
+# The most measurements to remember; past that, the oldest are forgotten.
+MAX_METRICS = 100000
+
+class MetricsError(Exception):
+	pass
+
+def cache_path():
+	return os.path.join(probe_util.cache_dir(), 'text-metrics.json')
+
+def font_options(font_path, font_style, font_weight):
+	'''
+	>>> font_options('/fonts/Open Sans.ttf', 'Normal', 'Bold')
+	['-font', '/fonts/Open Sans.ttf', '-style', 'Normal', '-weight', 'Bold']
+	'''
+	# The convert options that pick the font, for drawing a label, and for
+	# measuring it, which had better pick the same one. (It's an argv, so
+	# the path isn't quoted, even if it has spaces.)
+	return ['-font', font_path, '-style', font_style, '-weight', font_weight]
+
+def convert_text_size(font_path, font_style, font_weight, font_size, text):
+	# ImageMagick's label: is as big as the text it draws, which is the same
+	# text, at the same size, as -annotate would draw.
+	try:
+		size_text = subprocess.check_output(
+			[
+				'convert',
+				] + font_options(font_path, font_style, font_weight) + [
+				'-pointsize', str(font_size),
+				'label:%s' % (text,),
+				'-format', '%w %h',
+				'info:',
+			],
+			stderr=subprocess.PIPE,
+		)
+		width, height = size_text.split()
+		return int(width), int(height)
+	except (OSError, ValueError, subprocess.CalledProcessError) as err:
+		raise MetricsError('could not measure "%s" at %d points: %s' % (text, font_size, err,))
+
+class TextMetrics(object):
+	# The measure callable takes the font_path, font_style, font_weight,
+	# font_size and text, and returns the text's (width, height) in pixels.
+	# The engine names the measure, e.g., with the ImageMagick version.
+	#
+	# NOTE: The workers share one TextMetrics. Two of them might measure the
+	#       same text at once, but they'd get the same answer.
+
+	def __init__(self, measure, engine, metrics_path=None):
+		self.measure = measure
+		self.engine = engine
+		self.metrics_path = metrics_path or cache_path()
+		self.lock = threading.Lock()
+		# The measurements, by key, loaded the first time we need them, and
+		# the ones we've made since, to add to the cache file.
+		self.metrics = None
+		self.added = {}
+		self.font_stamps = {}
+		# The fitted size, by label and box, for the labels that are the
+		# same on every slide.
+		self.fits = {}
+		self.hits = 0
+		self.misses = 0
+
+	def metrics_read(self):
+		try:
+			with open(self.metrics_path, 'r') as metrics_f:
+				cached = json.load(metrics_f)
+			if cached.get('version') == METRICS_VERSION:
+				return dict(cached['metrics'])
+		except (OSError, ValueError, KeyError, AttributeError, TypeError):
+			pass
+		return {}
+
+	def font_stamp(self, font_path):
+		# So that a font that's been updated is measured again.
+		try:
+			return self.font_stamps[font_path]
+		except KeyError:
+			pass
+		try:
+			font_stat = os.stat(font_path)
+			stamp = [font_stat.st_mtime_ns, font_stat.st_size]
+		except OSError:
+			# E.g., a font name, rather than a file.
+			stamp = None
+		return self.font_stamps.setdefault(font_path, stamp)
+
+	def text_size(self, font_path, font_style, font_weight, font_size, text):
+		key = json.dumps([
+			self.engine, font_path, self.font_stamp(font_path),
+			font_style, font_weight, font_size, text,
+		])
+		with self.lock:
+			if self.metrics is None:
+				self.metrics = self.metrics_read()
+			try:
+				width, height = self.metrics[key]
+				self.hits += 1
+				return width, height
+			except KeyError:
+				self.misses += 1
+		width, height = self.measure(font_path, font_style, font_weight, font_size, text)
+		with self.lock:
+			self.metrics[key] = self.added[key] = [width, height]
+		return width, height
+
+	def fit_size(self, font_path, font_style, font_weight, text, box_w, box_h):
+		'''
+		>>> metrics = TextMetrics(
+		...     lambda path, style, weight, size, text: (len(text) * size // 2, size),
+		...     'test', metrics_path=os.devnull)
+		>>> metrics.fit_size('Font.ttf', 'Normal', 'Normal', 'slide-0042.png', 300, 40)
+		40
+		>>> metrics.fit_size('Font.ttf', 'Normal', 'Normal', 'slide-0042.png', 100, 40)
+		14
+		'''
+		# The largest point size (from 1 to the box height, which, at 72 DPI,
+		# is the most that could fit) at which the text fits in the box, or 1,
+		# if it never does. Bigger text is never narrower, so binary search.
+		fit_key = (font_path, font_style, font_weight, text, box_w, box_h,)
+		try:
+			return self.fits[fit_key]
+		except KeyError:
+			pass
+		low_size, high_size = 1, max(1, box_h)
+		while low_size < high_size:
+			font_size = (low_size + high_size + 1) // 2
+			width, height = self.text_size(font_path, font_style, font_weight, font_size, text)
+			if (width <= box_w) and (height <= box_h):
+				low_size = font_size
+			else:
+				high_size = font_size - 1
+		return self.fits.setdefault(fit_key, low_size)
+
+	def save(self):
+		# Add what we measured to the cache file, along with whatever other
+		# runs have added since we read it. Not being able to save it (e.g.,
+		# a read-only home) only costs time.
+		with self.lock:
+			added = self.added
+			self.added = {}
+		if not added:
+			return
+		metrics = self.metrics_read()
+		metrics.update(added)
+		if len(metrics) > MAX_METRICS:
+			# The dict keeps the order the keys were added in, oldest first.
+			metrics = dict(list(metrics.items())[-MAX_METRICS:])
+		try:
+			os.makedirs(os.path.dirname(self.metrics_path), exist_ok=True)
+			metrics_temp = '%s.%d.tmp' % (self.metrics_path, os.getpid(),)
+			with open(metrics_temp, 'w') as metrics_f:
+				json.dump({'version': METRICS_VERSION, 'metrics': metrics}, metrics_f)
+			os.replace(metrics_temp, self.metrics_path)
+		except OSError:
+			pass
+
+if __name__ == '__main__':
+	import doctest
+	doctest.testmod()
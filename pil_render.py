@@ -0,0 +1,315 @@
+# Copyright © 2015 Landon Bouma. All rights reserved.
+#
+# Permission is hereby granted,  free of charge,  to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge,  publish,  distribute, sublicense,
+# and/or  sell copies  of the Software,  and to permit persons  to whom the
+# Software  is  furnished  to do so,  subject  to  the following conditions:
+#
+# The  above  copyright  notice  and  this  permission  notice  shall  be
+# included  in  all  copies  or  substantial  portions  of  the  Software.
+#
+# THE  SOFTWARE  IS  PROVIDED  "AS IS",  WITHOUT  WARRANTY  OF ANY KIND,
+# EXPRESS OR IMPLIED,  INCLUDING  BUT NOT LIMITED  TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE  FOR ANY
+# CLAIM,  DAMAGES OR OTHER LIABILITY,  WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE,  ARISING FROM,  OUT OF  OR IN  CONNECTION WITH THE
+# SOFTWARE   OR   THE   USE   OR   OTHER   DEALINGS  IN   THE  SOFTWARE.
+
+# An in-process rendering engine for mdm2 that uses Pillow instead of
+# forking ImageMagick's convert for every slide. It mimics the handful of
+# convert options that mdm2 uses: -background, -gravity, -extent, -resize,
+# and -annotate (with -font, -pointsize, -fill and -stroke).
+
+# CAVEAT: Pillow cannot synthesize a font style or weight, so -style and
+#         -weight are ignored. Point the label at, e.g., the bold font file.
+
+import threading
+import time
+
+from PIL import Image
+from PIL import ImageColor
+from PIL import ImageDraw
+from PIL import ImageFont
+
+import geometry_util
+
+# Pillow's text anchors that match ImageMagick's -gravity for -annotate.
+# The first letter is horizontal (left, middle, right) and the second is
+# vertical (ascender, middle, descender; or baseline, for no gravity).
+gravity_anchors = {
+	'northwest': 'la',
+	'north': 'ma',
+	'northeast': 'ra',
+	'west': 'lm',
+	'center': 'mm',
+	'east': 'rm',
+	'southwest': 'ld',
+	'south': 'md',
+	'southeast': 'rd',
+	'none': 'ls',
+	'forget': 'ls',
+}
+
+# Each worker thread loads a font file once and then reuses it for every
+# slide. FreeType faces aren't meant to be shared between threads, hence
+# a cache per thread rather than one for everybody.
+font_cache = threading.local()
+
+# The rendered text of labels that are the same on every slide, keyed by
+# everything that affects how the text looks. These images are never
+# changed after they're made, so the threads can share them.
+layer_cache = {}
+layer_cache_lock = threading.Lock()
+
+def parse_color(color):
+	# ImageMagick's 'none' is fully transparent (though -stroke none
+	# means no stroke at all, which the caller deals with).
+	if color.lower() in ('none', 'transparent',):
+		return (0, 0, 0, 0)
+	return ImageColor.getcolor(color, 'RGBA')
+
+def gravity_region(gravity, outer_w, outer_h, inner_w, inner_h, off_x, off_y):
+	# Return the top-left corner of a region of the given size relative to
+	# the outer box, using the same rules as ImageMagick's gravity, whereby
+	# the offset points inward from the edge named by the gravity.
+	if gravity in ('northeast', 'east', 'southeast',):
+		left = outer_w - inner_w - off_x
+	elif gravity in ('north', 'center', 'south',):
+		left = (outer_w - inner_w) // 2 + off_x
+	else:
+		left = off_x
+	if gravity in ('southwest', 'south', 'southeast',):
+		top = outer_h - inner_h - off_y
+	elif gravity in ('west', 'center', 'east',):
+		top = (outer_h - inner_h) // 2 + off_y
+	else:
+		top = off_y
+	return left, top
+
+def extent_image(image, extent_geom, extent_gravity, background):
+	new_w, new_h, off_x, off_y, flags = geometry_util.parse_geometry(
+		extent_geom, image.width, image.height,
+	)
+	if (new_w, new_h, off_x, off_y) == (image.width, image.height, 0, 0):
+		# The same as a canvas filled with the background, under the image.
+		if background[3] == 0:
+			return image
+		canvas = Image.new('RGBA', image.size, background)
+		canvas.alpha_composite(image)
+		return canvas
+	# The extent is the region of the image to keep, padded with the
+	# background. Its corner is where the image's corner isn't, as it were.
+	region_x, region_y = gravity_region(
+		extent_gravity, image.width, image.height, new_w, new_h, off_x, off_y,
+	)
+	canvas = Image.new('RGBA', (new_w, new_h), background)
+	src_x, src_y = max(0, region_x), max(0, region_y)
+	dst_x, dst_y = max(0, -region_x), max(0, -region_y)
+	copy_w = min(image.width - src_x, new_w - dst_x)
+	copy_h = min(image.height - src_y, new_h - dst_y)
+	if (copy_w > 0) and (copy_h > 0):
+		canvas.alpha_composite(image, dest=(dst_x, dst_y),
+			source=(src_x, src_y, src_x + copy_w, src_y + copy_h))
+	return canvas
+
+def resize_image(image, resize_geom):
+	new_w, new_h = geometry_util.resize_size(resize_geom, image.width, image.height)
+	if (new_w, new_h) == image.size:
+		return image
+	return image.resize((new_w, new_h), Image.LANCZOS)
+
+def load_font(font_path, font_size):
+	try:
+		fonts = font_cache.fonts
+	except AttributeError:
+		fonts = font_cache.fonts = {}
+	font_key = (font_path, font_size,)
+	try:
+		font = fonts[font_key]
+	except KeyError:
+		font = fonts[font_key] = ImageFont.truetype(font_path, font_size)
+	return font
+
+def text_size(font_path, font_size, label_text):
+	# How big the text comes out, for fitting a label to a box (--autofit).
+	left, top, right, bottom = load_font(font_path, font_size).getbbox(label_text)
+	return right - left, bottom - top
+
+def text_layer(label_def, label_text):
+	# Render the text onto its own transparent image, just big enough to fit.
+	# Returns the layer and where its corner goes relative to the anchor point.
+	font = load_font(label_def['font_path'], label_def['font_size'])
+	anchor = gravity_anchors[label_def['offset_gravity']]
+	stroke_width = 1
+	stroke_fill = label_def['font_stroke']
+	if stroke_fill.lower() == 'none':
+		stroke_width = 0
+		stroke_fill = None
+	else:
+		stroke_fill = parse_color(stroke_fill)
+	left, top, right, bottom = font.getbbox(
+		label_text, anchor=anchor, stroke_width=stroke_width,
+	)
+	layer = Image.new('RGBA', (max(1, right - left), max(1, bottom - top)), (0, 0, 0, 0))
+	draw = ImageDraw.Draw(layer)
+	draw.text((-left, -top), label_text, font=font, anchor=anchor,
+		fill=parse_color(label_def['font_fill']),
+		stroke_width=stroke_width, stroke_fill=stroke_fill)
+	return layer, left, top
+
+def cached_text_layer(label_def, label_text):
+	layer_key = (
+		label_def['font_path'],
+		label_def['font_size'],
+		label_def['font_fill'],
+		label_def['font_stroke'],
+		label_def['offset_gravity'],
+		label_text,
+	)
+	try:
+		return layer_cache[layer_key]
+	except KeyError:
+		pass
+	# If two threads race to render the same layer, one of them wins, but
+	# it's the same image either way.
+	layer_tuple = text_layer(label_def, label_text)
+	with layer_cache_lock:
+		return layer_cache.setdefault(layer_key, layer_tuple)
+
+def composite_clipped(image, layer, left, top):
+	# Like alpha_composite, but the layer can hang off the edges.
+	src_x, src_y = max(0, -left), max(0, -top)
+	copy_w = min(layer.width - src_x, image.width - max(0, left))
+	copy_h = min(layer.height - src_y, image.height - max(0, top))
+	if (copy_w > 0) and (copy_h > 0):
+		image.alpha_composite(layer, dest=(max(0, left), max(0, top)),
+			source=(src_x, src_y, src_x + copy_w, src_y + copy_h))
+
+def annotate_image(image, label_def, label_text):
+	if not label_text:
+		return
+	# A label whose text is the same on every slide is rasterized once
+	# and then pasted onto each slide; the others are rendered each time.
+	if label_def.get('static'):
+		layer, left, top = cached_text_layer(label_def, label_text)
+	else:
+		layer, left, top = text_layer(label_def, label_text)
+	gravity = label_def['offset_gravity']
+	off_x = label_def['offset_x']
+	off_y = label_def['offset_y']
+	if gravity in ('none', 'forget',):
+		# Without gravity, the offset is the text's baseline origin.
+		posit = (off_x, off_y)
+	else:
+		# The anchor takes care of the text box, so we just need the point.
+		posit = gravity_region(gravity, image.width, image.height, 0, 0, off_x, off_y)
+	composite_clipped(image, layer, posit[0] + left, posit[1] + top)
+
+def encoder_params(target_path, encoder):
+	# Translate mdm2's encoder settings to Pillow's save() parameters.
+	# NOTE: Pillow doesn't let us pick the PNG filter, so png_filter is moot.
+	save_params = {}
+	if not encoder:
+		return save_params
+	target_ext = target_path.rsplit('.', 1)[-1].lower()
+	if target_ext == 'png':
+		if encoder.get('png_compression') is not None:
+			save_params['compress_level'] = encoder['png_compression']
+	elif encoder.get('quality') is not None:
+		save_params['quality'] = encoder['quality']
+	if (target_ext == 'webp') and (encoder.get('webp_method') is not None):
+		save_params['method'] = encoder['webp_method']
+	return save_params
+
+def save_image(image, target_path, encoder=None, target_file=None):
+	# If there's a target_file, write to that instead, in the format that
+	# target_path's extension says.
+	save_params = encoder_params(target_path, encoder)
+	if encoder and encoder.get('strip'):
+		# Pillow carries over things like the ICC profile from the source.
+		image.info = {}
+	save_to = target_path
+	if target_file is not None:
+		target_ext = '.' + target_path.rsplit('.', 1)[-1].lower()
+		save_params['format'] = Image.registered_extensions()[target_ext]
+		save_to = target_file
+	# Formats without an alpha channel, like JPEG, cannot take RGBA.
+	try:
+		image.save(save_to, **save_params)
+	except OSError:
+		if image.mode != 'RGBA':
+			raise
+		if target_file is not None:
+			target_file.seek(0)
+			target_file.truncate()
+		image.convert('RGB').save(save_to, **save_params)
+
+def render_base(source_path, canvas_def, labels):
+	# Decode the source and put it on its canvas, and draw the labels, which
+	# leaves the base that the slides that share the source start from (see
+	# render_slide's base_image). Returns the image, and how long it took.
+	time_0 = time.perf_counter()
+	with Image.open(source_path) as source_image:
+		image = source_image.convert('RGBA')
+	time_1 = time.perf_counter()
+	background = parse_color(canvas_def['background_color'])
+	# NOTE: Order matters, as with convert: extent first, then resize.
+	image = extent_image(
+		image, canvas_def['extent_geom'], canvas_def['extent_gravity'], background,
+	)
+	image = resize_image(image, canvas_def['extent_geom'])
+	for label_def, label_text in labels:
+		annotate_image(image, label_def, label_text)
+	return image, {'decode': time_1 - time_0, 'render': time.perf_counter() - time_1}
+
+def render_slide(
+	source_path, target_path, canvas_def, labels, encoder=None, target_file=None, renditions=(),
+	base_image=None,
+):
+	# The canvas_def has the options that apply to the whole image, i.e.,
+	# background_color, extent_geom, and extent_gravity, and labels is a
+	# list of (label_def, label_text) with the text already formatted.
+	# The renditions are (resize_geom, labels, target_path) for smaller
+	# copies, each resized from the (unlabeled) one before it.
+	# Or, to start from a base_image (see render_base), which is left as is,
+	# pass it, and the labels left to draw on it, and no renditions.
+	# Returns how long (in seconds) each stage took.
+	if base_image is not None:
+		time_1 = time.perf_counter()
+		image = base_image.copy()
+		for label_def, label_text in labels:
+			annotate_image(image, label_def, label_text)
+		time_2 = time.perf_counter()
+		save_image(image, target_path, encoder, target_file=target_file)
+		return {'render': time_2 - time_1, 'write': time.perf_counter() - time_2}
+	image, timings = render_base(source_path, canvas_def, ())
+	time_1 = time.perf_counter()
+	# The labels are drawn on a copy, so the renditions start out clean.
+	plain_image = image
+	if renditions:
+		image = plain_image.copy()
+	for label_def, label_text in labels:
+		annotate_image(image, label_def, label_text)
+	time_2 = time.perf_counter()
+	save_image(image, target_path, encoder, target_file=target_file)
+	timings['render'] += time_2 - time_1
+	timings['write'] = time.perf_counter() - time_2
+	for resize_geom, rend_labels, rend_path in renditions:
+		time_0 = time.perf_counter()
+		plain_image = resize_image(plain_image, resize_geom)
+		image = plain_image.copy()
+		for label_def, label_text in rend_labels:
+			annotate_image(image, label_def, label_text)
+		time_1 = time.perf_counter()
+		save_image(image, rend_path, encoder)
+		timings['render'] += time_1 - time_0
+		timings['write'] += time.perf_counter() - time_1
+	return timings
+
+if __name__ == "__main__":
+	import doctest
+	doctest.testmod()
+	print('Testing complete!')
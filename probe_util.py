@@ -0,0 +1,138 @@
+# Copyright © 2015 Landon Bouma. All rights reserved.
+#
+# Permission is hereby granted,  free of charge,  to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge,  publish,  distribute, sublicense,
+# and/or  sell copies  of the Software,  and to permit persons  to whom the
+# Software  is  furnished  to do so,  subject  to  the following conditions:
+#
+# The  above  copyright  notice  and  this  permission  notice  shall  be
+# included  in  all  copies  or  substantial  portions  of  the  Software.
+#
+# THE  SOFTWARE  IS  PROVIDED  "AS IS",  WITHOUT  WARRANTY  OF ANY KIND,
+# EXPRESS OR IMPLIED,  INCLUDING  BUT NOT LIMITED  TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE  FOR ANY
+# CLAIM,  DAMAGES OR OTHER LIABILITY,  WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE,  ARISING FROM,  OUT OF  OR IN  CONNECTION WITH THE
+# SOFTWARE   OR   THE   USE   OR   OTHER   DEALINGS  IN   THE  SOFTWARE.
+
+# Find out what the installed ImageMagick can do -- its version, the image
+# formats it can write, and the fonts it knows by name -- and remember it,
+# so we don't fork convert three times on every run just to ask. The cache
+# is good for as long as the convert binary stays the same (going by its
+# mtime and size). To forget it, e.g., after installing new fonts, delete
+# ~/.cache/mdm2/imagemagick.json.
+
+import json
+import os
+import re
+import subprocess
+
+PROBE_VERSION = 1
+
+# E.g., "      PNG* rw+   Portable Network Graphics (libpng 1.6.37)".
+format_regex = re.compile(r'^\s*(?P<name>[A-Z0-9-]+)\*?\s+(?P<mode>[r-][w-][+-])\s')
+
+# E.g., "  Font: DejaVu-Sans", and, a few lines later, its "    glyphs: /path".
+font_regex = re.compile(r'^\s*Font:\s*(?P<name>.+?)\s*$')
+glyphs_regex = re.compile(r'^\s*glyphs:\s*(?P<path>.+?)\s*$')
+
+def cache_dir():
+	# Where mdm2 keeps what it's learned between runs (see metrics_util, too).
+	xdg_cache = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+	return os.path.join(xdg_cache, 'mdm2')
+
+def cache_path():
+	return os.path.join(cache_dir(), 'imagemagick.json')
+
+def parse_formats(listing):
+	'''
+	>>> parse_formats('   Format  Mode  Description\\n'
+	...     '      3FR  r--   Hasselblad CFV/H3D39II\\n'
+	...     '      PNG* rw+   Portable Network Graphics\\n')
+	['PNG']
+	'''
+	# The formats convert can write.
+	formats = []
+	for line in listing.splitlines():
+		match = format_regex.match(line)
+		if match and (match.group('mode')[1] == 'w'):
+			formats.append(match.group('name'))
+	return formats
+
+def parse_fonts(listing):
+	'''
+	>>> parse_fonts('  Font: DejaVu-Sans\\n    family: DejaVu Sans\\n'
+	...     '    glyphs: /usr/share/fonts/DejaVuSans.ttf\\n')
+	{'DejaVu-Sans': '/usr/share/fonts/DejaVuSans.ttf'}
+	'''
+	# The font names convert knows, and their font files.
+	fonts = {}
+	font_name = None
+	for line in listing.splitlines():
+		match = font_regex.match(line)
+		if match:
+			font_name = match.group('name')
+			continue
+		match = glyphs_regex.match(line)
+		if match and font_name:
+			fonts[font_name] = match.group('path')
+			font_name = None
+	return fonts
+
+def convert_output(args):
+	try:
+		return subprocess.run(
+			args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True,
+		).stdout.decode('utf-8', 'replace')
+	except subprocess.CalledProcessError:
+		return ''
+
+def probe_convert(convert_path):
+	version = convert_output([convert_path, '-version']).splitlines()
+	return {
+		'version': version[0] if version else '',
+		'formats': parse_formats(convert_output([convert_path, '-list', 'format'])),
+		'fonts': parse_fonts(convert_output([convert_path, '-list', 'font'])),
+	}
+
+def imagemagick_probe(convert='convert'):
+	# Returns a dict of the 'version', 'formats' and 'fonts', or None if
+	# convert isn't installed.
+	import shutil
+	convert_path = shutil.which(convert)
+	if convert_path is None:
+		return None
+	convert_path = os.path.realpath(convert_path)
+	convert_stat = os.stat(convert_path)
+	key = {
+		'probe_version': PROBE_VERSION,
+		'path': convert_path,
+		'mtime_ns': convert_stat.st_mtime_ns,
+		'size': convert_stat.st_size,
+	}
+	probe_path = cache_path()
+	try:
+		with open(probe_path, 'r') as probe_f:
+			cached = json.load(probe_f)
+		if cached.get('key') == key:
+			return cached['probe']
+	except (OSError, ValueError, KeyError, AttributeError):
+		pass
+	probe = probe_convert(convert_path)
+	# Not being able to cache it (e.g., a read-only home) only costs time.
+	try:
+		os.makedirs(os.path.dirname(probe_path), exist_ok=True)
+		probe_temp = '%s.%d.tmp' % (probe_path, os.getpid(),)
+		with open(probe_temp, 'w') as probe_f:
+			json.dump({'key': key, 'probe': probe}, probe_f, indent=1, sort_keys=True)
+		os.replace(probe_temp, probe_path)
+	except OSError:
+		pass
+	return probe
+
+if __name__ == '__main__':
+	import doctest
+	doctest.testmod()
@@ -0,0 +1,306 @@
+# Copyright © 2015 Landon Bouma. All rights reserved.
+#
+# Permission is hereby granted,  free of charge,  to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge,  publish,  distribute, sublicense,
+# and/or  sell copies  of the Software,  and to permit persons  to whom the
+# Software  is  furnished  to do so,  subject  to  the following conditions:
+#
+# The  above  copyright  notice  and  this  permission  notice  shall  be
+# included  in  all  copies  or  substantial  portions  of  the  Software.
+#
+# THE  SOFTWARE  IS  PROVIDED  "AS IS",  WITHOUT  WARRANTY  OF ANY KIND,
+# EXPRESS OR IMPLIED,  INCLUDING  BUT NOT LIMITED  TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE  FOR ANY
+# CLAIM,  DAMAGES OR OTHER LIABILITY,  WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE,  ARISING FROM,  OUT OF  OR IN  CONNECTION WITH THE
+# SOFTWARE   OR   THE   USE   OR   OTHER   DEALINGS  IN   THE  SOFTWARE.
+
+# A small HTTP server, on localhost or a Unix socket, that queues render
+# requests for a fixed pool of worker threads. The queue is bounded, and a
+# request that doesn't fit is turned away (503, with a Retry-After) rather
+# than left to pile up, so a busy server pushes back on its clients.
+#
+# The server doesn't know how to render anything itself: the caller passes
+# a render function, which takes the request (the JSON the client POSTed to
+# /render) and returns the response, or raises ServeError. GET /stats shows
+# the queue and the latency of the recent requests.
+
+import collections
+import http.client
+import http.server
+import json
+import os
+import queue
+import socket
+import socketserver
+import stat
+import threading
+import time
+
+# How many of the latest requests the latency stats cover.
+LATENCY_WINDOW = 1000
+
+# The most JSON we'll read for one request (e.g., an uploaded image).
+MAX_REQUEST_BYTES = 256 * 1024 * 1024
+
+class ServeError(Exception):
+
+	def __init__(self, status, message):
+		super(ServeError, self).__init__(message)
+		self.status = status
+
+def parse_address(address):
+	'''
+	>>> parse_address('unix:/tmp/mdm2.sock')
+	('unix', '/tmp/mdm2.sock')
+	>>> parse_address('8765')
+	('tcp', ('127.0.0.1', 8765))
+	>>> parse_address('localhost:8765')
+	('tcp', ('localhost', 8765))
+	'''
+	# A Unix socket path, or a TCP [HOST:]PORT, on the loopback by default.
+	if address.startswith('unix:'):
+		return ('unix', address[len('unix:'):],)
+	host, _, port = address.rpartition(':')
+	return ('tcp', (host or '127.0.0.1', int(port),),)
+
+def nearest_rank(ordered, pct):
+	if not ordered:
+		return None
+	return ordered[max(1, int(-(-pct * len(ordered) // 100))) - 1]
+
+class LatencyStats(object):
+	# Counts, and the queue wait, service and total times (in secs.) of the
+	# last LATENCY_WINDOW requests.
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.counts = collections.Counter()
+		self.samples = collections.deque(maxlen=LATENCY_WINDOW)
+
+	def count(self, outcome):
+		with self.lock:
+			self.counts[outcome] += 1
+
+	def record(self, queue_wait, service):
+		with self.lock:
+			self.counts['served'] += 1
+			self.samples.append((queue_wait, service, queue_wait + service,))
+
+	def summary(self):
+		with self.lock:
+			samples = list(self.samples)
+			summary = {'counts': dict(self.counts), 'window': len(samples)}
+		for stage_i, stage in enumerate(('queue_wait', 'service', 'total',)):
+			ordered = sorted(sample[stage_i] for sample in samples)
+			summary[stage] = {
+				'p50': nearest_rank(ordered, 50),
+				'p95': nearest_rank(ordered, 95),
+				'p99': nearest_rank(ordered, 99),
+				'max': ordered[-1] if ordered else None,
+			}
+		return summary
+
+class RenderRequestHandler(http.server.BaseHTTPRequestHandler):
+
+	protocol_version = 'HTTP/1.1'
+
+	def do_GET(self):
+		server = self.server.render_server
+		if self.path == '/stats':
+			stats = server.stats.summary()
+			stats['queue'] = {'size': server.requests.qsize(), 'limit': server.queue_size}
+			stats['workers'] = server.workers
+			self.send_json(200, stats)
+		elif self.path == '/health':
+			self.send_json(200, {'ok': True})
+		else:
+			self.send_json(404, {'error': 'not found: %s' % (self.path,)})
+
+	def do_POST(self):
+		server = self.server.render_server
+		if self.path != '/render':
+			self.send_json(404, {'error': 'not found: %s' % (self.path,)})
+			return
+		try:
+			body_len = int(self.headers.get('Content-Length') or 0)
+			if body_len > MAX_REQUEST_BYTES:
+				raise ServeError(413, 'the request is over %d bytes' % (MAX_REQUEST_BYTES,))
+			request = json.loads(self.rfile.read(body_len) or b'{}')
+			if not isinstance(request, dict):
+				raise ServeError(400, 'the request should be a JSON object')
+		except ValueError as err:
+			server.stats.count('bad_request')
+			self.send_json(400, {'error': 'bad request: %s' % (err,)})
+			return
+		except ServeError as err:
+			server.stats.count('bad_request')
+			self.send_json(err.status, {'error': str(err)})
+			# We didn't read the body, so don't try to read another request.
+			self.close_connection = True
+			return
+		pending = server.submit(request)
+		if pending is None:
+			# Backpressure: the client should back off and try again.
+			server.stats.count('rejected')
+			self.send_json(503, {'error': 'the render queue is full'}, {'Retry-After': '1'})
+			return
+		pending['done'].wait()
+		timings = {
+			'X-MDM2-Queue-Wait': '%.6f' % (pending['queue_wait'],),
+			'X-MDM2-Service': '%.6f' % (pending['service'],),
+		}
+		if pending['error'] is not None:
+			self.send_json(pending['error'].status, {'error': str(pending['error'])}, timings)
+			return
+		status, content_type, body = pending['response']
+		self.send_body(status, content_type, body, timings)
+
+	def send_json(self, status, obj, headers=None):
+		body = json.dumps(obj, sort_keys=True).encode('utf-8') + b'\n'
+		self.send_body(status, 'application/json', body, headers)
+
+	def send_body(self, status, content_type, body, headers=None):
+		self.send_response(status)
+		self.send_header('Content-Type', content_type)
+		self.send_header('Content-Length', str(len(body)))
+		for name, value in (headers or {}).items():
+			self.send_header(name, value)
+		self.end_headers()
+		self.wfile.write(body)
+
+	def address_string(self):
+		# A Unix socket's client has no address.
+		return self.client_address[0] if self.client_address else 'unix'
+
+	def log_message(self, format, *args):
+		# The stats say more, and they don't flood the terminal.
+		pass
+
+def stale_socket_remove(socket_path):
+	# Remove a socket left over from a server that didn't shut down cleanly,
+	# but not a server that's still running, nor anything that's not a socket.
+	try:
+		path_mode = os.lstat(socket_path).st_mode
+	except FileNotFoundError:
+		return
+	if not stat.S_ISSOCK(path_mode):
+		raise OSError('the path is in use, and not a socket: "%s"' % (socket_path,))
+	probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		probe.connect(socket_path)
+	except ConnectionRefusedError:
+		os.unlink(socket_path)
+		return
+	finally:
+		probe.close()
+	raise OSError('another server is already listening at "%s"' % (socket_path,))
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	daemon_threads = True
+
+class ThreadingTCPHTTPServer(http.server.ThreadingHTTPServer):
+	daemon_threads = True
+
+class RenderServer(object):
+
+	def __init__(self, address, render, workers=1, queue_size=8):
+		self.address = address
+		self.render = render
+		self.workers = workers
+		self.queue_size = queue_size
+		self.requests = queue.Queue(maxsize=queue_size)
+		self.stats = LatencyStats()
+		self.family, bind_address = parse_address(address)
+		if self.family == 'unix':
+			stale_socket_remove(bind_address)
+			self.httpd = ThreadingUnixHTTPServer(bind_address, RenderRequestHandler)
+		else:
+			self.httpd = ThreadingTCPHTTPServer(bind_address, RenderRequestHandler)
+		self.httpd.render_server = self
+		self.bind_address = bind_address
+		self.threads = [
+			threading.Thread(target=self.work, name='mdm2-render-%d' % (worker_i,), daemon=True)
+			for worker_i in range(workers)
+		]
+		for thread in self.threads:
+			thread.start()
+
+	def submit(self, request):
+		# Returns the pending request, for the caller to wait on, or None if
+		# the queue's full.
+		pending = {
+			'request': request,
+			'queued_at': time.perf_counter(),
+			'done': threading.Event(),
+			'queue_wait': 0.0,
+			'service': 0.0,
+			'response': None,
+			'error': None,
+		}
+		try:
+			self.requests.put_nowait(pending)
+		except queue.Full:
+			return None
+		return pending
+
+	def work(self):
+		while True:
+			pending = self.requests.get()
+			if pending is None:
+				return
+			time_0 = time.perf_counter()
+			pending['queue_wait'] = time_0 - pending['queued_at']
+			try:
+				pending['response'] = self.render(pending['request'])
+			except ServeError as err:
+				pending['error'] = err
+			except Exception as err:
+				pending['error'] = ServeError(500, 'internal error: %s' % (err,))
+			pending['service'] = time.perf_counter() - time_0
+			if pending['error'] is None:
+				self.stats.record(pending['queue_wait'], pending['service'])
+			elif pending['error'].status == 400:
+				# The client's mistake (e.g., an unknown variable), not a failed
+				# render (a 422 or a 500).
+				self.stats.count('bad_request')
+			else:
+				self.stats.count('failed')
+			pending['done'].set()
+
+	def serve_forever(self):
+		self.httpd.serve_forever()
+
+	def close(self):
+		self.httpd.shutdown()
+		self.httpd.server_close()
+		for thread in self.threads:
+			self.requests.put(None)
+		if self.family == 'unix':
+			try:
+				os.unlink(self.bind_address)
+			except FileNotFoundError:
+				pass
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+	# For clients of a server on a Unix socket, e.g., mdm2_bench.
+
+	def __init__(self, socket_path, timeout=None):
+		super(UnixHTTPConnection, self).__init__('localhost', timeout=timeout)
+		self.socket_path = socket_path
+
+	def connect(self):
+		self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		if self.timeout is not None:
+			self.sock.settimeout(self.timeout)
+		self.sock.connect(self.socket_path)
+
+def connect(address, timeout=None):
+	# An HTTPConnection to a server at the address, as given to RenderServer.
+	family, bind_address = parse_address(address)
+	if family == 'unix':
+		return UnixHTTPConnection(bind_address, timeout=timeout)
+	return http.client.HTTPConnection(bind_address[0], bind_address[1], timeout=timeout)
@@ -0,0 +1,319 @@
+# Copyright © 2015 Landon Bouma. All rights reserved.
+#
+# Permission is hereby granted,  free of charge,  to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge,  publish,  distribute, sublicense,
+# and/or  sell copies  of the Software,  and to permit persons  to whom the
+# Software  is  furnished  to do so,  subject  to  the following conditions:
+#
+# The  above  copyright  notice  and  this  permission  notice  shall  be
+# included  in  all  copies  or  substantial  portions  of  the  Software.
+#
+# THE  SOFTWARE  IS  PROVIDED  "AS IS",  WITHOUT  WARRANTY  OF ANY KIND,
+# EXPRESS OR IMPLIED,  INCLUDING  BUT NOT LIMITED  TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE  FOR ANY
+# CLAIM,  DAMAGES OR OTHER LIABILITY,  WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE,  ARISING FROM,  OUT OF  OR IN  CONNECTION WITH THE
+# SOFTWARE   OR   THE   USE   OR   OTHER   DEALINGS  IN   THE  SOFTWARE.
+
+# Output sinks that take rendered slides as bytes, in slide order, and put
+# them all in one file -- a zip or tar archive, a multi-page PDF, or a video
+# encoded by ffmpeg -- so the slides never land on disk one file apiece.
+
+import io
+import os
+import struct
+import subprocess
+import threading
+import time
+
+import header_util
+
+# NOTE: mdm2 imports us on every run, to tell if the target's a sink, so
+#       the sinks import what only they need (zipfile, tarfile, tempfile)
+#       themselves.
+
+class SinkError(Exception):
+	pass
+
+class Sink(object):
+	# The format the sink wants the slides in, or None for the target
+	# name's (i.e., the source's or --format's) format.
+	frame_format = None
+
+	def __init__(self, target_path):
+		self.target_path = target_path
+
+	def write(self, name, data):
+		raise NotImplementedError
+
+	def close(self):
+		pass
+
+	def abort(self):
+		# Clean up after a failed run, so no one mistakes it for a deck.
+		try:
+			self.close()
+		except Exception:
+			pass
+		try:
+			os.unlink(self.target_path)
+		except OSError:
+			pass
+
+class ZipSink(Sink):
+
+	def __init__(self, target_path):
+		super(ZipSink, self).__init__(target_path)
+		import zipfile
+		# The images are compressed already, so don't bother deflating them.
+		self.archive = zipfile.ZipFile(target_path, 'w', compression=zipfile.ZIP_STORED)
+
+	def write(self, name, data):
+		import zipfile
+		member = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+		member.external_attr = 0o644 << 16
+		self.archive.writestr(member, data)
+
+	def close(self):
+		self.archive.close()
+
+class TarSink(Sink):
+
+	def __init__(self, target_path):
+		super(TarSink, self).__init__(target_path)
+		import tarfile
+		# NOTE: The 'w|' modes write the archive as a stream, front to back.
+		if target_path.endswith(('.tar.gz', '.tgz',)):
+			tar_mode = 'w|gz'
+		else:
+			tar_mode = 'w|'
+		self.archive = tarfile.open(target_path, tar_mode)
+
+	def write(self, name, data):
+		import tarfile
+		member = tarfile.TarInfo(name)
+		member.size = len(data)
+		member.mtime = time.time()
+		member.mode = 0o644
+		self.archive.addfile(member, io.BytesIO(data))
+
+	def close(self):
+		self.archive.close()
+
+class PdfSink(Sink):
+	# A bare-bones PDF writer: each slide is a JPEG image on its own page, a
+	# point per pixel. PDF can show a JPEG as is, so there's no re-encoding.
+	frame_format = 'jpg'
+
+	def __init__(self, target_path):
+		super(PdfSink, self).__init__(target_path)
+		self.pdf_f = open(target_path, 'wb')
+		self.offsets = {}
+		self.page_ids = []
+		# Object 1 is the catalog and 2 is the page tree, which we write
+		# last, when we know all the pages.
+		self.next_id = 3
+		self.pdf_f.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+		self.write_object(1, b'<< /Type /Catalog /Pages 2 0 R >>')
+
+	def write_object(self, obj_id, body, stream=None):
+		self.offsets[obj_id] = self.pdf_f.tell()
+		self.pdf_f.write(b'%d 0 obj\n' % (obj_id,))
+		self.pdf_f.write(body)
+		if stream is not None:
+			self.pdf_f.write(b'\nstream\n')
+			self.pdf_f.write(stream)
+			self.pdf_f.write(b'\nendstream')
+		self.pdf_f.write(b'\nendobj\n')
+
+	def write(self, name, data):
+		try:
+			width, height, components = header_util.jpeg_dimensions(io.BytesIO(data))
+		except (header_util.HeaderError, struct.error) as err:
+			raise SinkError('bad JPEG for "%s": %s' % (name, err,))
+		color_space = {1: b'/DeviceGray', 3: b'/DeviceRGB', 4: b'/DeviceCMYK'}[components]
+		image_id, content_id, page_id = self.next_id, self.next_id + 1, self.next_id + 2
+		self.next_id += 3
+		self.write_object(image_id, (
+			b'<< /Type /XObject /Subtype /Image /Width %d /Height %d'
+			b' /ColorSpace %s /BitsPerComponent 8 /Filter /DCTDecode /Length %d >>'
+			% (width, height, color_space, len(data),)
+		), stream=data)
+		content = b'q %d 0 0 %d 0 0 cm /Im0 Do Q' % (width, height,)
+		self.write_object(content_id, b'<< /Length %d >>' % (len(content),), stream=content)
+		self.write_object(page_id, (
+			b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d]'
+			b' /Resources << /XObject << /Im0 %d 0 R >> >> /Contents %d 0 R >>'
+			% (width, height, image_id, content_id,)
+		))
+		self.page_ids.append(page_id)
+
+	def close(self):
+		if self.pdf_f.closed:
+			return
+		kids = b' '.join(b'%d 0 R' % (page_id,) for page_id in self.page_ids)
+		self.write_object(2, b'<< /Type /Pages /Kids [%s] /Count %d >>' % (kids, len(self.page_ids),))
+		xref_offset = self.pdf_f.tell()
+		self.pdf_f.write(b'xref\n0 %d\n' % (self.next_id,))
+		self.pdf_f.write(b'0000000000 65535 f \n')
+		for obj_id in range(1, self.next_id):
+			self.pdf_f.write(b'%010d 00000 n \n' % (self.offsets[obj_id],))
+		self.pdf_f.write(
+			b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n'
+			% (self.next_id, xref_offset,)
+		)
+		self.pdf_f.close()
+
+class FfmpegSink(Sink):
+	# Pipe the slides into ffmpeg, which makes a video, showing each
+	# slide for 1/fps secs.
+	frame_format = 'png'
+
+	codecs = {
+		'.mp4': ['-c:v', 'libx264', '-pix_fmt', 'yuv420p'],
+		'.mkv': ['-c:v', 'libx264', '-pix_fmt', 'yuv420p'],
+		'.webm': ['-c:v', 'libvpx-vp9', '-b:v', '0', '-crf', '32', '-pix_fmt', 'yuv420p'],
+	}
+
+	def __init__(self, target_path, fps=1.0):
+		super(FfmpegSink, self).__init__(target_path)
+		codec_opts = self.codecs[os.path.splitext(target_path)[1].lower()]
+		import tempfile
+		self.stderr_f = tempfile.TemporaryFile()
+		try:
+			self.ffmpeg = subprocess.Popen([
+				'ffmpeg', '-hide_banner', '-loglevel', 'error', '-y',
+				'-f', 'image2pipe', '-framerate', str(fps), '-i', '-',
+				# The 4:2:0 chroma subsampling needs even dimensions.
+				'-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2',
+				] + codec_opts + [
+				target_path,
+			], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=self.stderr_f)
+		except FileNotFoundError:
+			raise SinkError('making a video needs ffmpeg: try `sudo apt-get install ffmpeg`')
+		# Once ffmpeg quits on us, every write (and the close) says why.
+		self.failure = None
+
+	def write(self, name, data):
+		if self.failure is not None:
+			raise self.failure
+		if self.ffmpeg.stdin.closed:
+			raise SinkError('ffmpeg is not taking any more slides: "%s"' % (name,))
+		try:
+			self.ffmpeg.stdin.write(data)
+		except BrokenPipeError:
+			self.failure = self.ffmpeg_finish() or SinkError(
+				'ffmpeg quit before taking all the slides: "%s"' % (name,)
+			)
+			raise self.failure
+
+	def close(self):
+		if self.failure is not None:
+			raise self.failure
+		if self.ffmpeg.returncode is not None:
+			return
+		failure = self.ffmpeg_finish()
+		if failure is not None:
+			raise failure
+
+	def ffmpeg_finish(self):
+		# Wait for ffmpeg to finish, and return a SinkError (with what it
+		# said) if it failed, or None.
+		try:
+			self.ffmpeg.stdin.close()
+		except BrokenPipeError:
+			pass
+		if self.ffmpeg.wait() == 0:
+			return None
+		self.stderr_f.seek(0)
+		return SinkError(
+			'ffmpeg failed: "%s" (%s)'
+			% (self.stderr_f.read().decode('utf-8', 'replace').strip(), self.ffmpeg.returncode,)
+		)
+
+	def abort(self):
+		self.ffmpeg.kill()
+		self.ffmpeg.wait()
+		super(FfmpegSink, self).abort()
+
+class BufferSink(Sink):
+	# Keep the slides in memory, e.g., for mdm2 --serve to send back.
+
+	def __init__(self, target_path=None):
+		super(BufferSink, self).__init__(target_path)
+		self.slides = []
+
+	def write(self, name, data):
+		self.slides.append((name, data,))
+
+	def abort(self):
+		self.slides = []
+
+class OrderedSink(object):
+	# The render workers finish out of order, so hold on to each slide until
+	# all the slides before it have been written. The slides pile up here
+	# behind a slow one, so the caller shouldn't start a slide too far past
+	# next_index (mdm2 keeps within a window of a few batches per job).
+
+	def __init__(self, sink, first_index=0):
+		self.sink = sink
+		self.frame_format = sink.frame_format
+		self.next_index = first_index
+		self.held = {}
+		self.lock = threading.Lock()
+
+	def add(self, curr_index, name, data):
+		self.hold(curr_index, (name, data,))
+
+	def skip(self, curr_index):
+		# A slide that failed, and is left out, so the ones after it don't
+		# wait for it.
+		self.hold(curr_index, None)
+
+	def hold(self, curr_index, slide):
+		with self.lock:
+			self.held[curr_index] = slide
+			while self.next_index in self.held:
+				slide = self.held.pop(self.next_index)
+				if slide is not None:
+					self.sink.write(*slide)
+				self.next_index += 1
+
+	def close(self):
+		if self.held:
+			raise SinkError('missing slide number %d' % (self.next_index + 1,))
+		self.sink.close()
+
+	def abort(self):
+		self.sink.abort()
+
+SINK_EXTENSIONS = {
+	'.zip': ZipSink,
+	'.tar': TarSink,
+	'.tar.gz': TarSink,
+	'.tgz': TarSink,
+	'.pdf': PdfSink,
+	'.mp4': FfmpegSink,
+	'.mkv': FfmpegSink,
+	'.webm': FfmpegSink,
+}
+
+def sink_class(target_path):
+	# Returns the Sink class for the target, or None if it's a directory.
+	lower_path = target_path.lower()
+	for sink_ext, sink_cls in SINK_EXTENSIONS.items():
+		if lower_path.endswith(sink_ext):
+			return sink_cls
+	return None
+
+def make_sink(target_path, fps=1.0):
+	# The fps only matters for a video.
+	sink_cls = sink_class(target_path)
+	if sink_cls is None:
+		raise SinkError('not an archive, PDF or video file: "%s"' % (target_path,))
+	if sink_cls is FfmpegSink:
+		return FfmpegSink(target_path, fps=fps)
+	return sink_cls(target_path)
@@ -20,7 +20,6 @@
 
 import re
 import time
-from datetime import timedelta
 
 unit_mapping = (
 	("weeks", "weeks",),
@@ -96,6 +95,7 @@ def parse_timedelta(input):
 		for key, val in match_obj.groupdict(default='0').items():
 			kwargs.setdefault(unit_lookup[key], 0)
 			kwargs[unit_lookup[key]] += int(val)
+		from datetime import timedelta
 		tdelta = timedelta(**kwargs)
 	return tdelta
 
@@ -0,0 +1,154 @@
+# Copyright © 2015 Landon Bouma. All rights reserved.
+#
+# Permission is hereby granted,  free of charge,  to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge,  publish,  distribute, sublicense,
+# and/or  sell copies  of the Software,  and to permit persons  to whom the
+# Software  is  furnished  to do so,  subject  to  the following conditions:
+#
+# The  above  copyright  notice  and  this  permission  notice  shall  be
+# included  in  all  copies  or  substantial  portions  of  the  Software.
+#
+# THE  SOFTWARE  IS  PROVIDED  "AS IS",  WITHOUT  WARRANTY  OF ANY KIND,
+# EXPRESS OR IMPLIED,  INCLUDING  BUT NOT LIMITED  TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE  FOR ANY
+# CLAIM,  DAMAGES OR OTHER LIABILITY,  WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE,  ARISING FROM,  OUT OF  OR IN  CONNECTION WITH THE
+# SOFTWARE   OR   THE   USE   OR   OTHER   DEALINGS  IN   THE  SOFTWARE.
+
+# Wait for the files in a directory to change, using Linux's inotify if we
+# can, or by polling the directory listing if we cannot. Both watchers just
+# say *that* something changed; the caller rescans to figure out *what*.
+
+import ctypes
+import ctypes.util
+import os
+import select
+import time
+
+# From <sys/inotify.h>.
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_CLOEXEC = 0o2000000
+
+# NOTE: We watch for IN_CLOSE_WRITE and not IN_MODIFY, otherwise we'd hear
+#       about every write() while GIMP is still busy exporting the file.
+WATCH_MASK = (
+	IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+	| IN_DELETE_SELF | IN_MOVE_SELF
+)
+
+class InotifyWatcher(object):
+
+	def __init__(self, watch_dir):
+		libc_name = ctypes.util.find_library('c') or 'libc.so.6'
+		libc = ctypes.CDLL(libc_name, use_errno=True)
+		# Raises AttributeError if the libc doesn't do inotify (e.g., macOS).
+		inotify_init1 = libc.inotify_init1
+		inotify_add_watch = libc.inotify_add_watch
+		self.fd = inotify_init1(IN_CLOEXEC)
+		if self.fd < 0:
+			err = ctypes.get_errno()
+			raise OSError(err, os.strerror(err))
+		wd = inotify_add_watch(self.fd, os.fsencode(watch_dir), WATCH_MASK)
+		if wd < 0:
+			err = ctypes.get_errno()
+			os.close(self.fd)
+			raise OSError(err, os.strerror(err), watch_dir)
+
+	def wait(self, timeout=None):
+		# Return True if something changed within timeout secs (or ever, if
+		# timeout is None), or False if nothing did.
+		readable, _, _ = select.select([self.fd], [], [], timeout)
+		if not readable:
+			return False
+		# We don't care about the particulars, so just drain the queue.
+		os.read(self.fd, 64 * 1024)
+		return True
+
+	def close(self):
+		os.close(self.fd)
+
+class PollingWatcher(object):
+
+	def __init__(self, watch_dir, recursive=False, interval=1.0, skip_dir=None):
+		self.watch_dir = watch_dir
+		self.recursive = recursive
+		self.interval = interval
+		# E.g., the target directory, if it's under the source, so that
+		# writing the slides doesn't look like a change to the source.
+		self.skip_abs = os.path.abspath(skip_dir) if skip_dir else None
+		self.snapshot = self.take_snapshot()
+
+	def take_snapshot(self, rel_dir='', visited=None):
+		snapshot = {}
+		try:
+			scan_dir = os.path.join(self.watch_dir, rel_dir)
+			# Like mdm2's scan, look in each directory once, in case a symlink
+			# leads back up the tree.
+			if visited is None:
+				visited = set()
+			dir_stat = os.stat(scan_dir)
+			if (dir_stat.st_dev, dir_stat.st_ino,) in visited:
+				return snapshot
+			visited.add((dir_stat.st_dev, dir_stat.st_ino,))
+			with os.scandir(scan_dir) as entries:
+				for entry in entries:
+					rel_path = os.path.join(rel_dir, entry.name)
+					try:
+						if entry.is_dir():
+							if self.recursive and (os.path.abspath(entry.path) != self.skip_abs):
+								snapshot.update(self.take_snapshot(rel_path, visited))
+						elif entry.is_file():
+							entry_stat = entry.stat()
+							snapshot[rel_path] = (entry_stat.st_mtime_ns, entry_stat.st_size,)
+					except FileNotFoundError:
+						# Deleted out from under us, which the next poll will notice.
+						pass
+		except FileNotFoundError:
+			pass
+		return snapshot
+
+	def wait(self, timeout=None):
+		time_0 = time.time()
+		while True:
+			snapshot = self.take_snapshot()
+			if snapshot != self.snapshot:
+				self.snapshot = snapshot
+				return True
+			if timeout is not None:
+				remaining = timeout - (time.time() - time_0)
+				if remaining <= 0:
+					return False
+				time.sleep(min(self.interval, remaining))
+			else:
+				time.sleep(self.interval)
+
+	def close(self):
+		pass
+
+def make_watcher(watch_dir, recursive=False, poll_interval=1.0, skip_dir=None):
+	# An inotify watch only covers the one directory, so we poll for the
+	# recursive case, or if inotify isn't available.
+	if not recursive:
+		try:
+			return InotifyWatcher(watch_dir)
+		except (AttributeError, OSError):
+			pass
+	return PollingWatcher(
+		watch_dir, recursive=recursive, interval=poll_interval, skip_dir=skip_dir,
+	)
+
+def wait_for_quiet(watcher, debounce):
+	# Block until something changes, and then until nothing else has
+	# changed for debounce secs, so a burst of exports is one event.
+	watcher.wait(None)
+	while watcher.wait(debounce):
+		pass